@@ -4,15 +4,16 @@ Configuration for Django admin site.
 from functools import update_wrapper
 
 from django.contrib import admin
-from django.db.models import Q
+from django.contrib.admin.views.main import ChangeList
 from django.conf.urls.defaults import patterns, url, include
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
+from django.db import connections
 
 from mptt import admin as mptt_admin
 
 from phylogeny.models import Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint, TaxonImageCategory, TaxonImage, TaxaCategory
-from phylogeny.views import PhylogenyAdminVisualizeView, PhylogenyAdminImportView
+from phylogeny.views import PhylogenyAdminVisualizeView, PhylogenyAdminImportView, PhylogenyAdminImportJobView, PhylogenyAdminImportJobStatusView
 
 
 ModelAdmin = admin.ModelAdmin
@@ -74,46 +75,69 @@ class LeafNodeListFilter(admin.SimpleListFilter):
 	'''
 	Returns a queryset of either all leaf-nodes or all non-leaf-nodes.
 	
-	Note that mptt could be improved by moving instance-specific query methods
-	into the manager.  One would expect get_leafnodes() to be a manager method,
-	but it is not (as of mptt v0.5.pre).
+	Leaf nodes are found in SQL from their MPTT fields (see
+	TaxonQuerySet.leaf_nodes), so no primary keys are fetched.
 	'''
 	title = _('leaf node')
 	parameter_name = 'leaf_node'
-
+	
 	def lookups(self, request, model_admin):
 		'''Returns options for this admin filter.'''
 		return (
 			('yes', _('yes')),
 			('no', _('no')),
 		)
-
+	
 	def queryset(self, request, queryset):
 		'''Returns a queryset of items for the admin change list view.'''
-		leaf_pk_list = []
-		
-		# generates a list of primary keys of all leaf nodes
-		for root_node in Taxon._tree_manager.root_nodes():
-			if root_node.is_leaf_node():
-				leaf_pk_list += [root_node.pk]
-			leaf_pk_list += root_node.get_leafnodes().values_list('pk', flat=True)
-		
 		if self.value() == 'yes':
-			# filters items in that have a primary key in the list of primary
-			# keys of leaf nodes
-			return queryset.filter(pk__in=leaf_pk_list)
+			return queryset.leaf_nodes()
 		
 		if self.value() == 'no':
-			# filters items out that have a primary key in the list of primary
-			# keys of leaf nodes
-			return queryset.filter(~Q(pk__in=leaf_pk_list))
+			return queryset.non_leaf_nodes()
+
+
+class TaxonChangeList(ChangeList):
+	'''
+	Change list searching taxa in the search index (see search.py) rather
+	than with `icontains` lookups on `search_fields`, so words of a search
+	match the starts of words rather than any substring.
+	'''
+	def get_query_set(self, request):
+		'''Returns the filtered queryset, with the search applied from the index.'''
+		from phylogeny.search import search_index_cache
+		query = self.query
+		self.query = ''
+		try:
+			queryset = super(TaxonChangeList, self).get_query_set(request)
+		finally:
+			self.query = query
+		if query:
+			pks = search_index_cache.get().search(query)
+			if connections[queryset.db].vendor == 'sqlite':
+				# the taxa found are query parameters, so on SQLite they are
+				# filtered in batches and only then cut to the search limit
+				limit = self.model_admin.search_limit
+				found = []
+				for start in range(0, len(pks), limit):
+					found.extend(queryset.filter(pk__in=pks[start:start + limit]).values_list('pk', flat=True))
+					if len(found) >= limit:
+						break
+				pks = found[:limit]
+			queryset = queryset.filter(pk__in=pks)
+		return queryset
 
 
 class TaxonAdmin(mptt_admin.MPTTModelAdmin, ModelAdmin):
 	'''Admin for the Taxon model.'''
 	list_display = ('name', 'rank', 'is_leaf_node',)
 	list_filter = (LeafNodeListFilter,)
+	# searches go through the search index (see TaxonChangeList); the search
+	# box is shown when search fields are set
 	search_fields = ('name', 'common_name', 'rank',)
+	# largest number of taxa found by a search on SQLite (which takes up to
+	# 999 query parameters), after list filters are applied
+	search_limit = 900
 	readonly_fields = ('is_leaf_node',)
 	prepopulated_fields = {'slug': ('name',)}
 	save_on_top = True
@@ -145,6 +169,10 @@ class TaxonAdmin(mptt_admin.MPTTModelAdmin, ModelAdmin):
 		})
 	)
 	
+	def get_changelist(self, request, **kwargs):
+		'''Returns the change list class searching the search index.'''
+		return TaxonChangeList
+	
 	def get_urls(self):
 		'''
 		Adds custom admin URLs for taxon management.
@@ -161,6 +189,8 @@ class TaxonAdmin(mptt_admin.MPTTModelAdmin, ModelAdmin):
 		base_taxon_admin_urls = patterns('',
 			url(_(r'^visualize/(?P<slug>[-\w]+)/$'), wrap(PhylogenyAdminVisualizeView.as_view()), name='visualize'),
 			url(_(r'^import/$'), wrap(PhylogenyAdminImportView.as_view()), name='import'),
+			url(_(r'^import/(?P<pk>\d+)/$'), wrap(PhylogenyAdminImportJobView.as_view()), name='import_job'),
+			url(_(r'^import/(?P<pk>\d+)/status/$'), wrap(PhylogenyAdminImportJobStatusView.as_view()), name='import_job_status'),
 		)
 		
 		taxon_admin_urls = patterns('',
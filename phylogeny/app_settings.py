@@ -1,7 +1,10 @@
 '''
 General app-wide settings for Django Phylogeny.
 '''
+import os
+
 from django.utils.translation import ugettext_lazy as _
+from django.conf import settings
 
 from Bio.Phylo.PhyloXML import Taxonomy
 
@@ -28,6 +31,12 @@ TAXON_SOCIAL_UNIT_CHOICES = (
 	('colony', _('colony'),),
 )
 PHYLOGENY_IMPORT_FILE_FORMAT_CHOICES = tuple((importer.format_name, importer.format_verbose_name,) for importer in importer_registry.get_importers())
+IMPORT_JOB_STATUS_CHOICES = (
+	('queued', _('queued'),),
+	('running', _('running'),),
+	('succeeded', _('succeeded'),),
+	('failed', _('failed'),),
+)
 
 
 # default field values
@@ -36,3 +45,43 @@ TAXON_BODY_LENGTH_UNIT_DEFAULT = 'mm'
 TAXON_APPEARANCE_DATE_UNIT_DEFAULT = 'mya'
 TAXON_SOCIAL_UNIT_DEFAULT = ''
 #PHYLOGENY_IMPORT_FILE_FORMAT_DEFAULT_CHOICE = PHYLOGENY_IMPORT_FILE_FORMAT_CHOICES[0][0]
+
+# maintain the descendant and leaf counts of taxa as taxa are inserted, moved
+# and deleted (counts of taxa loaded from fixtures are recomputed with the
+# recount-phylogeny command)
+PHYLOGENY_TAXON_COUNTS = getattr(settings, 'PHYLOGENY_TAXON_COUNTS', True)
+# cache alias used to share the version of the taxa tree between processes, so
+# that tree snapshots are rebuilt after changes made by any process (None only
+# sees changes made by the current process)
+PHYLOGENY_SNAPSHOT_CACHE = getattr(settings, 'PHYLOGENY_SNAPSHOT_CACHE', 'default')
+# cache alias used to share the version of the indexed taxa between processes,
+# so that search indexes are rebuilt after changes made by any process (None
+# only sees changes made by the current process)
+PHYLOGENY_SEARCH_CACHE = getattr(settings, 'PHYLOGENY_SEARCH_CACHE', 'default')
+
+
+# importing
+# storage path (`upload_to`) of uploaded files awaiting import in the
+# background, and the cache alias used to share the progress of running
+# import jobs between processes
+PHYLOGENY_IMPORT_JOB_UPLOAD_TO = getattr(settings, 'PHYLOGENY_IMPORT_JOB_UPLOAD_TO', 'phylogeny/imports/%Y/%m')
+PHYLOGENY_IMPORT_JOB_CACHE = getattr(settings, 'PHYLOGENY_IMPORT_JOB_CACHE', 'default')
+
+
+# exporting
+# stream exports from exporters with a streaming writer (such as PhyloXML and
+# Newick) rather than building the whole phylogeny in memory; streamed taxa
+# are read after the view returns, outside the request's transaction, and the
+# database connection is closed once the download is sent
+PHYLOGENY_EXPORT_STREAMING = getattr(settings, 'PHYLOGENY_EXPORT_STREAMING', False)
+# cache alias used to cache exported phylogenies (None disables the cache),
+# how long exports are cached (in seconds), and the largest export cached (in
+# characters)
+PHYLOGENY_EXPORT_CACHE = getattr(settings, 'PHYLOGENY_EXPORT_CACHE', 'default')
+PHYLOGENY_EXPORT_CACHE_TIMEOUT = getattr(settings, 'PHYLOGENY_EXPORT_CACHE_TIMEOUT', 60 * 60 * 24)
+PHYLOGENY_EXPORT_CACHE_MAX_SIZE = getattr(settings, 'PHYLOGENY_EXPORT_CACHE_MAX_SIZE', 1024 * 1024)
+# exported phylogenies materialized as files by the materialize-phylogeny
+# command (a dictionary mapping taxon slugs to exporter format names), and the
+# directory they are written to
+PHYLOGENY_EXPORT_ARTIFACTS = getattr(settings, 'PHYLOGENY_EXPORT_ARTIFACTS', {})
+PHYLOGENY_EXPORT_ARTIFACTS_ROOT = getattr(settings, 'PHYLOGENY_EXPORT_ARTIFACTS_ROOT', os.path.join(settings.MEDIA_ROOT, 'phylogeny', 'exports'))
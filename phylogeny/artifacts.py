@@ -0,0 +1,170 @@
+'''
+Export artifacts are exported phylogenies materialized ahead of time as files,
+so that the export view can serve them without exporting.
+
+Roots and formats to materialize are listed in the
+`PHYLOGENY_EXPORT_ARTIFACTS` setting, a dictionary mapping taxon slugs to
+exporter format names:
+
+	PHYLOGENY_EXPORT_ARTIFACTS = {
+		'animalia': ('phyloxml', 'newick', 'phyloxml-jsphylosvg',),
+	}
+
+Artifacts are written to `PHYLOGENY_EXPORT_ARTIFACTS_ROOT` by the
+materialize-phylogeny command.  Each artifact has a sidecar file holding the
+export cache digest of the phylogeny it was exported from (see
+`ExportCache.get_digest`), which depends only on the phylogeny's version,
+format and pruning filter, so web workers and commands agree on it whatever
+the cache.  Stale artifacts are regenerated in a background thread.
+'''
+import logging
+import os
+from Queue import Queue
+from tempfile import mkstemp
+from threading import Lock, Thread
+
+from django.db import connection
+
+from phylogeny import app_settings
+from phylogeny.models import Taxon
+from phylogeny.exporters import exporter_registry, export_cache
+
+
+logger = logging.getLogger('phylogeny')
+
+
+class ArtifactStore(object):
+	'''
+	Materializes, checks and regenerates export artifacts.
+	'''
+	def __init__(self, artifacts=None, root=None):
+		if artifacts is None:
+			artifacts = app_settings.PHYLOGENY_EXPORT_ARTIFACTS
+		self.artifacts = artifacts
+		self.root = root or app_settings.PHYLOGENY_EXPORT_ARTIFACTS_ROOT
+		self._queue = Queue()
+		self._pending = set()
+		self._lock = Lock()
+		self._thread = None
+	
+	def get_exporters(self, slugs=None):
+		'''
+		Yields an exporter for each artifact listed in the settings (only those
+		rooted on `slugs`, if given).
+		'''
+		for slug, format_names in sorted(self.artifacts.items()):
+			if slugs and slug not in slugs:
+				continue
+			taxon = Taxon.objects.get_by_natural_key(slug)
+			for format_name in format_names:
+				exporter = exporter_registry.get_by_format_name(format_name)
+				exporter.taxon = taxon
+				yield exporter
+	
+	def is_listed(self, exporter):
+		'''
+		Returns True if the exporter's phylogeny is listed as an artifact.
+		Pruned phylogenies are never materialized.
+		'''
+		return exporter.pruning_filter is None and exporter.format_name in self.artifacts.get(exporter.taxon.slug, ())
+	
+	def get_path(self, exporter):
+		'''Returns the path of the artifact for an exporter.'''
+		return os.path.join(self.root, '%s.%s.%s' % (exporter.taxon.slug, exporter.format_name, exporter.extension,))
+	
+	def get_digest_path(self, exporter):
+		'''Returns the path of the sidecar file of the artifact for an exporter.'''
+		return '%s.digest' % self.get_path(exporter)
+	
+	def is_fresh(self, exporter, digest=None):
+		'''
+		Returns True if the artifact for an exporter exists and was exported
+		from the phylogeny as it is now.
+		'''
+		digest = digest or export_cache.get_digest(exporter)
+		try:
+			with open(self.get_digest_path(exporter), 'r') as open_file:
+				materialized_digest = open_file.read().strip()
+		except IOError:
+			return False
+		return materialized_digest == digest and os.path.exists(self.get_path(exporter))
+	
+	def write_atomically(self, path, write):
+		'''
+		Calls `write` with a temporary path next to `path`, then renames the
+		temporary file to `path` so readers never see a partial file.
+		'''
+		descriptor, temporary_path = mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+		os.close(descriptor)
+		try:
+			write(temporary_path)
+			os.chmod(temporary_path, 0644)
+			os.rename(temporary_path, path)
+		except:
+			os.remove(temporary_path)
+			raise
+	
+	def materialize(self, exporter, digest=None):
+		'''
+		Exports the phylogeny to its artifact with the exporter's `save`
+		method.  The sidecar file is written last, so the artifact is only
+		ever considered fresh once it has been written completely.
+		'''
+		digest = digest or export_cache.get_digest(exporter)
+		if not os.path.isdir(self.root):
+			os.makedirs(self.root)
+		
+		def write_digest(path):
+			with open(path, 'w') as open_file:
+				open_file.write(digest)
+		
+		self.write_atomically(self.get_path(exporter), exporter.save)
+		self.write_atomically(self.get_digest_path(exporter), write_digest)
+	
+	def get_fresh_path(self, exporter, digest=None):
+		'''
+		Returns the path of the artifact for an exporter if it is fresh.
+		Returns None otherwise, scheduling stale artifacts for regeneration.
+		'''
+		if not self.is_listed(exporter):
+			return None
+		if self.is_fresh(exporter, digest):
+			return self.get_path(exporter)
+		self.regenerate(exporter)
+		return None
+	
+	def regenerate(self, exporter):
+		'''
+		Schedules the artifact for an exporter for regeneration in the
+		background thread, unless it is already scheduled.
+		'''
+		key = (exporter.taxon.slug, exporter.format_name,)
+		with self._lock:
+			if key in self._pending:
+				return
+			self._pending.add(key)
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = Thread(target=self.work, name='phylogeny-artifacts')
+				self._thread.daemon = True
+				self._thread.start()
+		self._queue.put(key)
+	
+	def work(self):
+		'''Regenerates scheduled artifacts one at a time.'''
+		while True:
+			slug, format_name = key = self._queue.get()
+			try:
+				exporter = exporter_registry.get_by_format_name(format_name)
+				exporter.taxon = Taxon.objects.get_by_natural_key(slug)
+				self.materialize(exporter)
+			except Exception:
+				logger.exception('Failed to regenerate export artifact %s.%s.' % key)
+			finally:
+				with self._lock:
+					self._pending.discard(key)
+				# the thread has its own database connection
+				connection.close()
+
+
+# materializes the artifacts listed in the settings
+artifact_store = ArtifactStore()
@@ -0,0 +1,538 @@
+'''
+Columnar snapshot files store a phylogeny compactly, for backup and fast
+reload.  They are written by the "columnar" exporter and read by the
+"columnar" importer.
+
+A file holds tables of fixed-width columns:
+
+	taxa         the taxa of the phylogeny in depth-first order, root first;
+	             `parent` is the row of the parent taxon (-1 for the root)
+	categories   the taxa categories of the taxa
+	databases    the taxonomy databases of the taxonomy records
+	citations, records, points
+	             the citations, taxonomy records and distribution points of
+	             the taxa
+
+Columns hold the fields of the models, except primary keys and the fields
+derived from the tree (MPTT fields, lineage paths and counts), which are
+recomputed on import.  Related objects are referred to by row.  Numbers are
+stored as 64-bit floats (NaN for null) or 32-bit integers (the smallest
+integer for null).  Text, dates and other values are stored once as UTF-8 in
+a string table and referred to by index (-1 for null), so repeated values
+such as ranks and units take 4 bytes per row.
+
+A file starts with the magic bytes "PHYLOCOL", the length of its header (4
+bytes) and the header:  JSON describing its tables and string table.  The
+columns follow, little-endian and aligned on 8 bytes.  Files are mapped into
+memory when read; with NumPy, columns are arrays over the mapped file rather
+than copies.
+'''
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from django.db import connection, transaction
+from django.db.models import Max, get_model
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+
+from phylogeny.exceptions import PhyloColumnarFileError
+from phylogeny.managers import make_path
+
+
+MAGIC = 'PHYLOCOL'
+VERSION = 1
+# null values of integer columns and of string and row columns
+NULL_INTEGER = -2 ** 31
+NULL_INDEX = -1
+
+# array type codes and NumPy types of column kinds
+COLUMN_TYPES = {
+	'float': ('d', '<f8'),
+	'integer': ('i', '<i4'),
+	'string': ('i', '<i4'),
+	'row': ('i', '<i4'),
+}
+# string offsets
+OFFSET_TYPE = ('I', '<u4')
+# fields stored in integer columns (other fields but floats and relations
+# are stored as strings)
+INTEGER_FIELDS = ('BooleanField', 'IntegerField', 'NullBooleanField', 'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallIntegerField',)
+
+# tables:  name, model and fields left out
+TABLES = (
+	('taxa', 'Taxon', ('lft', 'rght', 'tree_id', 'level', 'path', 'descendant_count', 'leaf_count',)),
+	('categories', 'TaxaCategory', ()),
+	('databases', 'TaxonomyDatabase', ()),
+	('citations', 'Citation', ()),
+	('records', 'TaxonomyRecord', ()),
+	('points', 'DistributionPoint', ()),
+)
+
+
+def get_columns(model, excluded=()):
+	'''
+	Returns the (name, kind, field) of the columns storing the fields of a
+	model:  every local field but the primary key and `excluded` fields.
+	'''
+	columns = []
+	for field in model._meta.local_fields:
+		if field.primary_key or field.name in excluded:
+			continue
+		if field.rel:
+			kind = 'row'
+		elif field.get_internal_type() == 'FloatField':
+			kind = 'float'
+		elif field.get_internal_type() in INTEGER_FIELDS:
+			kind = 'integer'
+		else:
+			kind = 'string'
+		columns.append((field.name, kind, field,))
+	return columns
+
+
+def to_string(value):
+	'''Returns the string stored for a value of a string column.'''
+	if value is None:
+		return None
+	if isinstance(value, (datetime, date, time,)):
+		return value.isoformat()
+	return force_unicode(value)
+
+
+def align(offset):
+	'''Returns an offset rounded up to a multiple of 8 bytes.'''
+	return (offset + 7) & ~7
+
+
+class ColumnarWriter(object):
+	'''Collects tables of columns and writes them as a columnar snapshot file.'''
+	def __init__(self):
+		# (name, number of rows, [(column name, kind, array)])
+		self.tables = []
+		self._strings = {}
+		self._string_data = []
+		self._string_offsets = array(OFFSET_TYPE[0], [0])
+	
+	def add_string(self, value):
+		'''Returns the index of a string in the string table, adding it if needed.'''
+		if value is None:
+			return NULL_INDEX
+		index = self._strings.get(value)
+		if index is None:
+			data = value.encode('utf-8')
+			index = self._strings[value] = len(self._string_data)
+			self._string_data.append(data)
+			self._string_offsets.append(self._string_offsets[-1] + len(data))
+		return index
+	
+	def add_table(self, name, columns, rows):
+		'''
+		Adds a table from its columns (see `get_columns`) and rows (sequences
+		of field values, with rows instead of related objects) and returns
+		the number of rows.
+		'''
+		arrays = [array(COLUMN_TYPES[kind][0]) for column_name, kind, field in columns]
+		converters = [self.get_converter(kind) for column_name, kind, field in columns]
+		count = 0
+		for row in rows:
+			for values, convert, value in zip(arrays, converters, row):
+				values.append(convert(value))
+			count += 1
+		self.tables.append((name, count, [(column[0], column[1], values,) for column, values in zip(columns, arrays)],))
+		return count
+	
+	def get_converter(self, kind):
+		'''Returns a function converting field values to values of a column kind.'''
+		if kind == 'float':
+			return lambda value: float('nan') if value is None else value
+		if kind == 'integer':
+			return lambda value: NULL_INTEGER if value is None else int(value)
+		if kind == 'row':
+			return lambda value: NULL_INDEX if value is None else value
+		return lambda value: self.add_string(to_string(value))
+	
+	def get_chunks(self):
+		'''Yields the file as byte strings:  its header, then column by column.'''
+		header = {'version': VERSION, 'tables': []}
+		# (offset, array or byte strings) of columns, from the end of the header
+		columns = []
+		offset = 0
+		for name, count, table_columns in self.tables:
+			table = {'name': name, 'count': count, 'columns': []}
+			for column_name, kind, values in table_columns:
+				table['columns'].append({'name': column_name, 'kind': kind, 'offset': offset})
+				columns.append((offset, values,))
+				offset = align(offset + len(values) * values.itemsize)
+			header['tables'].append(table)
+		header['strings'] = {'count': len(self._string_data), 'offsets': offset}
+		columns.append((offset, self._string_offsets,))
+		offset = header['strings']['data'] = align(offset + len(self._string_offsets) * self._string_offsets.itemsize)
+		columns.append((offset, self._string_data,))
+		
+		header = simplejson.dumps(header)
+		start = align(len(MAGIC) + 4 + len(header))
+		yield MAGIC + struct.pack('<I', len(header)) + header + '\0' * (start - len(MAGIC) - 4 - len(header))
+		position = 0
+		for offset, values in columns:
+			if offset > position:
+				yield '\0' * (offset - position)
+				position = offset
+			if isinstance(values, array):
+				if sys.byteorder == 'big':
+					values = array(values.typecode, values)
+					values.byteswap()
+				data = values.tostring()
+				yield data
+				position += len(data)
+			else:
+				for start in xrange(0, len(values), 1000):
+					data = ''.join(values[start:start + 1000])
+					yield data
+					position += len(data)
+	
+	def write(self, open_file):
+		'''Writes the file to an open file object.'''
+		for chunk in self.get_chunks():
+			open_file.write(chunk)
+
+
+class ColumnarReader(object):
+	'''
+	Reads a columnar snapshot file from a path or file object.  Files on disk
+	are mapped into memory; others are read whole.
+	'''
+	def __init__(self, source):
+		self._file = None
+		if isinstance(source, basestring):
+			source = self._file = open(source, 'rb')
+		try:
+			self.buffer = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+		except (AttributeError, EnvironmentError, ValueError,):
+			# not a file on disk (or an empty one)
+			self.buffer = source.read()
+		
+		if self.buffer[:len(MAGIC)] != MAGIC:
+			self.close()
+			raise PhyloColumnarFileError('Not a columnar snapshot file.')
+		header_size = struct.unpack('<I', self.buffer[len(MAGIC):len(MAGIC) + 4])[0]
+		header = simplejson.loads(self.buffer[len(MAGIC) + 4:len(MAGIC) + 4 + header_size])
+		if header.get('version') != VERSION:
+			self.close()
+			raise PhyloColumnarFileError('Unsupported columnar snapshot file version:  %s.' % header.get('version'))
+		self.data_offset = align(len(MAGIC) + 4 + header_size)
+		self.tables = dict((table['name'], table,) for table in header['tables'])
+		self.strings = header['strings']
+		self._string_offsets = self.read_array(self.strings['offsets'], OFFSET_TYPE, self.strings['count'] + 1)
+	
+	def read_array(self, offset, types, count):
+		'''
+		Returns `count` values of a type (an array type code and a NumPy type)
+		at an offset from the end of the header:  an array over the file with
+		NumPy, otherwise a copy.
+		'''
+		offset += self.data_offset
+		if numpy is not None:
+			return numpy.frombuffer(self.buffer, dtype=types[1], count=count, offset=offset)
+		values = array(types[0])
+		values.fromstring(self.buffer[offset:offset + count * values.itemsize])
+		if sys.byteorder == 'big':
+			values.byteswap()
+		return values
+	
+	def get_count(self, table):
+		'''Returns the number of rows of a table (0 if the file does not have it).'''
+		return self.tables.get(table, {}).get('count', 0)
+	
+	def get_column_names(self, table):
+		'''Returns the names of the columns of a table.'''
+		return [column['name'] for column in self.tables.get(table, {}).get('columns', ())]
+	
+	def get_column(self, table, name):
+		'''Returns the values of a column (see `read_array`).'''
+		for column in self.tables[table]['columns']:
+			if column['name'] == name:
+				return self.read_array(column['offset'], COLUMN_TYPES[column['kind']], self.tables[table]['count'])
+		raise KeyError(name)
+	
+	def get_string(self, index):
+		'''Returns a string of the string table by index (None for -1).'''
+		if index < 0:
+			return None
+		start = self.data_offset + self.strings['data']
+		return self.buffer[start + int(self._string_offsets[index]):start + int(self._string_offsets[index + 1])].decode('utf-8')
+	
+	def close(self):
+		'''Closes the file.  Columns read with NumPy must no longer be used.'''
+		if isinstance(self.buffer, mmap.mmap):
+			self.buffer.close()
+		if self._file is not None:
+			self._file.close()
+
+
+def dump_phylogeny(taxon, pruned=(), chunk_size=1000):
+	'''
+	Returns a ColumnarWriter holding the phylogeny rooted on a taxon, with
+	the related objects of its taxa.  Descendants of the taxa in `pruned`
+	(primary keys) are left out.  Taxa are fetched `chunk_size` at a time as
+	values rather than model instances.
+	'''
+	models = dict((name, get_model('phylogeny', model_name),) for name, model_name, excluded in TABLES)
+	columns = dict((name, get_columns(models[name], excluded),) for name, model_name, excluded in TABLES)
+	writer = ColumnarWriter()
+	# the lft of each taxon by row, to look up the rows of related objects
+	lfts = array('l')
+	# rows of referred categories and databases by primary key
+	rows = {'categories': {}, 'databases': {}}
+	
+	def get_taxa():
+		'''Yields the rows of taxa in depth-first order.'''
+		names = [column[0] for column in columns['taxa']]
+		parent_index = names.index('parent')
+		category_index = names.index('category')
+		queryset = taxon.get_descendants(include_self=True).values_list('pk', 'lft', 'rght', *names)
+		# (rght, row) of the ancestors of the current taxon
+		stack = []
+		pruned_rght = 0
+		last_lft = None
+		while True:
+			chunk = queryset
+			if last_lft is not None:
+				chunk = chunk.filter(lft__gt=last_lft)
+			chunk = list(chunk[:chunk_size])
+			for values in chunk:
+				pk, lft, rght = values[:3]
+				values = list(values[3:])
+				if lft < pruned_rght:
+					continue
+				if pk in pruned:
+					pruned_rght = rght
+				while stack and stack[-1][0] < lft:
+					stack.pop()
+				values[parent_index] = stack[-1][1] if stack else None
+				if values[category_index] is not None:
+					values[category_index] = rows['categories'].setdefault(values[category_index], len(rows['categories']))
+				stack.append((rght, len(lfts),))
+				lfts.append(lft)
+				yield values
+			if len(chunk) < chunk_size:
+				return
+			last_lft = max(chunk[-1][1], pruned_rght)
+	
+	def get_related(name):
+		'''Yields the rows of the objects of a model related to the taxa.'''
+		names = [column[0] for column in columns[name]]
+		queryset = models[name].objects.filter(taxon__tree_id=taxon.tree_id, taxon__lft__gte=taxon.lft, taxon__lft__lte=taxon.rght)
+		for values in queryset.order_by('taxon__lft', 'pk').values_list('taxon__lft', *names).iterator():
+			row = bisect_left(lfts, values[0])
+			if row == len(lfts) or lfts[row] != values[0]:
+				# a pruned taxon
+				continue
+			values = list(values[1:])
+			values[names.index('taxon')] = row
+			if name == 'records':
+				values[names.index('database')] = rows['databases'].setdefault(values[names.index('database')], len(rows['databases']))
+			yield values
+	
+	def get_referred(name):
+		'''Yields the rows of referred categories or databases.'''
+		names = [column[0] for column in columns[name]]
+		pks = sorted(rows[name], key=rows[name].get)
+		objects = dict((values[0], values[1:],) for values in models[name].objects.filter(pk__in=pks).values_list('pk', *names))
+		for pk in pks:
+			yield objects[pk]
+	
+	writer.add_table('taxa', columns['taxa'], get_taxa())
+	for name in ('citations', 'records', 'points',):
+		writer.add_table(name, columns[name], get_related(name))
+	for name in ('categories', 'databases',):
+		writer.add_table(name, columns[name], get_referred(name))
+	return writer
+
+
+class ColumnarLoader(object):
+	'''
+	Writes the phylogeny of a columnar snapshot file as a new tree with
+	batched inserts.  Tree fields, counts and lineage paths are computed from
+	the parent rows of taxa.  Categories and taxonomy databases are matched
+	with existing ones by slug (and created if missing).
+	
+	Always load within a transaction so that a merge conflict rolls back the
+	whole tree.
+	'''
+	# number of slugs per query when scanning for conflicts
+	scan_batch_size = 900
+	
+	def __init__(self, reader, batch_size=500, progress=None):
+		'''
+		Initializes a loader for a file read by a ColumnarReader.  `progress`
+		is called with the number of taxa written after every batch.
+		'''
+		self.reader = reader
+		self.batch_size = batch_size
+		self.progress = progress
+		self.models = dict((name, get_model('phylogeny', model_name),) for name, model_name, excluded in TABLES)
+		# columns of the current models which the file has
+		self.columns = {}
+		for name, model_name, excluded in TABLES:
+			names = reader.get_column_names(name)
+			self.columns[name] = [column for column in get_columns(self.models[name], excluded) if column[0] in names]
+		# primary keys by row
+		self.pks = {}
+	
+	def get_converter(self, kind, field):
+		'''Returns a function converting values of a column to database values.'''
+		if kind == 'float':
+			return lambda value: None if value != value else value
+		if kind == 'integer':
+			return lambda value: None if value == NULL_INTEGER else field.to_python(value)
+		if kind == 'row':
+			pks = self.pks[dict((model, name,) for name, model in self.models.items())[field.rel.to]]
+			return lambda value: None if value < 0 else pks[value]
+		if field.get_internal_type() in ('CharField', 'SlugField', 'TextField',):
+			return self.reader.get_string
+		# dates and other values are converted once per distinct value
+		cache = {NULL_INDEX: None}
+		def convert(index):
+			try:
+				return cache[index]
+			except KeyError:
+				value = cache[index] = field.get_db_prep_save(field.to_python(self.reader.get_string(index)), connection=connection)
+				return value
+		return convert
+	
+	def get_rows(self, table, columns, start=0, end=None):
+		'''Yields rows start to end of a table as tuples of database values.'''
+		if end is None:
+			end = self.reader.get_count(table)
+		if end <= start:
+			return
+		converters = [self.get_converter(kind, field) for name, kind, field in columns]
+		values = [self.reader.get_column(table, name)[start:end].tolist() for name, kind, field in columns]
+		for row in zip(*values):
+			yield tuple(convert(value) for convert, value in zip(converters, row))
+	
+	def insert(self, model, column_names, rows):
+		'''Inserts rows of database values with batched INSERT statements.'''
+		qn = connection.ops.quote_name
+		sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table), ', '.join(qn(column) for column in column_names), ', '.join(['%s'] * len(column_names)))
+		cursor = connection.cursor()
+		batch = []
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= self.batch_size:
+				cursor.executemany(sql, batch)
+				batch = []
+		if batch:
+			cursor.executemany(sql, batch)
+	
+	def load_referred(self, table):
+		'''Matches the rows of categories or databases with existing objects by slug, creating missing ones.'''
+		model = self.models[table]
+		columns = self.columns[table]
+		names = [column[0] for column in columns]
+		rows = [dict(zip(names, [column[2].to_python(value) for column, value in zip(columns, row)])) for row in self.get_rows(table, columns)]
+		existing = dict(model.objects.filter(slug__in=[row['slug'] for row in rows]).values_list('slug', 'pk'))
+		self.pks[table] = [existing.get(row['slug']) or model.objects.create(**row).pk for row in rows]
+	
+	def get_tree(self):
+		'''
+		Returns the level, MPTT `lft` and `rght`, and descendant and leaf
+		counts of each taxon from the parent rows.  Raises
+		PhyloColumnarFileError if taxa are not in depth-first order.
+		'''
+		parents = self.reader.get_column('taxa', 'parent').tolist()
+		count = len(parents)
+		if not count or parents[0] != NULL_INDEX:
+			raise PhyloColumnarFileError('The first taxon of a columnar snapshot file must be its root.')
+		levels = [0] * count
+		# open rows
+		stack = [0]
+		for row in xrange(1, count):
+			parent = parents[row]
+			while stack and stack[-1] != parent:
+				stack.pop()
+			if not stack:
+				raise PhyloColumnarFileError('Taxa of a columnar snapshot file must be in depth-first order.')
+			levels[row] = len(stack)
+			stack.append(row)
+		sizes = [1] * count
+		leaves = [0] * count
+		for row in xrange(count - 1, 0, -1):
+			leaves[row] = leaves[row] or 1
+			sizes[parents[row]] += sizes[row]
+			leaves[parents[row]] += leaves[row]
+		leaves[0] = leaves[0] or 1
+		# in depth-first order, the taxa before a taxon but its ancestors are closed
+		lfts = [2 * row - levels[row] + 1 for row in xrange(count)]
+		rghts = [lft + 2 * size - 1 for lft, size in zip(lfts, sizes)]
+		return levels, lfts, rghts, [size - 1 for size in sizes], leaves
+	
+	def check_conflicts(self):
+		'''Raises PhylogenyImportMergeConflict if the slug of a taxon already exists.'''
+		from phylogeny.importers import merge_conflict
+		slugs = self.reader.get_column('taxa', 'slug')
+		for start in xrange(0, len(slugs), self.scan_batch_size):
+			batch = [self.reader.get_string(index) for index in slugs[start:start + self.scan_batch_size].tolist()]
+			existing = self.models['taxa'].objects.filter(slug__in=batch).values_list('name', flat=True)[:1]
+			if existing:
+				raise merge_conflict(existing[0])
+	
+	def load(self):
+		'''Writes the phylogeny and returns its root taxon.'''
+		from phylogeny.search import search_index_cache
+		from phylogeny.snapshots import snapshot_cache
+		Taxon = self.models['taxa']
+		levels, lfts, rghts, descendant_counts, leaf_counts = self.get_tree()
+		self.check_conflicts()
+		for table in ('categories', 'databases',):
+			self.load_referred(table)
+		
+		# taxa are inserted without parents, which are set along with their
+		# lineage paths once their primary keys are known
+		tree_id = (Taxon.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+		columns = [column for column in self.columns['taxa'] if column[0] != 'parent']
+		column_names = [column[2].column for column in columns] + ['tree_id', 'lft', 'rght', 'level', 'descendant_count', 'leaf_count', 'path']
+		count = len(lfts)
+		for start in xrange(0, count, self.batch_size):
+			end = min(start + self.batch_size, count)
+			tree = zip(lfts[start:end], rghts[start:end], levels[start:end], descendant_counts[start:end], leaf_counts[start:end])
+			self.insert(Taxon, column_names, (row + (tree_id,) + tree_row + ('',) for row, tree_row in zip(self.get_rows('taxa', columns, start, end), tree)))
+			if self.progress is not None:
+				self.progress(end)
+		pks = self.pks['taxa'] = list(Taxon.objects.filter(tree_id=tree_id).order_by('lft').values_list('pk', flat=True))
+		
+		qn = connection.ops.quote_name
+		opts = Taxon._meta
+		sql = 'UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s' % (qn(opts.db_table), qn(opts.get_field('parent').column), qn(opts.get_field('path').column), qn(opts.pk.column))
+		cursor = connection.cursor()
+		parents = self.reader.get_column('taxa', 'parent').tolist()
+		# lineage paths of the open taxa
+		paths = {}
+		batch = []
+		for row, parent in enumerate(parents):
+			parent_pk = pks[parent] if parent >= 0 else None
+			paths[levels[row]] = path = make_path(paths[levels[row] - 1] if parent >= 0 else '', pks[row])
+			batch.append((parent_pk, path, pks[row],))
+			if len(batch) >= self.batch_size:
+				cursor.executemany(sql, batch)
+				batch = []
+		if batch:
+			cursor.executemany(sql, batch)
+		
+		for table in ('citations', 'records', 'points',):
+			columns = self.columns[table]
+			self.insert(self.models[table], [column[2].column for column in columns], self.get_rows(table, columns))
+		transaction.commit_unless_managed()
+		# taxa are inserted without signals
+		snapshot_cache.invalidate()
+		search_index_cache.invalidate()
+		return Taxon.objects.get(pk=pks[0])
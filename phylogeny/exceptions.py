@@ -77,3 +77,17 @@ class PhylogenyDjangoColorsNotInstalled(Exception):
 	'''Django Colors app is not installed.'''
 	pass
 
+
+class PhyloSnapshotTaxonNotFound(Exception):
+	'''A taxon was looked up in a tree snapshot which does not contain it.'''
+	pass
+
+
+class PhyloMetricsNumPyNotAvailable(Exception):
+	'''Tree metrics were requested but NumPy is not installed.'''
+	pass
+
+
+class PhyloColumnarFileError(Exception):
+	'''A columnar snapshot file is invalid or of an unsupported version.'''
+	pass
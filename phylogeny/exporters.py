@@ -8,22 +8,68 @@ accessible throughout the app:
 
 	exporter_registry.register(<MyExporterClass>)
 '''
+import re
 from abc import ABCMeta, abstractmethod
+from hashlib import md5
 from inspect import isclass
+from xml.sax.saxutils import escape
 
-from django.db import transaction
+from django.core.cache import get_cache
+from django.db.models import Count, Max
+from django.db.models.query import prefetch_related_objects
 from django.template import Context
 from django.template.loader import get_template
+from django.utils.encoding import force_unicode
+from django.utils.formats import localize
+from django.utils.html import escape as escape_html
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
 from Bio import Phylo
 
+from phylogeny import app_settings
+from phylogeny.columnar import dump_phylogeny
 from phylogeny.models import Taxon, TaxaCategory
+from phylogeny.utils import SharedVersion, join_chunks
 from phylogeny.exceptions import PhyloExporterUnsupportedTaxonAssignment, PhyloExporterMissingAttribute, PhyloExporterRegistryOnlyClassesMayRegister, PhyloExporterRegistryClassAlreadyRegistered, PhyloExporterRegistryExporterNotFound
 
 
+# Newick node labels matching this pattern are written without quotes
+NEWICK_UNQUOTED_LABEL = re.compile(r"[^\s\(\)\[\]\'\:\;\,]+$")
+
+
+def format_xml_value(value):
+	'''Formats a value as PhyloXML text, the same way Biopython does.'''
+	if isinstance(value, float):
+		return (u'%s' % value).upper()
+	return u'%s' % value
+
+
+def format_xml_element(indent, tag, value=None, attributes=None):
+	'''
+	Returns a line containing a PhyloXML element with escaped text and
+	attributes.  Elements without a value are written as empty elements.
+	'''
+	attributes = u''.join(u' %s="%s"' % (name, escape(format_xml_value(attribute_value), {'"': '&quot;', '\n': '&#10;'})) for name, attribute_value in sorted((attributes or {}).items()))
+	if value is None or value == u'':
+		return u'%s<%s%s />\n' % (indent, tag, attributes,)
+	return u'%s<%s%s>%s</%s>\n' % (indent, tag, attributes, escape(format_xml_value(value)), tag,)
+
+
+def format_newick_label(name):
+	'''Returns a Newick node label, quoted if it contains special characters.'''
+	if not name or NEWICK_UNQUOTED_LABEL.match(name):
+		return name or u''
+	return u"'%s'" % name.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def render_value(value):
+	'''Renders a value the way a template variable with autoescaping would.'''
+	return escape_html(force_unicode(localize(value)))
+
+
 class ExporterRegistry(object):
 	'''
 	Registers exporters and reports on exporter availability.
@@ -95,6 +141,18 @@ class AbstractBasePhyloExporter(object):
 	format_name = None
 	# file extension of phylogeny format
 	extension = None
+	# MIME type of exported phylogenies served by views (by default, from
+	# the extension)
+	content_type = None
+	# related objects fetched along with the taxa of the phylogeny
+	select_related = ()
+	prefetch_related = ()
+	# whether `stream` writes the phylogeny incrementally
+	streaming = False
+	# number of taxa fetched per query when streaming
+	chunk_size = 1000
+	# tree snapshot to read the phylogeny from instead of the database
+	snapshot = None
 	
 	def __init__(self, taxon=None, export_to=None, pruning_filter=None, *args, **kwargs):
 		'''Initializes an instance of the phylogeny exporter.'''
@@ -195,6 +253,148 @@ class AbstractBasePhyloExporter(object):
 		'''Sets the value of the `pruning_filter` property.'''
 		self._pruning_filter = pruning_filter
 	
+	def get_queryset(self):
+		'''
+		Returns a queryset of the taxa in the phylogeny (the taxon and all of
+		its descendants) in depth-first order.
+		'''
+		queryset = self.taxon.get_descendants(include_self=True)
+		if self.select_related:
+			queryset = queryset.select_related(*self.select_related)
+		return queryset
+	
+	def get_taxa(self, chunk_size=None):
+		'''
+		Yields the taxa to export in depth-first order, with related objects
+		prefetched in bulk.
+		
+		Descendants of taxa matching the pruning filter are skipped while
+		walking the phylogeny.  Pruning is read-only:  nothing is deleted and
+		no transaction is needed.
+		
+		If `chunk_size` is given, taxa are fetched `chunk_size` at a time,
+		paging on `lft`, so that only one chunk of taxa is held in memory.
+		Pruned subtrees are skipped by the paging query itself.
+		
+		If `snapshot` is set, taxa are unsaved instances built from the tree
+		snapshot, holding only its fields.
+		'''
+		queryset = self.get_queryset()
+		pruned = set()
+		pruning_filter = self.pruning_filter
+		if pruning_filter:
+			pruned = set(queryset.filter(**pruning_filter).values_list('pk', flat=True))
+		
+		if self.snapshot is not None:
+			for taxa in self.snapshot.get_taxa(self.taxon, pruned, chunk_size or self.chunk_size):
+				if self.prefetch_related:
+					prefetch_related_objects(taxa, self.prefetch_related)
+				for taxon in taxa:
+					yield taxon
+			return
+		
+		pruned_rght = 0
+		last_lft = None
+		while True:
+			chunk = queryset
+			if last_lft is not None:
+				chunk = chunk.filter(lft__gt=last_lft)
+			if chunk_size:
+				chunk = chunk[:chunk_size]
+			chunk = list(chunk)
+			
+			taxa = []
+			for taxon in chunk:
+				# skip the descendants of the last pruned taxon
+				if taxon.lft < pruned_rght:
+					continue
+				if taxon.pk in pruned:
+					pruned_rght = taxon.rght
+				taxa.append(taxon)
+			
+			if self.prefetch_related:
+				prefetch_related_objects(taxa, self.prefetch_related)
+			for taxon in taxa:
+				yield taxon
+			
+			if not chunk_size or len(chunk) < chunk_size:
+				return
+			# resume after the last taxon fetched or the last pruned subtree
+			last_lft = max(chunk[-1].lft, pruned_rght)
+	
+	def walk(self, chunk_size=None):
+		'''
+		Walks the phylogeny without recursion.  Yields a ("start", taxon) event
+		when a taxon is entered and an ("end", taxon) event once all of its
+		descendants have been walked.  Parent/child relations are derived from
+		MPTT `lft` and `rght` values, so no further queries are made per taxon.
+		
+		Only the ancestors of the current taxon are kept on the stack, so with
+		a `chunk_size` memory is bounded by chunk size and tree depth.
+		'''
+		stack = []
+		for taxon in self.get_taxa(chunk_size=chunk_size):
+			while stack and stack[-1].rght < taxon.lft:
+				yield 'end', stack.pop()
+			yield 'start', taxon
+			stack.append(taxon)
+		while stack:
+			yield 'end', stack.pop()
+	
+	def stream(self):
+		'''
+		Yields the phylogeny as a series of unicode strings.  Exporters with a
+		streaming writer set `streaming` to True and write the phylogeny while
+		walking it; other exporters yield the whole phylogeny at once.
+		'''
+		yield self()
+	
+	def write(self, open_file):
+		'''Writes the phylogeny chunk by chunk to an open file object.'''
+		for chunk in self.stream():
+			if isinstance(chunk, unicode):
+				chunk = chunk.encode('utf-8')
+			open_file.write(chunk)
+	
+	def get_state(self):
+		'''
+		Returns a dictionary with the number of taxa in the phylogeny
+		(`count`), the numbers of their citations, taxonomy records and
+		distribution points (`related_counts`), and the latest modification
+		date among them and their taxonomy databases and taxa categories
+		(`last_modified`), fetched in one aggregate query.
+		'''
+		state = self.taxon.get_descendants(include_self=True).aggregate(
+			count=Count('pk', distinct=True),
+			citation_count=Count('citation', distinct=True),
+			taxonomyrecord_count=Count('taxonomyrecord', distinct=True),
+			distributionpoint_count=Count('distributionpoint', distinct=True),
+			taxon_modified=Max('date_modified'),
+			category_modified=Max('category__date_modified'),
+			citation_modified=Max('citation__date_modified'),
+			taxonomyrecord_modified=Max('taxonomyrecord__date_modified'),
+			database_modified=Max('taxonomyrecord__database__date_modified'),
+			distributionpoint_modified=Max('distributionpoint__date_modified')
+		)
+		dates = [value for key, value in state.items() if key.endswith('_modified') and value is not None]
+		return {
+			'count': state['count'],
+			'related_counts': (state['citation_count'], state['taxonomyrecord_count'], state['distributionpoint_count'],),
+			'last_modified': dates and max(dates) or None,
+		}
+	
+	def get_version(self, state=None):
+		'''
+		Returns a string which changes whenever taxa are added to, moved within
+		or removed from the phylogeny, or are modified, and whenever the data
+		exported with them is:  the tree span of the root taxon combined with
+		the phylogeny's state.
+		'''
+		if state is None:
+			state = self.get_state()
+		last_modified = state['last_modified']
+		return u'%s.%s.%s.%s.%s.%s' % (self.taxon.tree_id, self.taxon.lft, self.taxon.rght, state['count'], u'.'.join(map(unicode, state['related_counts'])), last_modified and last_modified.isoformat(),)
+	
 	@abstractmethod
 	def get_object(self):
 		'''Returns an object representating the phylogeny to export.'''
@@ -210,6 +410,7 @@ class AbstractBaseBiopythonPhyloExporter(AbstractBasePhyloExporter):
 	'''Exports a phylogeny rooted on a given taxon to a Biopython phylogeny.'''
 	__metaclass__ = ABCMeta
 	verbose_name = _('Export Biopython Phylogeny')
+	prefetch_related = ('taxonomyrecord_set__database', 'distributionpoint_set', 'citation_set',)
 	
 	def __call__(self):
 		'''Returns a string representation of the PhyloXML phylogeny.'''
@@ -217,8 +418,9 @@ class AbstractBaseBiopythonPhyloExporter(AbstractBasePhyloExporter):
 	
 	def get_clade_for_taxon(self, taxon, parent_clade=None):
 		'''
-		Marshals data from taxon and its children recursively to new Clade(s).
-		Returns the new root clade object.
+		Marshals data from a taxon to a new Clade, which is appended to the
+		children of `parent_clade` if given.  Returns the new clade object.
+		Related objects are read from the prefetched taxa.
 		
 		Biopython's PhyloXML library is used because it is the most
 		comprehensive available and may easily be converted to other formats,
@@ -287,28 +489,19 @@ class AbstractBaseBiopythonPhyloExporter(AbstractBasePhyloExporter):
 		if parent_clade:
 			parent_clade.clades += [clade]
 		
-		# recurse into child taxa
-		for child_taxon in taxon.get_children():
-			self.get_clade_for_taxon(child_taxon, parent_clade=clade)
-		
 		return clade
 	
 	def get_object(self):
 		'''Returns a Biopython phylogeny object.'''
-		# open a transaction so that taxa may be pruned during export
-		# and then rolled back
-		with transaction.commit_manually():
-			# if there is a pruning filter, delete all children of matching taxa
-			pruning_filter = self.pruning_filter
-			if pruning_filter:
-				for taxon in Taxon.objects.filter(**pruning_filter):
-					for child in taxon.get_children():
-						child.delete()
-			# get the clade (and its children) for the taxon
-			clade = self.get_clade_for_taxon(self.taxon)
-			# rollback the transaction
-			# (don't actually allow any taxon deletions to stand)
-			transaction.rollback()
+		# get the clade (and its children) for the taxon in a single pass
+		# over the phylogeny
+		clades = []
+		for event, taxon in self.walk():
+			if event == 'start':
+				parent_clade = clades[-1] if clades else None
+				clades.append(self.get_clade_for_taxon(taxon, parent_clade=parent_clade))
+			else:
+				clade = clades.pop()
 		
 		phylogeny = clade.to_phylogeny()
 		
@@ -326,6 +519,86 @@ class PhyloXMLPhyloExporter(AbstractBaseBiopythonPhyloExporter):
 	verbose_name = _('Export PhyloXML Phylogeny')
 	format_name = 'phyloxml'
 	extension = 'xml'
+	streaming = True
+	
+	def stream(self):
+		'''
+		Yields the PhyloXML phylogeny while walking the phylogeny, without
+		building Biopython clades.  Output follows Biopython's PhyloXML writer.
+		'''
+		return join_chunks(self.get_phyloxml_lines())
+	
+	def get_phyloxml_lines(self):
+		'''Yields the lines of the PhyloXML phylogeny.'''
+		yield u'<phyloxml xmlns="http://www.phyloxml.org" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.phyloxml.org http://www.phyloxml.org/1.10/phyloxml.xsd">\n'
+		yield u'  <phylogeny rooted="true">\n'
+		depth = 2
+		for event, taxon in self.walk(chunk_size=self.chunk_size):
+			if event == 'start':
+				for line in self.get_clade_lines(taxon, u'  ' * depth):
+					yield line
+				depth += 1
+			else:
+				depth -= 1
+				yield u'%s</clade>\n' % (u'  ' * depth)
+		yield u'  </phylogeny>\n'
+		yield u'</phyloxml>'
+	
+	def get_clade_lines(self, taxon, indent):
+		'''
+		Returns the lines of the opening tag and elements of the clade for a
+		taxon (the same data as `get_clade_for_taxon`).  The closing tag is
+		written after the children of the clade.
+		'''
+		inner = indent + u'  '
+		lines = [
+			u'%s<clade>\n' % indent,
+			format_xml_element(inner, 'name', taxon.name),
+			format_xml_element(inner, 'branch_length', taxon.branch_length or 1.0),
+		]
+		
+		for taxonomy_record in taxon.taxonomyrecord_set.all():
+			lines += [
+				u'%s<taxonomy>\n' % inner,
+				format_xml_element(inner + u'  ', 'id', taxonomy_record.record_id, {'provider': u'%s' % taxonomy_record.database}),
+				format_xml_element(inner + u'  ', 'uri', u'%s' % (taxonomy_record.url or taxonomy_record.database.url)),
+				u'%s</taxonomy>\n' % inner,
+			]
+		
+		if taxon.distribution:
+			lines += [
+				u'%s<distribution>\n' % inner,
+				format_xml_element(inner + u'  ', 'desc', taxon.distribution),
+				u'%s</distribution>\n' % inner,
+			]
+		
+		for distribution_point in taxon.distributionpoint_set.all():
+			lines += [
+				u'%s<distribution>\n' % inner,
+				format_xml_element(inner + u'  ', 'desc', distribution_point.place_name),
+				u'%s  <point geodetic_datum="WGS84">\n' % inner,
+				format_xml_element(inner + u'    ', 'lat', distribution_point.latitude),
+				format_xml_element(inner + u'    ', 'long', distribution_point.longitude),
+				u'%s  </point>\n' % inner,
+				u'%s</distribution>\n' % inner,
+			]
+		
+		if taxon.appearance_date():
+			lines.append(u'%s<date unit="%s">\n' % (inner, escape(taxon.appearance_date_unit, {'"': '&quot;'}),))
+			lines.append(format_xml_element(inner + u'  ', 'desc', taxon.appearance_date_annotation))
+			for tag, value in (('minimum', taxon.appearance_date_min_value), ('maximum', taxon.appearance_date_max_value),):
+				if value is not None:
+					lines.append(format_xml_element(inner + u'  ', tag, value))
+			lines.append(u'%s</date>\n' % inner)
+		
+		for citation in taxon.citation_set.all():
+			lines += [
+				u'%s<reference doi="%s">\n' % (inner, escape(citation.doi, {'"': '&quot;', '\n': '&#10;'}),),
+				format_xml_element(inner + u'  ', 'desc', u'%s %s' % (citation.description, citation.url,)),
+				u'%s</reference>\n' % inner,
+			]
+		
+		return lines
 	
 
 class NexusPhyloExporter(AbstractBaseBiopythonPhyloExporter):
@@ -340,6 +613,30 @@ class NewickPhyloExporter(AbstractBaseBiopythonPhyloExporter):
 	verbose_name = _('Export Newick Phylogeny')
 	format_name = 'newick'
 	extension = 'tree'
+	streaming = True
+	
+	def stream(self):
+		'''
+		Yields the Newick phylogeny while walking the phylogeny, without
+		building Biopython clades.  Output follows Biopython's Newick writer.
+		'''
+		return join_chunks(self.get_newick_tokens())
+	
+	def get_newick_tokens(self):
+		'''Yields the tokens of the Newick phylogeny.'''
+		# whether each taxon on the stack has had a child written
+		has_children = []
+		for event, taxon in self.walk(chunk_size=self.chunk_size):
+			if event == 'start':
+				if has_children:
+					yield u',' if has_children[-1] else u'('
+					has_children[-1] = True
+				has_children.append(False)
+			else:
+				if has_children.pop():
+					yield u')'
+				yield u'%s:%1.5f' % (format_newick_label(taxon.name), taxon.branch_length or 1.0,)
+		yield u';\n'
 	
 
 class JSPhyloSVGPhyloXMLPhyloExporter(AbstractBasePhyloExporter):
@@ -347,6 +644,19 @@ class JSPhyloSVGPhyloXMLPhyloExporter(AbstractBasePhyloExporter):
 	verbose_name = _('Export jsPhyloSVG PhyloXML')
 	format_name = 'phyloxml-jsphylosvg'
 	extension = 'xml'
+	select_related = ('category',)
+	# render clades with the recursive clade template rather than in Python
+	use_templates = False
+	
+	def get_queryset(self):
+		'''
+		Returns the taxa in depth-first order.  Without templates, only the
+		fields written to the clades are loaded.
+		'''
+		queryset = super(JSPhyloSVGPhyloXMLPhyloExporter, self).get_queryset()
+		if not self.use_templates:
+			queryset = queryset.only('name', 'tagline', 'branch_length', 'category__slug', 'lft', 'rght', 'tree_id', 'level', 'parent', 'slug')
+		return queryset
 	
 	def __call__(self):
 		'''Returns a jsPhyloSVG PhyloXML string.'''
@@ -354,40 +664,221 @@ class JSPhyloSVGPhyloXMLPhyloExporter(AbstractBasePhyloExporter):
 	
 	def get_object(self):
 		'''Returns a jsPhyloSVG PhyloXML string.'''
-		# open a transaction so that taxa may be pruned during export
-		# and then rolled back
-		with transaction.commit_manually():
-			# if there is a pruning filter, delete all children of matching taxa
-			pruning_filter = self.pruning_filter
-			if pruning_filter:
-				for taxon in Taxon.objects.filter(**pruning_filter):
-					for child in taxon.get_children():
-						child.delete()
-			
-			# get template, context, and render the template
-			template_path = 'phylogeny/exporters/%s/%s.%s'
-			template = get_template(template_path % (self.format_name, 'phylogeny', self.extension,))
-			context = Context({
-				'taxa_categories': TaxaCategory.objects.all,
-				'colors_app_installed': ('colors' in settings.INSTALLED_APPS),
-				'object': self.taxon,
-				'clade_template_path': template_path % (self.format_name, 'clade', self.extension,)
-			})
-			rendered_template = template.render(context)
-			# rollback the transaction
-			# (don't actually allow any taxon deletions to stand)
-			transaction.rollback()
-		
-		return rendered_template
+		template_path = 'phylogeny/exporters/%s/%s.%s'
+		context = {
+			'taxa_categories': TaxaCategory.objects.all,
+			'colors_app_installed': ('colors' in settings.INSTALLED_APPS),
+			'clade_template_path': template_path % (self.format_name, 'clade', self.extension,)
+		}
+		if self.use_templates:
+			context['object'] = self.get_root_taxon()
+		else:
+			context['clades'] = mark_safe(self.render_clades())
+		
+		# get template, context, and render the template
+		template = get_template(template_path % (self.format_name, 'phylogeny', self.extension,))
+		return template.render(Context(context))
+	
+	def get_root_taxon(self):
+		'''
+		Returns the root taxon with the exported children attached to each
+		taxon, so that the clade template neither queries for children nor
+		sees pruned taxa.
+		'''
+		taxa = []
+		for event, taxon in self.walk():
+			if event == 'start':
+				taxon.exported_children = []
+				if taxa:
+					taxa[-1].exported_children.append(taxon)
+				taxa.append(taxon)
+			else:
+				root_taxon = taxa.pop()
+		return root_taxon
+	
+	def render_clades(self):
+		'''
+		Returns the clades of the phylogeny rendered without templates or
+		recursion, in the same markup (including whitespace) as the clade
+		template.
+		'''
+		output = []
+		depth = 0
+		for event, taxon in self.walk():
+			if event == 'start':
+				if depth:
+					output.append(u'\n\t\t')
+				output.append(self.render_clade_start(taxon))
+				depth += 1
+			else:
+				depth -= 1
+				output.append(u'\n</clade>\n')
+				if depth:
+					output.append(u'\n\t')
+		return u''.join(output)
+	
+	def render_clade_start(self, taxon):
+		'''
+		Returns the opening tag and elements of the clade for a taxon, as the
+		clade template renders them.  The children and closing tag follow.
+		'''
+		bg_style = u'default'
+		if taxon.category:
+			bg_style = render_value(force_unicode(taxon.category.slug).replace('-', '_'))
+		if taxon.branch_length is None or taxon.branch_length < 1:
+			branch_length = u'1.0'
+		else:
+			branch_length = render_value(taxon.branch_length)
+		
+		annotation = u''
+		get_absolute_url = getattr(taxon, 'get_absolute_url', None)
+		absolute_url = get_absolute_url() if callable(get_absolute_url) else get_absolute_url
+		if taxon.tagline or absolute_url:
+			annotation = u'\n\t\t<annotation>\n\t\t\t%s\n\t\t\t%s\n\t\t</annotation>\n\t' % (
+				u'\n\t\t\t\t<desc>%s</desc>\n\t\t\t' % render_value(taxon.tagline) if taxon.tagline else u'',
+				u'\n\t\t\t\t<uri>%s</uri>\n\t\t\t' % render_value(absolute_url) if absolute_url else u'',
+			)
+		
+		return u'\n<clade>\n\t<name bgStyle="%s">%s</name>\n\t<branch_length>%s</branch_length>\n\t%s\n\t' % (bg_style, render_value(taxon.name), branch_length, annotation,)
 	
 	def save(self, export_to=None):
 		'''Saves the jsPhyloSVG PhyloXML to file.'''
 		if export_to is not None:
 			self.export_to = export_to
-		output = self()
 		with open(self.export_to, 'w') as open_file:
-			open_file.write(output)
+			self.write(open_file)
+	
+
+class ColumnarPhyloExporter(AbstractBasePhyloExporter):
+	'''
+	Exports a phylogeny to a columnar snapshot file (see columnar.py), a
+	compact binary format for backups which the columnar importer reloads
+	with batched inserts.
+	'''
+	verbose_name = _('Export Columnar Snapshot')
+	format_name = 'columnar'
+	extension = 'phylocol'
+	content_type = 'application/octet-stream'
+	# taxa are fetched as values, so larger chunks are cheap
+	chunk_size = 10000
+	
+	def __call__(self):
+		'''Returns the columnar snapshot file as a byte string.'''
+		return ''.join(self.stream())
+	
+	def get_object(self):
+		'''
+		Returns a ColumnarWriter holding the phylogeny, fetched as values
+		`chunk_size` taxa at a time.
+		'''
+		pruned = set()
+		pruning_filter = self.pruning_filter
+		if pruning_filter:
+			pruned = set(self.get_queryset().filter(**pruning_filter).values_list('pk', flat=True))
+		return dump_phylogeny(self.taxon, pruned, self.chunk_size)
+	
+	def stream(self):
+		'''Yields the columnar snapshot file as byte strings.'''
+		return self.get_object().get_chunks()
+	
+	def save(self, export_to=None):
+		'''Saves the columnar snapshot file.'''
+		if export_to is not None:
+			self.export_to = export_to
+		with open(self.export_to, 'wb') as open_file:
+			self.write(open_file)
+	
+
+class ExportCache(object):
+	'''
+	Caches exported phylogenies with Django's cache framework.
+	
+	Cache keys combine the digest of an exporter's phylogeny (its root taxon,
+	format, extension and pruning filter, and the version of the phylogeny;
+	see `AbstractBasePhyloExporter.get_version`) with a generation (a
+	`SharedVersion`), which is incremented whenever taxa, their citations,
+	taxonomy records or distribution points, taxonomy databases or taxa
+	categories are saved or deleted.  Stale entries are never read again and
+	expire from the cache.  The time of the last such change is kept beside
+	the generation, to date changes (deletions) which leave no row behind.
+	'''
+	generation_key = 'phylogeny:export:generation'
+	modified_key = 'phylogeny:export:modified'
+	
+	def __init__(self, alias=None, timeout=None, max_size=None):
+		self.alias = alias or app_settings.PHYLOGENY_EXPORT_CACHE
+		self.timeout = timeout or app_settings.PHYLOGENY_EXPORT_CACHE_TIMEOUT
+		self.max_size = max_size or app_settings.PHYLOGENY_EXPORT_CACHE_MAX_SIZE
+		self._cache = None
+		self.generation = SharedVersion(self.generation_key, self.alias)
+		self.modified = SharedVersion(self.modified_key, self.alias)
+	
+	@property
+	def cache(self):
+		'''The cache backend, or None if the export cache is disabled.'''
+		if self._cache is None and self.alias:
+			self._cache = get_cache(self.alias)
+		return self._cache
+	
+	def get_generation(self):
+		'''Returns the current generation of cached exports (None if the export cache is disabled).'''
+		return self.generation.get()
+	
+	def get_last_modified(self):
+		'''
+		Returns the time (a timestamp in seconds) of the last change to data
+		written to exports, or None if the export cache is disabled.  If the
+		time was evicted it starts again from the current time.
+		'''
+		modified = self.modified.get()
+		if modified is None:
+			return None
+		return modified // 1000000
+	
+	def invalidate(self):
+		'''Invalidates all cached exports by starting a new generation.'''
+		self.generation.increment()
+		self.modified.reset()
 	
+	def get_digest(self, exporter, version=None):
+		'''
+		Returns a digest identifying an exporter's phylogeny as currently
+		exported, from the root taxon, format, extension, pruning filter and
+		version of the phylogeny.  It is the same in every process.  Pass
+		`version` if it has already been fetched.
+		'''
+		key = u'|'.join([
+			exporter.taxon.slug,
+			exporter.format_name,
+			exporter.extension,
+			u'%s' % sorted((exporter.pruning_filter or {}).items()),
+			version or exporter.get_version(),
+		])
+		return md5(key.encode('utf-8')).hexdigest()
+	
+	def get_key(self, exporter, version=None):
+		'''Returns the cache key of an exporter's phylogeny in the current generation.'''
+		return 'phylogeny:export:%s:%s' % (self.get_digest(exporter, version=version), self.get_generation(),)
+	
+	def export(self, exporter, version=None):
+		'''
+		Returns the exported phylogeny from the cache, or exports and caches
+		it if it is not cached.  Exports larger than `max_size` are not cached.
+		'''
+		if self.cache is None:
+			return exporter()
+		key = self.get_key(exporter, version=version)
+		content = self.cache.get(key)
+		if content is None:
+			content = exporter()
+			if len(content) <= self.max_size:
+				self.cache.set(key, content, self.timeout)
+		return content
+	
+
+# caches exported phylogenies for views
+export_cache = ExportCache()
+
 
 # registry is used to register exporter classes and report on them
 # throughout the app
@@ -397,3 +888,4 @@ exporter_registry.register(PhyloXMLPhyloExporter)
 exporter_registry.register(NexusPhyloExporter)
 exporter_registry.register(NewickPhyloExporter)
 exporter_registry.register(JSPhyloSVGPhyloXMLPhyloExporter)
+exporter_registry.register(ColumnarPhyloExporter)
@@ -8,6 +8,6 @@ from phylogeny import app_settings
 
 
 class PhylogenyImportForm(forms.Form):
-	file_field = forms.FileField(label=_('phylogeny file'))
-	file_format = forms.ChoiceField(label=_('format'), choices=app_settings.PHYLOGENY_IMPORT_FILE_FORMAT_CHOICES)
+	file_field = forms.FileField(label=_('phylogeny file'), help_text=_('may be compressed with gzip or bzip2'))
+	file_format = forms.ChoiceField(label=_('format'), choices=app_settings.PHYLOGENY_IMPORT_FILE_FORMAT_CHOICES, help_text=_('used if the format cannot be detected from the file'))
 	
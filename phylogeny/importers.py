@@ -10,16 +10,29 @@ accessible throughout the app:
 '''
 from abc import ABCMeta, abstractmethod
 from inspect import isclass
+from time import time
 
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Max
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 
 from Bio import Phylo
+from Bio.File import as_handle
 
-from phylogeny.exceptions import PhyloImporterMissingAttribute, PhylogenyImportMergeConflict, PhyloImporterRegistryOnlyClassesMayRegister, PhyloImporterRegistryClassAlreadyRegistered, PhyloImporterRegistryImporterNotFound
-from phylogeny.utils import slugify_unique
+from phylogeny.columnar import MAGIC, ColumnarLoader, ColumnarReader
+from phylogeny.parsers import StreamingPhyloXMLParser, tokenize_newick, get_newick_clade_events
+from phylogeny.exceptions import PhyloImporterMissingAttribute, PhylogenyImportMergeConflict, PhylogenyImportNameConflict, PhyloImporterRegistryOnlyClassesMayRegister, PhyloImporterRegistryClassAlreadyRegistered, PhyloImporterRegistryImporterNotFound
+from phylogeny.utils import SlugAllocator, bulk_create, open_decompressed
+
+
+def merge_conflict(taxon_name):
+	'''
+	Returns a PhylogenyImportMergeConflict exception for a clade whose name
+	already exists.
+	'''
+	return PhylogenyImportMergeConflict(ugettext('Merge conflict occurred:  name "%(taxon_name)s" already exists.  Import aborted.  This may be caused by two clades having the same name in the phylogeny file or by a clade having the same name as an existing taxon.  Please change the name of the existing taxon or change the name of the taxon in the import file.') % {'taxon_name': taxon_name})
 
 
 class ImporterRegistry(object):
@@ -61,6 +74,186 @@ class ImporterRegistry(object):
 				return importer_class()
 		raise PhyloImporterRegistryImporterNotFound(ugettext('Importer with format name %s not found.') % format_name)
 	
+	def sniff_format_name(self, fileobj, size=1024):
+		'''
+		Returns the format name of the first importer recognizing the first
+		`size` bytes of a (possibly compressed) phylogeny file, or None.  The
+		file must be seekable; it is rewound.
+		'''
+		header = open_decompressed(fileobj).read(size)
+		fileobj.seek(0)
+		# skip a UTF-8 byte order mark and leading whitespace
+		header = header.lstrip('\xef\xbb\xbf \t\r\n')
+		for importer_class in self._registry:
+			if importer_class.sniff(header):
+				return importer_class.format_name
+		return None
+	
+
+class BulkTaxonWriter(object):
+	'''
+	Writes a new tree of taxa to the database with batched inserts.
+	
+	Nodes are dictionaries of taxon data carrying precomputed MPTT `lft`,
+	`rght` and `level` values along with the `lft` of their parent (`None` for
+	the root).  They must be written in post-order, children before their
+	parent.  Taxa are inserted without a parent; parent links are filled in
+	with one UPDATE per batch once the parent itself has been inserted, so the
+	tree is never rewritten by MPTT.
+	
+	Always write within a transaction so that a merge conflict rolls back the
+	whole tree.
+	'''
+	# number of parent links set per UPDATE statement
+	update_batch_size = 250
+	
+	def __init__(self, tree_id=None, batch_size=500, slug_allocator=None, progress=None):
+		'''
+		Initializes a writer for a new tree.  `progress` is called with the
+		number of taxa written after every batch.
+		'''
+		from phylogeny.models import Taxon
+		if tree_id is None:
+			tree_id = (Taxon.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+		if slug_allocator is None:
+			slug_allocator = SlugAllocator(Taxon)
+		self.tree_id = tree_id
+		self.batch_size = batch_size
+		self.slug_allocator = slug_allocator
+		self.progress = progress
+		self.count = 0
+		self._nodes = []
+		# lft values of inserted children, by the lft of their parent
+		self._orphans = {}
+		self._taxonomy_databases = {}
+	
+	def get_slug(self, name):
+		'''
+		Returns the slug for a taxon name.  Unnamed clades ("none") receive a
+		unique slug.
+		'''
+		if name == 'none':
+			return self.slug_allocator.allocate(name)
+		slug = slugify(name)
+		self.slug_allocator.reserve(slug)
+		return slug
+	
+	def write(self, node):
+		'''Queues a node for insertion, flushing full batches.'''
+		node['slug'] = self.get_slug(node['name'])
+		self._nodes.append(node)
+		if len(self._nodes) >= self.batch_size:
+			self.flush()
+	
+	def check_conflicts(self, nodes):
+		'''
+		Raises PhylogenyImportMergeConflict if a node slug is repeated within
+		the batch or already exists in the database.  Slugs of earlier batches
+		are already in the database.
+		'''
+		from phylogeny.models import Taxon
+		slugs = set()
+		for node in nodes:
+			if node['slug'] in slugs:
+				raise merge_conflict(node['name'])
+			slugs.add(node['slug'])
+		existing = Taxon.objects.filter(slug__in=slugs).values_list('name', flat=True)[:1]
+		if existing:
+			raise merge_conflict(existing[0])
+	
+	def flush(self):
+		'''Inserts queued nodes, their related records and parent links.'''
+		from phylogeny.models import Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint
+		nodes, self._nodes = self._nodes, []
+		if not nodes:
+			return
+		self.check_conflicts(nodes)
+		
+		bulk_create(Taxon, [Taxon(
+			name=node['name'],
+			slug=node['slug'],
+			branch_length=node['branch_length'],
+			distribution=node['distribution'],
+			lft=node['lft'],
+			rght=node['rght'],
+			level=node['level'],
+			tree_id=self.tree_id,
+			descendant_count=(node['rght'] - node['lft'] - 1) / 2,
+			leaf_count=node['leaf_count']
+		) for node in nodes])
+		self.count += len(nodes)
+		pks = dict(Taxon.objects.filter(tree_id=self.tree_id, lft__in=[node['lft'] for node in nodes]).values_list('lft', 'pk'))
+		
+		# import taxonomies, distributions, and references
+		taxonomy_records = set()
+		distribution_points = set()
+		citations = []
+		for node in nodes:
+			taxon_id = pks[node['lft']]
+			for provider, record_id in node['taxonomies']:
+				if provider not in self._taxonomy_databases:
+					self._taxonomy_databases[provider], c = TaxonomyDatabase.objects.get_or_create(name=provider, slug=slugify(provider))
+				taxonomy_records.add((taxon_id, self._taxonomy_databases[provider].pk, record_id,))
+			for place_name, latitude, longitude in node['points']:
+				distribution_points.add((taxon_id, place_name, latitude, longitude,))
+			for description, doi in node['references']:
+				citations.append(Citation(taxon_id=taxon_id, description=description, doi=doi))
+		bulk_create(TaxonomyRecord, [TaxonomyRecord(taxon_id=taxon_id, database_id=database_id, record_id=record_id) for taxon_id, database_id, record_id in taxonomy_records])
+		bulk_create(DistributionPoint, [DistributionPoint(taxon_id=taxon_id, place_name=place_name, latitude=latitude, longitude=longitude) for taxon_id, place_name, latitude, longitude in distribution_points])
+		bulk_create(Citation, citations)
+		
+		# link children to parents inserted in this batch
+		for node in nodes:
+			if node['parent_lft'] is not None:
+				self._orphans.setdefault(node['parent_lft'], []).append(node['lft'])
+		links = []
+		for node in nodes:
+			for child_lft in self._orphans.pop(node['lft'], ()):
+				links.append((child_lft, pks[node['lft']],))
+		self.set_parents(links)
+		if self.progress is not None:
+			self.progress(self.count)
+	
+	def set_parents(self, links):
+		'''
+		Sets parents from a list of (child lft, parent pk) pairs with one
+		UPDATE ... CASE statement per batch.
+		'''
+		from phylogeny.models import Taxon
+		qn = connection.ops.quote_name
+		opts = Taxon._meta
+		cursor = connection.cursor()
+		for start in range(0, len(links), self.update_batch_size):
+			batch = links[start:start + self.update_batch_size]
+			sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s = %%s AND %s IN (%s)' % (
+				qn(opts.db_table),
+				qn(opts.get_field('parent').column),
+				qn('lft'),
+				' '.join(['WHEN %s THEN %s'] * len(batch)),
+				qn('tree_id'),
+				qn('lft'),
+				', '.join(['%s'] * len(batch)),
+			)
+			params = [value for link in batch for value in link] + [self.tree_id] + [child_lft for child_lft, parent_pk in batch]
+			cursor.execute(sql, params)
+		if links:
+			transaction.commit_unless_managed()
+	
+	def close(self):
+		'''
+		Flushes remaining nodes, sets the lineage paths of the tree (parents
+		are inserted after their children) and returns the root taxon.
+		'''
+		from phylogeny.models import Taxon
+		from phylogeny.search import search_index_cache
+		from phylogeny.snapshots import snapshot_cache
+		self.flush()
+		Taxon.objects.rebuild_paths(tree_id=self.tree_id)
+		# taxa are inserted without signals
+		snapshot_cache.invalidate()
+		search_index_cache.invalidate()
+		return Taxon.objects.get(tree_id=self.tree_id, lft=1)
+
 
 class AbstractBasePhyloImporter(object):
 	'''
@@ -73,6 +266,9 @@ class AbstractBasePhyloImporter(object):
 	# name of phylogeny format
 	format_name = None
 	format_verbose_name = _('Phylogeny')
+	# whether phylogeny files are parsed while the phylogeny is saved
+	# instead of when `import_from` is set
+	stream = False
 	
 	def __init__(self, phylogeny=None, import_from=None, *args, **kwargs):
 		'''Initializes an instance of the phylogeny importer.'''
@@ -132,7 +328,17 @@ class AbstractBasePhyloImporter(object):
 		'''Sets the value of the `import_from` property.'''
 		if import_from is not None:
 			self._import_from = import_from
-			self.phylogeny = Phylo.read(self.import_from, self.format_name)
+			if not self.stream:
+				self.phylogeny = Phylo.read(self.import_from, self.format_name)
+	
+	@classmethod
+	def sniff(cls, header):
+		'''
+		Returns True if the beginning of a file (leading whitespace removed)
+		is in the importer's format.  Importers not recognizing their format
+		return False.
+		'''
+		return False
 	
 	@abstractmethod
 	def get_object(self):
@@ -150,20 +356,175 @@ class AbstractBaseBiopythonPhyloImporter(AbstractBasePhyloImporter):
 	__metaclass__ = ABCMeta
 	verbose_name = _('Import Biopython Phylogeny')
 	format_verbose_name = _('Biopython Phylogeny')
+	# number of taxa per batched insert when importing in bulk
+	bulk_batch_size = 500
+	# number of slugs per query when scanning for name conflicts
+	scan_batch_size = 900
+	# whether the importer can parse files clade by clade (with a
+	# `stream_clade_events` method; see `stream_nodes`)
+	streaming = False
+	# called with the number of taxa written after every batch of a bulk import
+	progress = None
+	
+	def __init__(self, phylogeny=None, import_from=None, bulk=False, stream=False, *args, **kwargs):
+		'''
+		Initializes an instance of the phylogeny importer.  When `bulk` is
+		true, the phylogeny is written with batched inserts instead of
+		clade-by-clade.  When `stream` is true and the importer supports
+		streaming, the file is parsed while it is written with batched
+		inserts, without holding the whole phylogeny in memory.
+		'''
+		self.stream = stream and self.streaming
+		super(AbstractBaseBiopythonPhyloImporter, self).__init__(phylogeny, import_from, *args, **kwargs)
+		self.bulk = bulk
+		self.slug_allocator = None
+	
+	def get_taxon_name_for_clade(self, clade):
+		'''
+		Returns the taxon name for a clade.  Unnamed clades are named "none".
+		'''
+		# base name
+		taxon_name = clade.name or 'none'
+		# sometimes the name can be in a taxonomy, but not the clade itself
+		if hasattr(clade, 'taxonomies') and len(clade.taxonomies) > 0 and hasattr(clade.taxonomies[0], 'scientific_name'):
+			taxon_name = clade.taxonomies[0].scientific_name or taxon_name
+		return taxon_name
+	
+	def get_clades(self):
+		'''Yields every clade of the phylogeny in pre-order, without recursion.'''
+		stack = [self.phylogeny.root]
+		while stack:
+			clade = stack.pop()
+			yield clade
+			stack.extend(reversed(clade.clades))
+	
+	def scan_clade_names(self):
+		'''
+		Returns the slugs of the names of all clades, without using the
+		database.  Raises PhylogenyImportNameConflict if two or more clades
+		have the same name (slug) within the phylogeny.  Unnamed clades never
+		conflict.
+		'''
+		names = {}
+		for clade in self.get_clades():
+			taxon_name = self.get_taxon_name_for_clade(clade)
+			if taxon_name == 'none':
+				continue
+			slug = slugify(taxon_name)
+			if slug in names:
+				raise PhylogenyImportNameConflict(ugettext('Name conflict occurred:  two or more clades are named "%(taxon_name)s".  Import aborted.  Please change the names of these clades in the import file.') % {'taxon_name': taxon_name})
+			names[slug] = taxon_name
+		return list(names)
+	
+	def scan_names(self):
+		'''
+		Scans the names of all clades for conflicts before anything is written
+		to the database.  Raises PhylogenyImportNameConflict if two or more
+		clades have the same name (slug) within the phylogeny, and
+		PhylogenyImportMergeConflict if a clade has the same name as an
+		existing taxon.  Unnamed clades never conflict.
+		'''
+		from phylogeny.models import Taxon
+		
+		slugs = self.scan_clade_names()
+		for start in range(0, len(slugs), self.scan_batch_size):
+			existing = Taxon.objects.filter(slug__in=slugs[start:start + self.scan_batch_size]).values_list('name', flat=True)[:1]
+			if existing:
+				raise merge_conflict(existing[0])
+	
+	def get_node_for_clade(self, clade):
+		'''
+		Returns a dictionary of the taxon data held by a single clade (its
+		children are ignored), as written by BulkTaxonWriter.
+		'''
+		node = {
+			'name': self.get_taxon_name_for_clade(clade),
+			'branch_length': getattr(clade, 'branch_length', None) or 1.0,
+			'distribution': u'',
+			'taxonomies': [],
+			'points': [],
+			'references': [],
+		}
+		for taxonomy in getattr(clade, 'taxonomies', ()):
+			if taxonomy.id and taxonomy.id.value and taxonomy.id.provider:
+				node['taxonomies'].append((taxonomy.id.provider, taxonomy.id.value,))
+		for distribution in getattr(clade, 'distributions', ()):
+			if distribution.desc and not distribution.points:
+				node['distribution'] = (u'%s %s' % (distribution.desc, node['distribution'])).strip()
+			for point in distribution.points:
+				node['points'].append((distribution.desc or '', point.lat, point.long,))
+		for reference in getattr(clade, 'references', ()):
+			node['references'].append((reference.desc or '', reference.doi or '',))
+		return node
+	
+	def get_clade_events(self):
+		'''
+		Walks the phylogeny without recursion and yields ('start', None) as
+		each clade is entered and ('end', clade) once its subtree is complete,
+		like the streaming parsers (see parsers.py).
+		'''
+		stack = [iter([self.phylogeny.root])]
+		clades = []
+		while stack:
+			for clade in stack[-1]:
+				yield 'start', None
+				clades.append(clade)
+				stack.append(iter(clade.clades))
+				break
+			else:
+				stack.pop()
+				if clades:
+					yield 'end', clades.pop()
+	
+	def get_nodes(self, events=None):
+		'''
+		Yields a node dictionary for every clade as soon as its subtree is
+		complete (post-order), from clade events (by default those of the
+		phylogeny).  MPTT `lft`, `rght` and `level` values and leaf counts are
+		assigned in memory along the way.  Child clades keep the order of the
+		file.
+		'''
+		if events is None:
+			events = self.get_clade_events()
+		stack = []
+		counter = 1
+		for event, clade in events:
+			if event == 'start':
+				stack.append({'lft': counter, 'level': len(stack), 'parent_lft': stack[-1]['lft'] if stack else None, 'leaf_count': 0})
+				counter += 1
+				continue
+			node = stack.pop()
+			node.update(self.get_node_for_clade(clade))
+			node['rght'] = counter
+			node['leaf_count'] = node['leaf_count'] or 1
+			if stack:
+				stack[-1]['leaf_count'] += node['leaf_count']
+			counter += 1
+			yield node
+	
+	def stream_nodes(self):
+		'''
+		Yields the node dictionaries of the file to import as its clades are
+		parsed.  Memory is bounded by the depth of the tree.  Only for
+		streaming importers, which parse a phylogeny file (a path or an open
+		file) with `stream_clade_events`, yielding clade events as they are
+		read.
+		'''
+		return self.get_nodes(self.stream_clade_events(self.import_from))
 	
 	def get_taxon_for_clade(self, clade, parent_taxon=None):
 		'''
 		Imports data from a phylogeny and saves taxa to the database.
-
+		
 		Merge conflicts can arise when an imported clade's name matches an existing
 		taxon's name.  In the case of conflicts, a merge strategy is used.  The
 		default merge strategy is to abort import.
 		
 		Always use an importer's `save` method to ensure database changes are
 		run in transaction and rolled back in the event of a conflict.
-
+		
 		Available merge strategies are:
-
+			
 			None:  the default merge strategy is to abort import.
 		'''
 		from phylogeny.models import Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint
@@ -171,21 +532,26 @@ class AbstractBaseBiopythonPhyloImporter(AbstractBasePhyloImporter):
 		# merge strategy None is the only supported strategy at this time
 		merge_strategy = None
 		
-		# base name
-		taxon_name = clade.name or 'none'
-		# sometimes the name can be in a taxonomy, but not the clade itself
-		if hasattr(clade, 'taxonomies') and len(clade.taxonomies) > 0 and hasattr(clade.taxonomies[0], 'scientific_name'):
-			taxon_name = clade.taxonomies[0].scientific_name or taxon_name
-
+		taxon_name = self.get_taxon_name_for_clade(clade)
+		
+		# lookup slug; unnamed clades get a unique slug
+		if self.slug_allocator is None:
+			self.slug_allocator = SlugAllocator(Taxon)
+		if taxon_name == 'none':
+			lookup_slug = self.slug_allocator.allocate(taxon_name)
+		else:
+			lookup_slug = slugify(taxon_name)
+			self.slug_allocator.reserve(lookup_slug)
+		
 		defaults = {
 			'name': taxon_name,
-			'slug': slugify_unique(taxon_name, Taxon),
+			'slug': lookup_slug,
 			'branch_length': 1.0
 		}
-
+		
 		if hasattr(clade, 'branch_length'):
 			defaults['branch_length'] = clade.branch_length or defaults['branch_length']
-
+		
 		# add clade date to taxon defaults if available
 		# NOTE:  date output is disabled since Biopython can't read its own output
 		# that contains dates
@@ -198,19 +564,15 @@ class AbstractBaseBiopythonPhyloImporter(AbstractBasePhyloImporter):
 		#		defaults['appearance_date_min_value'] = clade.date.minimum
 		#	if hasattr(clade.date, 'maximum'):
 		#		defaults['appearance_date_max_value'] = clade.date.maximum
-
+		
 		# get or create a taxon matching taxon_name
-		lookup_slug = slugify(taxon_name)
-		if taxon_name == 'none':
-			lookup_slug = slugify_unique(taxon_name, Taxon)
-
 		taxon, created = Taxon.objects.get_or_create(slug=lookup_slug, defaults=defaults)
-
+		
 		# None merge strategy
 		if merge_strategy is None and not created:
 			# merge strategy is None or other:
-			raise PhylogenyImportMergeConflict(ugettext('Merge conflict occurred:  name "%(taxon_name)s" already exists.  Import aborted.  This may be caused by two clades having the same name in the phylogeny file or by a clade having the same name as an existing taxon.  Please change the name of the existing taxon or change the name of the taxon in the import file.') % {'taxon_name': taxon.name})
-
+			raise merge_conflict(taxon.name)
+		
 		if created:
 			taxon.save()
 			# import taxonomies, distributions, and references
@@ -229,31 +591,80 @@ class AbstractBaseBiopythonPhyloImporter(AbstractBasePhyloImporter):
 			if hasattr(clade, 'references'):
 				for reference in clade.references:
 					citation = Citation.objects.create(taxon=taxon, description=reference.desc or '', doi=reference.doi or '')
-
+		
 		# move taxon to parent (or root if no parent)
 		taxon.move_to(parent_taxon)
-
+		
 		for child_clade in clade.clades:
 			self.get_taxon_for_clade(child_clade, parent_taxon=taxon)
-
+		
 		return taxon
 	
+	def get_object_in_bulk(self):
+		'''
+		Returns a Taxon model instance for the imported phylogeny, written as a
+		new tree with batched inserts.
+		'''
+		return self.write_nodes(self.get_nodes())
+	
+	def write_nodes(self, nodes):
+		'''
+		Writes node dictionaries (see `get_nodes`) as a new tree with batched
+		inserts and returns the root taxon.
+		'''
+		writer = BulkTaxonWriter(batch_size=self.bulk_batch_size, slug_allocator=self.slug_allocator, progress=self.progress)
+		for node in nodes:
+			writer.write(node)
+		return writer.close()
+	
+	def read_nodes(self):
+		'''
+		Returns the node dictionaries of the phylogeny after scanning its
+		clade names for conflicts, without using the database (so that files
+		may be read in other processes).
+		'''
+		self.scan_clade_names()
+		return list(self.get_nodes())
+	
+	def save_nodes(self, nodes):
+		'''
+		Saves node dictionaries read by `read_nodes` to the database in a
+		transaction and returns the root taxon.  If a merge conflict occurs,
+		the transaction is rolled back.
+		'''
+		with transaction.commit_on_success():
+			return self.write_nodes(nodes)
+	
 	def get_object(self):
 		'''Returns a Taxon model instance for the imported phylogeny.'''
+		from phylogeny.models import Taxon
+		
+		# slugs are allocated by a single allocator for the whole import
+		self.slug_allocator = SlugAllocator(Taxon)
+		if self.stream:
+			return self.write_nodes(self.stream_nodes())
+		if self.bulk:
+			return self.get_object_in_bulk()
 		taxon = self.get_taxon_for_clade(self.phylogeny.root)
 		return taxon
 	
 	def save(self, import_from=None):
 		'''
-		Saves the phylogeny to the database in a transaction.  If a merge
-		conflict occurs, the transaction is rolled back.
+		Saves the phylogeny to the database in a transaction and returns the
+		root taxon.  Name conflicts are scanned for before the transaction
+		opens.  If a merge conflict occurs nonetheless, the transaction is
+		rolled back.  Streamed files are not scanned ahead:  conflicts raise
+		PhylogenyImportMergeConflict as the taxa are written.
 		'''
 		if import_from is not None:
 			self.import_from = import_from
 		
+		if not self.stream:
+			self.scan_names()
 		with transaction.commit_on_success():
 			# start transaction
 			taxon = self.get_object()
+		return taxon
 	
 
 class PhyloXMLPhyloImporter(AbstractBaseBiopythonPhyloImporter):
@@ -261,6 +672,16 @@ class PhyloXMLPhyloImporter(AbstractBaseBiopythonPhyloImporter):
 	verbose_name = _('Import PhyloXML Phylogeny')
 	format_name = 'phyloxml'
 	format_verbose_name = _('PhyloXML')
+	streaming = True
+	
+	@classmethod
+	def sniff(cls, header):
+		'''PhyloXML files are the only XML files imported.'''
+		return header.startswith('<')
+	
+	def stream_clade_events(self, import_from):
+		'''Parses a PhyloXML file with `iterparse`.'''
+		return StreamingPhyloXMLParser(import_from).get_clade_events()
 
 
 class NexusPhyloImporter(AbstractBaseBiopythonPhyloImporter):
@@ -268,6 +689,10 @@ class NexusPhyloImporter(AbstractBaseBiopythonPhyloImporter):
 	verbose_name = _('Import Nexus Phylogeny')
 	format_name = 'nexus'
 	format_verbose_name = _('Nexus')
+	
+	@classmethod
+	def sniff(cls, header):
+		return header[:6].upper() == '#NEXUS'
 
 
 class NewickPhyloImporter(AbstractBaseBiopythonPhyloImporter):
@@ -275,6 +700,61 @@ class NewickPhyloImporter(AbstractBaseBiopythonPhyloImporter):
 	verbose_name = _('Import Newick Phylogeny')
 	format_name = 'newick'
 	format_verbose_name = _('Newick')
+	streaming = True
+	
+	@classmethod
+	def sniff(cls, header):
+		'''Newick trees open with a parenthesis (a leading comment is allowed).'''
+		if header.startswith('['):
+			header = header[header.find(']') + 1:].lstrip()
+		return header.startswith('(')
+	
+	def stream_clade_events(self, import_from):
+		'''Parses a Newick file with an incremental tokenizer.'''
+		with as_handle(import_from, 'r') as handle:
+			for event in get_newick_clade_events(tokenize_newick(handle)):
+				yield event
+
+
+class ColumnarPhyloImporter(AbstractBasePhyloImporter):
+	'''
+	Imports a phylogeny from a columnar snapshot file (see columnar.py), as
+	written by ColumnarPhyloExporter, with batched inserts.  Files are mapped
+	into memory when saved rather than parsed into a Biopython phylogeny.
+	'''
+	verbose_name = _('Import Columnar Snapshot Phylogeny')
+	format_name = 'columnar'
+	format_verbose_name = _('Columnar snapshot')
+	# files are read while the phylogeny is saved
+	streaming = True
+	stream = True
+	# number of taxa per batched insert
+	bulk_batch_size = 500
+	# called with the number of taxa written after every batch
+	progress = None
+	
+	@classmethod
+	def sniff(cls, header):
+		return header.startswith(MAGIC)
+	
+	def get_object(self):
+		'''Writes the phylogeny to the database and returns its root taxon.'''
+		reader = ColumnarReader(self.import_from)
+		try:
+			return ColumnarLoader(reader, batch_size=self.bulk_batch_size, progress=self.progress).load()
+		finally:
+			reader.close()
+	
+	def save(self, import_from=None):
+		'''
+		Saves the phylogeny to the database in a transaction and returns the
+		root taxon.  If a merge conflict occurs, the transaction is rolled
+		back.
+		'''
+		if import_from is not None:
+			self.import_from = import_from
+		with transaction.commit_on_success():
+			return self.get_object()
 
 
 # registry is used to register importer classes and report on them
@@ -284,3 +764,22 @@ importer_registry = ImporterRegistry()
 importer_registry.register(PhyloXMLPhyloImporter)
 importer_registry.register(NexusPhyloImporter)
 importer_registry.register(NewickPhyloImporter)
+importer_registry.register(ColumnarPhyloImporter)
+
+
+def read_phylogeny_nodes(arguments):
+	'''
+	Reads a phylogeny file into node dictionaries with the importer for a
+	format.  Meant to run in worker processes:  the database is not used and
+	errors are returned rather than raised.  Takes a (path, format name) pair
+	and returns a (path, nodes, error message, seconds) tuple.
+	'''
+	path, format_name = arguments
+	start = time()
+	try:
+		importer = importer_registry.get_by_format_name(format_name)
+		importer.import_from = path
+		nodes = importer.read_nodes()
+	except Exception as exception:
+		return path, None, u'%s: %s' % (exception.__class__.__name__, exception,), time() - start
+	return path, nodes, None, time() - start
@@ -0,0 +1,164 @@
+'''
+Import jobs import uploaded phylogeny files in the background, so that large
+uploads neither hold a request nor time out while they are written.
+
+The admin import view saves the upload to storage as a queued ImportJob and
+submits it to `import_job_runner`, which runs submitted jobs one at a time in
+a background thread.  Running jobs report the number of clades written so far
+through the cache set with `PHYLOGENY_IMPORT_JOB_CACHE` (so that any process
+can report on them); the outcome is saved on the job.  Jobs left queued, for
+instance by a restart, are run by the run-phylogeny-import-jobs command.
+'''
+import logging
+from Queue import Queue
+from threading import Lock, Thread
+
+from django.core.cache import get_cache
+from django.db import connection
+from django.utils import timezone
+from django.utils.translation import ugettext
+
+from phylogeny import app_settings
+from phylogeny.models import ImportJob
+from phylogeny.exceptions import PhylogenyImportMergeConflict, PhylogenyImportNameConflict
+from phylogeny.importers import importer_registry
+from phylogeny.utils import open_decompressed
+
+
+logger = logging.getLogger('phylogeny')
+
+
+class ImportJobRunner(object):
+	'''
+	Creates, runs and reports on import jobs.
+	'''
+	progress_key = 'phylogeny:import-job:%d:progress'
+	# seconds the progress of a running job is kept in the cache
+	progress_timeout = 60 * 60 * 24
+	
+	def __init__(self, alias=None):
+		self.alias = alias or app_settings.PHYLOGENY_IMPORT_JOB_CACHE
+		self._cache = None
+		self._queue = Queue()
+		self._lock = Lock()
+		self._thread = None
+	
+	@property
+	def cache(self):
+		'''The cache backend holding the progress of running jobs.'''
+		if self._cache is None:
+			self._cache = get_cache(self.alias)
+		return self._cache
+	
+	def create(self, upload, file_format):
+		'''
+		Saves an uploaded file to storage and returns a queued job importing
+		it.  The format is detected from the file's first bytes, falling back
+		on `file_format`.  Commit before submitting the job, so that the
+		background thread sees it.
+		'''
+		job = ImportJob(file_format=importer_registry.sniff_format_name(upload) or file_format)
+		job.file.save(upload.name, upload)
+		return job
+	
+	def submit(self, job):
+		'''Schedules a queued job to run in the background thread.'''
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = Thread(target=self.work, name='phylogeny-import-jobs')
+				self._thread.daemon = True
+				self._thread.start()
+		self._queue.put(job.pk)
+	
+	def work(self):
+		'''Runs submitted jobs one at a time.'''
+		while True:
+			pk = self._queue.get()
+			try:
+				self.run(pk)
+			except Exception:
+				logger.exception('Failed to run phylogeny import job %s.' % pk)
+			finally:
+				# the thread has its own database connection
+				connection.close()
+	
+	def claim(self, pk):
+		'''
+		Marks a queued job as running and returns it.  Returns None if the
+		job is no longer queued (another worker claimed it).
+		'''
+		if not ImportJob.objects.filter(pk=pk, status='queued').update(status='running', date_started=timezone.now()):
+			return None
+		return ImportJob.objects.get(pk=pk)
+	
+	def run(self, pk):
+		'''
+		Imports the file of a queued job with batched inserts (streamed if
+		the importer supports it) and saves the outcome.  Merge and name
+		conflicts are reported with their messages, other errors with a
+		general message.  Compressed files are decompressed as they are
+		read.  The uploaded file is deleted once the job has
+		finished.  Returns the job, or None if it was not queued.
+		'''
+		job = self.claim(pk)
+		if job is None:
+			return None
+		importer = importer_registry.get_by_format_name(job.file_format)
+		importer.bulk = True
+		importer.stream = importer.streaming
+		importer.progress = lambda count: self.cache.set(self.progress_key % job.pk, count, self.progress_timeout)
+		try:
+			job.file.open('rb')
+			try:
+				job.taxon = importer.save(import_from=open_decompressed(job.file))
+			finally:
+				job.file.close()
+		except (PhylogenyImportMergeConflict, PhylogenyImportNameConflict,) as exception:
+			job.status = 'failed'
+			job.message = u'%s' % exception
+		except Exception:
+			logger.exception('Failed to import phylogeny file %s.' % job.file.name)
+			job.status = 'failed'
+			job.message = ugettext('An error occurred during import.  Please verify the file format and file contents.  If the error persists, try importing a different file or format.')
+		else:
+			job.status = 'succeeded'
+			job.message = ugettext('Successfully imported phylogeny rooted on taxon "%s".') % job.taxon
+			job.clade_count = job.taxon.descendant_count + 1
+		if job.status == 'failed':
+			job.clade_count = self.cache.get(self.progress_key % job.pk, 0)
+		job.date_finished = timezone.now()
+		job.file.delete(save=False)
+		job.save()
+		self.cache.delete(self.progress_key % job.pk)
+		return job
+	
+	def run_queued(self):
+		'''Runs every queued job in this thread, oldest first, and returns them.'''
+		jobs = []
+		for pk in ImportJob.objects.filter(status='queued').order_by('pk').values_list('pk', flat=True):
+			job = self.run(pk)
+			if job is not None:
+				jobs.append(job)
+		return jobs
+	
+	def get_status(self, job):
+		'''
+		Returns a dictionary reporting on a job:  its status, the number of
+		clades processed, the elapsed time (in seconds) and its outcome.
+		'''
+		clade_count = job.clade_count
+		if job.status == 'running':
+			clade_count = self.cache.get(self.progress_key % job.pk, clade_count)
+		return {
+			'status': job.status,
+			'status_display': u'%s' % job.get_status_display(),
+			'finished': job.is_finished(),
+			'clade_count': clade_count,
+			'elapsed_time': job.get_elapsed_time(),
+			'message': job.message,
+			'taxon': job.taxon_id and job.taxon.slug,
+		}
+
+
+# runs import jobs in a background thread of this process
+import_job_runner = ImportJobRunner()
@@ -0,0 +1,70 @@
+'''
+Benchmarks the tree queries of TaxonManager against their per-instance MPTT
+equivalents on the taxa in the database (especially as from the command line).
+'''
+from optparse import make_option
+from random import sample
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from phylogeny.models import Taxon
+
+
+class Command(BaseCommand):
+	help = _('Times bulk tree queries (ancestors, leaves, descendant counts and lowest common ancestors) against per-instance MPTT methods on a random sample of taxa')
+	option_list = BaseCommand.option_list + (
+		make_option('--sample', '-s', dest='sample', type='int', default=100, help=_('Number of taxa to sample (default is 100)')),
+	)
+	
+	def handle(self, *args, **options):
+		pks = list(Taxon.objects.values_list('pk', flat=True))
+		if not pks:
+			raise CommandError(_('There are no taxa to benchmark.'))
+		taxa = list(Taxon.objects.filter(pk__in=sample(pks, min(options['sample'], len(pks)))))
+		
+		self.compare(_('ancestors'),
+			lambda: set(ancestor.pk for taxon in taxa for ancestor in taxon.get_ancestors()),
+			lambda: set(Taxon.objects.ancestors_of(taxa).values_list('pk', flat=True))
+		)
+		self.compare(_('leaves'),
+			lambda: set(leaf.pk for taxon in taxa for leaf in taxon.get_descendants(include_self=True) if leaf.is_leaf_node()),
+			lambda: set(Taxon.objects.leaves_of(taxa).values_list('pk', flat=True))
+		)
+		self.compare(_('descendant counts'),
+			lambda: dict((taxon.pk, (taxon.get_descendant_count(), len([leaf for leaf in taxon.get_descendants(include_self=True) if leaf.is_leaf_node()]),)) for taxon in taxa),
+			lambda: dict((taxon.pk, (taxon.num_descendants, taxon.num_leaves,)) for taxon in Taxon.objects.with_descendant_counts().filter(pk__in=[taxon.pk for taxon in taxa]))
+		)
+		self.compare(_('lowest common ancestor'),
+			lambda: self.get_lowest_common_ancestor(taxa),
+			lambda: Taxon.objects.lowest_common_ancestor(taxa)
+		)
+	
+	def compare(self, name, instance_method, bulk_method):
+		'''Times and compares the results of per-instance and bulk queries.'''
+		start = time()
+		expected = instance_method()
+		instance_time = time() - start
+		start = time()
+		result = bulk_method()
+		bulk_time = time() - start
+		self.stdout.write(_('%(name)s:  per-instance %(instance_time).3fs, bulk %(bulk_time).3fs (%(speedup).1fx)%(mismatch)s\n') % {
+			'name': name,
+			'instance_time': instance_time,
+			'bulk_time': bulk_time,
+			'speedup': instance_time / max(bulk_time, 0.0001),
+			'mismatch': '' if result == expected else _(', RESULTS DIFFER'),
+		})
+	
+	def get_lowest_common_ancestor(self, taxa):
+		'''Returns the lowest common ancestor of taxa with per-instance MPTT methods.'''
+		common = None
+		for taxon in taxa:
+			lineage = list(taxon.get_ancestors(include_self=True))
+			if common is None:
+				common = lineage
+			else:
+				common = [ancestor for ancestor, other in zip(common, lineage) if ancestor == other]
+		if common:
+			return common[-1]
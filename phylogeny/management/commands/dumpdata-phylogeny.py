@@ -7,11 +7,18 @@ natural keys (if at all).  Relying on the fact that Taxon is based on MPTT, we
 know its instances are always output in depth-first order.  This means self-
 dependency will not cause problems when deserializing the data.  This management
 command allows self-dependency when serializing and when using natural keys.
+
+Objects are streamed rather than collected in memory:  each model is fetched in
+chunks paged on an indexed key (MPTT models on tree_id and lft, so taxa stay in
+depth-first order) and serialized objects are written out as they are
+serialized.  JSON is written one object per line.
 '''
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
 from django.core import serializers
+from django.core.serializers import json
 from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.utils import simplejson
 from django.utils.datastructures import SortedDict
 
 from optparse import make_option
@@ -31,6 +38,10 @@ class Command(BaseCommand):
             help='Use natural keys if they are available.'),
         make_option('-a', '--all', action='store_true', dest='use_base_manager', default=False,
             help="Use Django's base manager to dump all models stored in the database, including those that would otherwise be filtered or modified by a custom manager."),
+        make_option('-o', '--output', default=None, dest='output',
+            help='Specifies a file to write the serialized data to (defaults to standard output).'),
+        make_option('--chunk-size', default=1000, dest='chunk_size', type='int',
+            help='Specifies the number of objects fetched per query.'),
     )
     help = ("Output the contents of the database as a fixture of the given "
             "format (using each model's default manager unless --all is "
@@ -48,6 +59,8 @@ class Command(BaseCommand):
         show_traceback = options.get('traceback', False)
         use_natural_keys = options.get('use_natural_keys', False)
         use_base_manager = options.get('use_base_manager', False)
+        output = options.get('output', None)
+        chunk_size = options.get('chunk_size', 1000)
 
         excluded_apps = set()
         excluded_models = set()
@@ -108,24 +121,95 @@ class Command(BaseCommand):
         except KeyError:
             raise CommandError("Unknown serialization format: %s" % format_name)
 
-        # Now collate the objects to be serialized.
-        objects = []
-        for model in sort_dependencies(app_list.items()):
-            if model in excluded_models:
-                continue
-            if not model._meta.proxy and router.allow_syncdb(using, model):
-                if use_base_manager:
-                    objects.extend(model._base_manager.using(using).all())
-                else:
-                    objects.extend(model._default_manager.using(using).all())
+        # Now stream the objects to be serialized, one chunk at a time.
+        models = [model for model in sort_dependencies(app_list.items())
+            if model not in excluded_models and not model._meta.proxy and router.allow_syncdb(using, model)]
+        objects = iter_objects(models, using, use_base_manager=use_base_manager,
+            use_natural_keys=use_natural_keys, chunk_size=chunk_size)
+        if format_name == 'json':
+            serializer = StreamingJSONSerializer()
+        else:
+            serializer = serializers.get_serializer(format_name)()
 
+        stream = self.stdout
+        if output:
+            stream = open(output, 'w')
         try:
-            return serializers.serialize(format_name, objects, indent=indent,
-                        use_natural_keys=use_natural_keys)
+            serializer.serialize(objects, stream=stream, indent=indent,
+                use_natural_keys=use_natural_keys)
         except Exception, e:
             if show_traceback:
                 raise
             raise CommandError("Unable to serialize database: %s" % e)
+        finally:
+            if output:
+                stream.close()
+
+class StreamingJSONSerializer(json.Serializer):
+    """JSON serializer writing each object as soon as it is serialized.
+
+    Django's JSON serializer dumps the list of all serialized objects at the
+    end.  This one writes the same list item by item, one object per line
+    (unless indented).
+    """
+    def start_serialization(self):
+        super(StreamingJSONSerializer, self).start_serialization()
+        if simplejson.__version__.split('.') >= ['2', '1', '3']:
+            # Use JS strings to represent Python Decimal instances (ticket #16850)
+            self.options.update({'use_decimal': False})
+        self.count = 0
+        self.stream.write('[')
+
+    def end_object(self, obj):
+        super(StreamingJSONSerializer, self).end_object(obj)
+        for data in self.objects:
+            self.stream.write(self.count and ',\n' or '\n')
+            simplejson.dump(data, self.stream, cls=json.DjangoJSONEncoder, **self.options)
+            self.count += 1
+        self.objects = []
+
+    def end_serialization(self):
+        self.stream.write(self.count and '\n]\n' or ']\n')
+
+def iter_objects(models, using, use_base_manager=False, use_natural_keys=False, chunk_size=1000):
+    """Yield the objects of each model, fetching chunk_size objects per query.
+
+    Chunks are paged on an indexed key rather than by offset:  MPTT models on
+    (tree_id, lft), so that parents are always output before their children,
+    and other models on their primary key.  With natural keys, related
+    objects with natural keys are fetched in the same query.
+    """
+    for model in models:
+        if use_base_manager:
+            queryset = model._base_manager.using(using).all()
+        else:
+            queryset = model._default_manager.using(using).all()
+        if use_natural_keys:
+            related = [field.name for field in model._meta.fields
+                if hasattr(field.rel, 'to') and hasattr(field.rel.to, 'natural_key')]
+            if related:
+                queryset = queryset.select_related(*related)
+        mptt_meta = getattr(model, '_mptt_meta', None)
+        if mptt_meta is not None:
+            keys = (mptt_meta.tree_id_attr, mptt_meta.left_attr)
+        else:
+            keys = ('pk',)
+        queryset = queryset.order_by(*keys)
+
+        chunk = list(queryset[:chunk_size])
+        while chunk:
+            for obj in chunk:
+                yield obj
+            if len(chunk) < chunk_size:
+                break
+            last = [getattr(chunk[-1], key) for key in keys]
+            chunk = []
+            if len(keys) > 1:
+                # the rest of the tree, then the following trees (a single
+                # OR filter is not answered from the indexes)
+                chunk = list(queryset.filter(**{keys[0]: last[0], '%s__gt' % keys[1]: last[1]})[:chunk_size])
+            if len(chunk) < chunk_size:
+                chunk += list(queryset.filter(**{'%s__gt' % keys[0]: last[0]})[:chunk_size - len(chunk)])
 
 def sort_dependencies(app_list):
     """Sort a list of app,modellist pairs into a single list of models.
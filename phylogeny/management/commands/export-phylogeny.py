@@ -14,7 +14,8 @@ class Command(BaseCommand):
 	args = '<taxon_slug> <path>'
 	help = _('Exports a phylogenetic tree rooted on <taxon_slug> to the specified file in the specified format (default format is phyloxml)')
 	option_list = BaseCommand.option_list + (
-		make_option('--format', '-f', dest='format', default='phyloxml', help=_('A file format supported by Biopython for the exported phylogenetic tree ("phyloxml", "nexus", or "newick")')),
+		make_option('--format', '-f', dest='format', default='phyloxml', help=_('A file format for the exported phylogenetic tree ("phyloxml", "nexus", or "newick", supported by Biopython, or "columnar")')),
+		make_option('--stream', '-s', action='store_true', dest='stream', default=False, help=_('Write the phylogenetic tree to file while walking it rather than building it in memory first (for very large trees)')),
 	)
 	
 	def handle(self, *args, **options):
@@ -37,6 +38,10 @@ class Command(BaseCommand):
 		exporter = exporter_registry.get_by_format_name(format_name)
 		exporter.taxon = taxon
 		exporter.export_to = path
-		exporter.save()
+		if options['stream']:
+			with open(path, 'wb') as open_file:
+				exporter.write(open_file)
+		else:
+			exporter.save()
 		self.stdout.write(_('Successfully exported tree rooted on taxon "%(taxon_slug)s" to "%(path)s" in format "%(format)s"\n') % {'taxon_slug': taxon_slug, 'path': path, 'format': format_name})
 	
@@ -1,29 +1,121 @@
 '''
-Imports a phylogenetic tree (especially as from the command line).
+Imports phylogenetic trees (especially as from the command line).
 '''
+import os
+from glob import glob
+from multiprocessing import Pool
 from optparse import make_option
+from time import time
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from django.utils.translation import ugettext as _
 
-from phylogeny.importers import importer_registry
+from phylogeny.importers import importer_registry, read_phylogeny_nodes
 
 
 class Command(BaseCommand):
-	args = '<path>'
-	help = _('Imports a phylogenetic tree into the database')
+	args = '<path path ...>'
+	help = _('Imports phylogenetic trees into the database from files, directories (every file in them) or glob patterns, each file in its own transaction')
 	option_list = BaseCommand.option_list + (
 		make_option('--format', '-f', dest='format', default='phyloxml', help=_('A phylogeny file format supported by Biopython ("phyloxml", "nexus", or "newick")')),
+		make_option('--bulk', '-b', action='store_true', dest='bulk', default=False, help=_('Write the phylogeny with batched inserts (recommended for large trees)')),
+		make_option('--stream', '-s', action='store_true', dest='stream', default=False, help=_('Parse PhyloXML and Newick files while writing them with batched inserts, without holding whole trees in memory (other formats are read whole)')),
+		make_option('--processes', '-p', dest='processes', type='int', default=1, help=_('Number of processes parsing files in parallel (default is 1); files parsed in parallel are written with batched inserts')),
 	)
 	
 	def handle(self, *args, **options):
-		try:
-			path = args[0]
-		except:
+		if not args:
 			raise CommandError(_('Phylogeny path missing. For more information type:\npython manage.py help import-phylogeny'))
 		
 		format_name = options['format']
-		importer = importer_registry.get_by_format_name(format_name)
-		importer.save(import_from=path)	
-		self.stdout.write(_('Successfully imported tree from "%(path)s" in format "%(format)s"\n') % {'path': path, 'format': format_name})
+		# fail early on unknown formats
+		importer_registry.get_by_format_name(format_name)
+		paths = self.get_paths(args)
+		
+		start = time()
+		if options['processes'] > 1:
+			results = self.import_in_parallel(paths, format_name, options['processes'])
+		else:
+			results = self.import_serially(paths, format_name, options['bulk'], options['stream'])
+		failures = 0
+		for path, taxon, error, parse_time, write_time in results:
+			if error:
+				failures += 1
+				self.stderr.write(_('Failed to import tree from "%(path)s" (%(time).2fs):  %(error)s\n') % {'path': path, 'time': parse_time + write_time, 'error': error})
+			else:
+				self.stdout.write(_('Successfully imported tree rooted on taxon "%(taxon_slug)s" (%(count)d taxa) from "%(path)s" in format "%(format)s" (parsed in %(parse_time).2fs, written in %(write_time).2fs)\n') % {
+					'taxon_slug': taxon.slug,
+					'count': taxon.get_descendant_count() + 1,
+					'path': path,
+					'format': format_name,
+					'parse_time': parse_time,
+					'write_time': write_time,
+				})
+		
+		self.stdout.write(_('Imported %(count)d of %(total)d files in %(time).2fs\n') % {'count': len(paths) - failures, 'total': len(paths), 'time': time() - start})
+		if failures:
+			raise CommandError(_('%(failures)d of %(total)d files failed to import') % {'failures': failures, 'total': len(paths)})
 	
+	def get_paths(self, args):
+		'''
+		Returns the file paths for the command's arguments:  files, the files
+		in directories (sorted, hidden files excluded) and the files matching
+		glob patterns.  Arguments matching nothing are kept, so that they are
+		reported as failures.
+		'''
+		paths = []
+		for arg in args:
+			if os.path.isdir(arg):
+				paths.extend(sorted(os.path.join(arg, name) for name in os.listdir(arg) if not name.startswith('.') and os.path.isfile(os.path.join(arg, name))))
+			elif os.path.exists(arg):
+				paths.append(arg)
+			else:
+				paths.extend(sorted(path for path in glob(arg) if os.path.isfile(path)) or [arg])
+		return paths
+	
+	def import_serially(self, paths, format_name, bulk, stream):
+		'''
+		Parses and saves files one at a time.  Yields a (path, root taxon,
+		error message, parse time, write time) tuple per file.  Streamed
+		files are parsed while they are written.
+		'''
+		for path in paths:
+			importer = importer_registry.get_by_format_name(format_name)
+			importer.bulk = bulk
+			importer.stream = stream and importer.streaming
+			start = time()
+			try:
+				importer.import_from = path
+				parsed = time()
+				taxon = importer.save()
+			except Exception as exception:
+				yield path, None, u'%s: %s' % (exception.__class__.__name__, exception,), time() - start, 0
+				continue
+			yield path, taxon, None, parsed - start, time() - parsed
+	
+	def import_in_parallel(self, paths, format_name, processes):
+		'''
+		Parses files in a pool of worker processes and saves each parsed tree
+		with batched inserts as it arrives.  Yields a (path, root taxon, error
+		message, parse time, write time) tuple per file.
+		'''
+		# forked workers must not share the database connection
+		connection.close()
+		pool = Pool(processes)
+		try:
+			for path, nodes, error, parse_time in pool.imap_unordered(read_phylogeny_nodes, [(path, format_name,) for path in paths]):
+				if error:
+					yield path, None, error, parse_time, 0
+					continue
+				importer = importer_registry.get_by_format_name(format_name)
+				start = time()
+				try:
+					taxon = importer.save_nodes(nodes)
+				except Exception as exception:
+					yield path, None, u'%s: %s' % (exception.__class__.__name__, exception,), parse_time, time() - start
+					continue
+				yield path, taxon, None, parse_time, time() - start
+		finally:
+			pool.terminate()
+			pool.join()
@@ -0,0 +1,154 @@
+'''
+Loads fixtures (especially as written by dumpdata-phylogeny) with batched
+inserts, without saving taxa one at a time through MPTT.
+
+JSON fixtures are read object by object.  Consecutive objects of a model are
+inserted in batches, so fixtures must list objects after the objects they
+refer to (as dumpdata-phylogeny does).  Objects which already exist are
+overwritten one at a time, as by loaddata.  Once loaded, the MPTT fields of
+taxa are checked (or recomputed) in one pass, and their counts and lineage
+paths are recomputed.
+'''
+import os
+from optparse import make_option
+from time import time
+
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.db import connection, transaction
+from django.utils.translation import ugettext as _
+
+from phylogeny.managers import NaturalKeyResolver
+from phylogeny.utils import bulk_create, iter_json_array, open_decompressed
+
+
+class Command(BaseCommand):
+	args = '<path path ...>'
+	help = _('Loads fixtures into the database with batched inserts, then checks (or rebuilds) the tree fields of taxa in one pass and recomputes their counts and lineage paths')
+	option_list = BaseCommand.option_list + (
+		make_option('--format', '-f', dest='format', default=None, help=_('Serialization format of the fixtures ("json", "xml", or "yaml"); by default, from their file extensions')),
+		make_option('--batch-size', dest='batch_size', type='int', default=500, help=_('Number of objects per batched insert (default is 500)')),
+		make_option('--rebuild', '-r', action='store_true', dest='rebuild', default=False, help=_('Recompute the tree fields of taxa from their parents instead of checking the loaded values')),
+	)
+	
+	def handle(self, *paths, **options):
+		from phylogeny.exporters import export_cache
+		from phylogeny.models import Taxon
+		from phylogeny.search import search_index_cache
+		from phylogeny.snapshots import snapshot_cache
+		if not paths:
+			raise CommandError(_('Fixture path missing. For more information type:\npython manage.py help loaddata-phylogeny'))
+		formats = [self.get_format_name(path, options['format']) for path in paths]
+		
+		start = time()
+		counts = {}
+		with transaction.commit_on_success():
+			with connection.constraint_checks_disabled():
+				with NaturalKeyResolver() as resolver:
+					for path, format_name in zip(paths, formats):
+						fixture = open(path, 'rb')
+						try:
+							for model, count in self.load(self.get_objects(open_decompressed(fixture), format_name), options['batch_size'], resolver).items():
+								counts[model] = counts.get(model, 0) + count
+						except Exception as exception:
+							raise CommandError(_('Failed to load fixture "%(path)s":  %(error)s') % {'path': path, 'error': u'%s: %s' % (exception.__class__.__name__, exception,)})
+						finally:
+							fixture.close()
+			connection.check_constraints(table_names=[model._meta.db_table for model in counts])
+			
+			if Taxon in counts:
+				self.rebuild_tree(options['rebuild'])
+			sequence_sql = connection.ops.sequence_reset_sql(no_style(), counts.keys())
+			if sequence_sql:
+				cursor = connection.cursor()
+				for sql in sequence_sql:
+					cursor.execute(sql)
+		# objects are inserted without signals
+		export_cache.invalidate()
+		snapshot_cache.invalidate()
+		search_index_cache.invalidate()
+		
+		for model, count in sorted(counts.items(), key=lambda item: item[0]._meta.object_name):
+			self.stdout.write(_('Loaded %(count)d %(model)s\n') % {'count': count, 'model': model._meta.verbose_name_plural})
+		self.stdout.write(_('Successfully loaded %(count)d objects from %(total)d fixtures in %(time).2fs\n') % {'count': sum(counts.values()), 'total': len(paths), 'time': time() - start})
+	
+	def get_format_name(self, path, format_name=None):
+		'''
+		Returns the serialization format of a fixture:  `format_name` if
+		given, otherwise its file extension (after any ".gz" or ".bz2").
+		'''
+		if format_name is None:
+			name, extension = os.path.splitext(path)
+			if extension in ('.gz', '.bz2',):
+				name, extension = os.path.splitext(name)
+			format_name = extension[1:]
+		if format_name not in serializers.get_public_serializer_formats():
+			raise CommandError(_('Unknown serialization format "%(format)s" for fixture "%(path)s"') % {'format': format_name, 'path': path})
+		return format_name
+	
+	def get_objects(self, fixture, format_name):
+		'''
+		Returns the deserialized objects of a fixture.  JSON fixtures are
+		parsed one object at a time.
+		'''
+		if format_name == 'json':
+			return PythonDeserializer(iter_json_array(fixture))
+		return serializers.deserialize(format_name, fixture)
+	
+	def load(self, objects, batch_size, resolver):
+		'''
+		Writes deserialized objects in batches of consecutive objects of a
+		model and returns the number of objects written by model.  Slugs are
+		added to the natural key resolver before their objects are written, so
+		that taxa may refer to parents in the same batch.
+		'''
+		counts = {}
+		batch = []
+		for obj in objects:
+			model = obj.object.__class__
+			if batch and (batch[0].object.__class__ is not model or len(batch) >= batch_size):
+				self.write(batch)
+				batch = []
+			if model in resolver.get_models():
+				resolver.add(model, obj.object.slug, obj.object.pk)
+			batch.append(obj)
+			counts[model] = counts.get(model, 0) + 1
+		self.write(batch)
+		return counts
+	
+	def write(self, batch):
+		'''
+		Writes a batch of deserialized objects of a model with batched inserts.
+		Objects which already exist (by primary key) or have many-to-many data
+		are saved one at a time, as by loaddata (without `save` methods).
+		'''
+		if not batch:
+			return
+		model = batch[0].object.__class__
+		pks = [obj.object.pk for obj in batch]
+		existing = set()
+		for start in range(0, len(pks), 500):
+			existing.update(model._default_manager.filter(pk__in=pks[start:start + 500]).values_list('pk', flat=True))
+		bulk_create(model, [obj.object for obj in batch if obj.object.pk not in existing and not obj.m2m_data], raw=True)
+		for obj in batch:
+			if obj.object.pk in existing or obj.m2m_data:
+				obj.save()
+	
+	def rebuild_tree(self, rebuild=False):
+		'''
+		Checks the loaded MPTT fields of taxa, recomputing them from parent
+		links if they are inconsistent (or if `rebuild` is set), then
+		recomputes the counts and lineage paths of taxa.
+		'''
+		from phylogeny.models import Taxon
+		if not rebuild:
+			pk = Taxon.objects.find_tree_error()
+			if pk is not None:
+				self.stderr.write(_('Tree fields of taxa are inconsistent (first at taxon %(pk)s); rebuilding them from parent taxa\n') % {'pk': pk})
+				rebuild = True
+		if rebuild:
+			Taxon.objects.rebuild_tree()
+		Taxon.objects.recount()
+		Taxon.objects.rebuild_paths()
@@ -0,0 +1,23 @@
+'''
+Overrides Django's loaddata command (as with any app command of the same
+name, while the Phylogeny app is installed) to resolve natural keys from
+memory.
+
+Fixtures are loaded by Django's own command inside a `NaturalKeyResolver`,
+so the natural keys of taxa, taxonomy databases and taxa categories (as
+written by dumpdata-phylogeny with -n) resolve from slugs read once per model
+instead of with one to three queries per object.  Everything else behaves as
+Django's loaddata does.  For large fixtures, loaddata-phylogeny writes with
+batched inserts.
+'''
+from django.core.management.commands import loaddata
+
+from phylogeny.managers import NaturalKeyResolver
+
+
+class Command(loaddata.Command):
+	help = loaddata.Command.help + ' Natural keys of Phylogeny models are resolved from memory.'
+	
+	def handle(self, *fixture_labels, **options):
+		with NaturalKeyResolver(using=options['database']):
+			return super(Command, self).handle(*fixture_labels, **options)
@@ -0,0 +1,39 @@
+'''
+Materializes the exported phylogenies listed in the PHYLOGENY_EXPORT_ARTIFACTS
+setting as files (especially as from the command line or a scheduled job).
+'''
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from phylogeny.models import Taxon
+from phylogeny.exporters import export_cache
+from phylogeny.artifacts import artifact_store
+
+
+class Command(BaseCommand):
+	args = '[taxon_slug taxon_slug ...]'
+	help = _('Exports the phylogenetic trees listed in the PHYLOGENY_EXPORT_ARTIFACTS setting (or only those rooted on the given taxa) to PHYLOGENY_EXPORT_ARTIFACTS_ROOT')
+	option_list = BaseCommand.option_list + (
+		make_option('--force', '-f', action='store_true', dest='force', default=False, help=_('Export trees even if their files are up to date')),
+	)
+	
+	def handle(self, *args, **options):
+		for taxon_slug in args:
+			if taxon_slug not in artifact_store.artifacts:
+				raise CommandError(_('Taxon "%(taxon_slug)s" is not listed in PHYLOGENY_EXPORT_ARTIFACTS') % {'taxon_slug': taxon_slug})
+		
+		try:
+			exporters = list(artifact_store.get_exporters(slugs=args))
+		except Taxon.DoesNotExist:
+			raise CommandError(_('A taxon listed in PHYLOGENY_EXPORT_ARTIFACTS does not exist'))
+		
+		for exporter in exporters:
+			path = artifact_store.get_path(exporter)
+			digest = export_cache.get_digest(exporter)
+			if not options['force'] and artifact_store.is_fresh(exporter, digest):
+				self.stdout.write(_('"%(path)s" is up to date\n') % {'path': path})
+				continue
+			artifact_store.materialize(exporter, digest)
+			self.stdout.write(_('Successfully exported tree rooted on taxon "%(taxon_slug)s" to "%(path)s" in format "%(format)s"\n') % {'taxon_slug': exporter.taxon.slug, 'path': path, 'format': exporter.format_name})
@@ -0,0 +1,19 @@
+'''
+Recomputes the denormalized descendant and leaf counts and lineage paths of all
+taxa (especially as from the command line, after loading fixtures).
+'''
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.translation import ugettext as _
+
+from phylogeny.models import Taxon
+
+
+class Command(BaseCommand):
+	help = _('Recomputes the descendant and leaf counts and lineage paths of all taxa in bulk')
+	
+	def handle(self, *args, **options):
+		with transaction.commit_on_success():
+			Taxon.objects.recount()
+			Taxon.objects.rebuild_paths()
+		self.stdout.write(_('Successfully recounted %(count)d taxa\n') % {'count': Taxon.objects.count()})
@@ -0,0 +1,22 @@
+'''
+Runs queued phylogeny import jobs (especially as from the command line, for
+jobs left queued when the process running them stopped).
+'''
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext as _
+
+from phylogeny.jobs import import_job_runner
+
+
+class Command(BaseCommand):
+	help = _('Runs the queued phylogeny import jobs, oldest first')
+	
+	def handle(self, *args, **options):
+		for job in import_job_runner.run_queued():
+			self.stdout.write(_('Import job %(pk)d %(status)s (%(count)d clades, %(time).2fs):  %(message)s\n') % {
+				'pk': job.pk,
+				'status': job.get_status_display(),
+				'count': job.clade_count,
+				'time': job.get_elapsed_time(),
+				'message': job.message,
+			})
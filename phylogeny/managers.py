@@ -1,22 +1,491 @@
 '''
 Managers to Phylogeny models.
 '''
-from django.db.models import Manager
+from threading import local
+
+from django.db import connection, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Manager, F, Max, Min, signals
+from django.db.models.query import QuerySet
 
 from mptt import managers as mptt_managers
 
 
+# length of lineage paths (an indexed VARCHAR within MySQL's key length);
+# longer paths, in trees some 40 levels deep, are cut to it
+PATH_LENGTH = 255
+
+
+def make_path(parent_path, pk):
+	'''
+	Returns the lineage path of a taxon from its parent's, cut to
+	`PATH_LENGTH` characters.  A cut path still starts with the complete
+	paths of its ancestors, so prefix lookups on complete paths find it, but
+	lookups from a taxon with a cut path use its MPTT fields instead.
+	'''
+	return ('%s%d/' % (parent_path or '', pk))[:PATH_LENGTH]
+
+
+def is_complete_path(path):
+	'''Returns False if a lineage path may have been cut (see `make_path`).'''
+	return len(path) < PATH_LENGTH
+
+
+class NaturalKeyResolver(object):
+	'''
+	Resolves the natural keys of taxa, taxonomy databases and taxa
+	categories (their slugs) to primary keys from memory, for deserializing
+	fixtures with natural keys.  Slugs are read with one query per model the
+	first time a key of that model is resolved, and objects saved while the
+	resolver is active (as deserialized objects are) are added as they are
+	saved.
+	
+	While a resolver is active, the `get_by_natural_key` methods of the
+	managers of these models return instances with only their primary key
+	and slug set, and those of taxonomy records and distribution points look
+	records up with one query:
+	
+		with NaturalKeyResolver():
+			for obj in serializers.deserialize('json', fixture):
+				obj.save()
+	'''
+	# the active resolver of each database, per thread
+	_active = local()
+	
+	def __init__(self, using=DEFAULT_DB_ALIAS):
+		self.using = using
+		# slug to primary key maps by model
+		self.pks = {}
+		self._previous = None
+	
+	@classmethod
+	def get_active(cls, using):
+		'''Returns the resolver active for a database in this thread, or None.'''
+		return getattr(cls._active, 'resolvers', {}).get(using)
+	
+	def get_models(self):
+		'''Returns the models resolved from memory.'''
+		from phylogeny.models import Taxon, TaxonomyDatabase, TaxaCategory
+		return (Taxon, TaxonomyDatabase, TaxaCategory,)
+	
+	def __enter__(self):
+		if not hasattr(self._active, 'resolvers'):
+			self._active.resolvers = {}
+		self._previous = self._active.resolvers.get(self.using)
+		self._active.resolvers[self.using] = self
+		for model in self.get_models():
+			signals.post_save.connect(self.add_instance, sender=model)
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		for model in self.get_models():
+			signals.post_save.disconnect(self.add_instance, sender=model)
+		if self._previous is None:
+			del self._active.resolvers[self.using]
+		else:
+			self._active.resolvers[self.using] = self._previous
+	
+	def get_pks(self, model):
+		'''Returns the slug to primary key map of a model, reading it if needed.'''
+		pks = self.pks.get(model)
+		if pks is None:
+			pks = self.pks[model] = dict(model._default_manager.using(self.using).order_by().values_list('slug', 'pk').iterator())
+		return pks
+	
+	def add(self, model, slug, pk):
+		'''
+		Adds the slug and primary key of a model instance (say, one queued for
+		a bulk insert).
+		'''
+		self.get_pks(model)[slug] = pk
+	
+	def add_instance(self, sender, instance, using=None, **kwargs):
+		'''Adds saved instances (connected to `post_save` while active).'''
+		if using == self.using:
+			self.add(sender, instance.slug, instance.pk)
+	
+	def get_pk(self, model, slug):
+		'''
+		Returns the primary key of the instance of a model with a slug.  Slugs
+		missing from memory (of objects written otherwise) are looked up and
+		added.  Raises the model's DoesNotExist if there is no such instance.
+		'''
+		pks = self.get_pks(model)
+		try:
+			return pks[slug]
+		except KeyError:
+			pk = pks[slug] = model._default_manager.using(self.using).filter(slug=slug).values_list('pk', flat=True).get()
+			return pk
+	
+	def get(self, model, slug):
+		'''Returns an instance of a model with only its primary key and slug set.'''
+		return model(pk=self.get_pk(model, slug), slug=slug)
+
+
+class TaxonQuerySet(QuerySet):
+	'''
+	QuerySet for Taxon model.  Tree queries are expressed in SQL with MPTT
+	fields rather than with per-instance MPTT methods.
+	
+	Methods taking `taxa` accept a queryset of taxa (used as a subquery), or
+	an iterable of taxa or taxon primary keys.
+	'''
+	def leaf_nodes(self):
+		'''Returns taxa without children (`rght` is `lft` + 1).'''
+		return self.filter(rght=F('lft') + 1)
+	
+	def non_leaf_nodes(self):
+		'''Returns taxa with children (`rght` is greater than `lft` + 1).'''
+		return self.filter(rght__gt=F('lft') + 1)
+	
+	def filter_by_tree_range(self, taxa, condition):
+		'''
+		Returns taxa in the same tree as any of `taxa` for which `condition`
+		holds, in one query.  `condition` is SQL comparing the MPTT fields of a
+		taxon in this queryset (`%(taxon)s`) and one of `taxa` (`%(node)s`).
+		'''
+		if isinstance(taxa, QuerySet):
+			pk_sql, params = taxa.order_by().values('pk').query.sql_with_params()
+		else:
+			params = [getattr(taxon, 'pk', taxon) for taxon in taxa]
+			if not params:
+				# unlike none(), keeps this queryset's class
+				return self.filter(pk__in=[])
+			pk_sql = ', '.join(['%s'] * len(params))
+		
+		qn = connection.ops.quote_name
+		names = {
+			'table': qn(self.model._meta.db_table),
+			'taxon': qn('tree_range_taxon'),
+			'node': qn('tree_range_node'),
+			'pk': qn(self.model._meta.pk.column),
+			'pks': pk_sql,
+		}
+		names['condition'] = condition % names
+		# the range join starts from the given taxa, so it is evaluated once
+		# rather than once per taxon in this queryset
+		where = '%(table)s.%(pk)s IN (SELECT %(taxon)s.%(pk)s FROM %(table)s %(node)s INNER JOIN %(table)s %(taxon)s ON %(taxon)s.tree_id = %(node)s.tree_id AND %(condition)s WHERE %(node)s.%(pk)s IN (%(pks)s))' % names
+		return self.extra(where=[where], params=params)
+	
+	def descendants_of(self, taxa, include_self=False):
+		'''Returns the descendants of any of the given taxa.'''
+		if include_self:
+			return self.filter_by_tree_range(taxa, '%(taxon)s.lft >= %(node)s.lft AND %(taxon)s.lft <= %(node)s.rght')
+		return self.filter_by_tree_range(taxa, '%(taxon)s.lft > %(node)s.lft AND %(taxon)s.lft < %(node)s.rght')
+	
+	def ancestors_of(self, taxa, include_self=False):
+		'''Returns the ancestors of any of the given taxa.'''
+		if include_self:
+			return self.filter_by_tree_range(taxa, '%(taxon)s.lft <= %(node)s.lft AND %(taxon)s.rght >= %(node)s.rght')
+		return self.filter_by_tree_range(taxa, '%(taxon)s.lft < %(node)s.lft AND %(taxon)s.rght > %(node)s.rght')
+	
+	def leaves_of(self, taxa):
+		'''
+		Returns the leaf nodes under any of the given taxa (including the
+		given taxa which are leaf nodes).
+		'''
+		return self.descendants_of(taxa, include_self=True).leaf_nodes()
+	
+	def with_descendant_counts(self):
+		'''
+		Annotates each taxon with its number of descendants
+		(`num_descendants`, from its MPTT fields) and leaf nodes (`num_leaves`,
+		from a correlated subquery) in the same query.
+		'''
+		qn = connection.ops.quote_name
+		names = {
+			'table': qn(self.model._meta.db_table),
+			'leaf': qn('tree_range_leaf'),
+		}
+		return self.extra(select={
+			'num_descendants': '(%(table)s.rght - %(table)s.lft - 1) / 2' % names,
+			'num_leaves': 'SELECT COUNT(*) FROM %(table)s %(leaf)s WHERE %(leaf)s.tree_id = %(table)s.tree_id AND %(leaf)s.lft >= %(table)s.lft AND %(leaf)s.rght <= %(table)s.rght AND %(leaf)s.rght = %(leaf)s.lft + 1' % names,
+		})
+	
+	def lowest_common_ancestor(self, taxa):
+		'''
+		Returns the deepest taxon which is an ancestor of (or one of) all the
+		given taxa, or None if they are in different trees, in two queries.
+		'''
+		if not isinstance(taxa, QuerySet):
+			taxa = self.model._default_manager.filter(pk__in=[getattr(taxon, 'pk', taxon) for taxon in taxa])
+		span = taxa.aggregate(Min('tree_id'), Max('tree_id'), Min('lft'), Max('rght'))
+		if span['tree_id__min'] is None or span['tree_id__min'] != span['tree_id__max']:
+			return None
+		ancestors = self.filter(tree_id=span['tree_id__min'], lft__lte=span['lft__min'], rght__gte=span['rght__max']).order_by('-lft')
+		try:
+			return ancestors[0]
+		except IndexError:
+			return None
+	
+	def get_path(self, taxon):
+		'''
+		Returns the lineage path of a taxon, looking it up by slug (one index
+		probe) if given a slug.
+		'''
+		if isinstance(taxon, basestring):
+			return self.model._default_manager.filter(slug=taxon).values_list('path', flat=True).get()
+		return taxon.path
+	
+	def get_taxa(self, taxon):
+		'''Returns a taxon (or slug) as `taxa` for tree range lookups.'''
+		if isinstance(taxon, basestring):
+			return self.model._default_manager.filter(slug=taxon)
+		return [taxon]
+	
+	def lineage_of(self, taxon, include_self=True):
+		'''
+		Returns the root and ancestors of a taxon (or slug), root first, by
+		primary key from its lineage path (or from its MPTT fields if its path
+		was cut).
+		'''
+		path = self.get_path(taxon)
+		if not is_complete_path(path):
+			return self.ancestors_of(self.get_taxa(taxon), include_self=include_self)
+		pks = [int(pk) for pk in path.split('/') if pk]
+		if not include_self:
+			pks = pks[:-1]
+		return self.filter(pk__in=pks)
+	
+	def subtree_of(self, taxon, include_self=True):
+		'''
+		Returns the descendants of a taxon (or slug) with one indexed prefix
+		lookup on their lineage paths (or from its MPTT fields if its path was
+		cut).
+		'''
+		path = self.get_path(taxon)
+		if not is_complete_path(path):
+			return self.descendants_of(self.get_taxa(taxon), include_self=include_self)
+		queryset = self.filter(path__startswith=path)
+		if not include_self:
+			queryset = queryset.exclude(path=path)
+		return queryset
+	
+	def search(self, query, limit=None):
+		'''
+		Returns the taxa (up to `limit`) with every word of `query` in their
+		names, common names or descriptions, the last as a prefix, looked up
+		in the search index of the process (see search.py) rather than with
+		`icontains` lookups.  On SQLite, keep `limit` under 1000 (the
+		primary keys found are query parameters).
+		'''
+		from phylogeny.search import search_index_cache
+		return self.filter(pk__in=search_index_cache.get().search(query, limit=limit))
+
+
 class TaxonManager(mptt_managers.TreeManager):
 	'''Manager for Taxon model.'''
+	def get_query_set(self):
+		'''Returns a TaxonQuerySet in tree order.'''
+		return TaxonQuerySet(self.model, using=self._db).order_by(self.tree_id_attr, self.left_attr)
+	
 	def get_by_natural_key(self, slug):
 		'''Returns taxon instance with matching slug.'''
+		resolver = NaturalKeyResolver.get_active(self.db)
+		if resolver is not None:
+			return resolver.get(self.model, slug)
 		return self.get(slug=slug)
+	
+	def leaf_nodes(self):
+		'''Returns taxa without children.'''
+		return self.get_query_set().leaf_nodes()
+	
+	def non_leaf_nodes(self):
+		'''Returns taxa with children.'''
+		return self.get_query_set().non_leaf_nodes()
+	
+	def descendants_of(self, taxa, include_self=False):
+		'''Returns the descendants of any of the given taxa.'''
+		return self.get_query_set().descendants_of(taxa, include_self=include_self)
+	
+	def ancestors_of(self, taxa, include_self=False):
+		'''Returns the ancestors of any of the given taxa.'''
+		return self.get_query_set().ancestors_of(taxa, include_self=include_self)
+	
+	def leaves_of(self, taxa):
+		'''Returns the leaf nodes under any of the given taxa.'''
+		return self.get_query_set().leaves_of(taxa)
+	
+	def with_descendant_counts(self):
+		'''Returns taxa annotated with their numbers of descendants and leaves.'''
+		return self.get_query_set().with_descendant_counts()
+	
+	def lowest_common_ancestor(self, taxa):
+		'''Returns the lowest common ancestor of the given taxa.'''
+		return self.get_query_set().lowest_common_ancestor(taxa)
+	
+	def lineage_of(self, taxon, include_self=True):
+		'''Returns the lineage of a taxon (or slug), root first.'''
+		return self.get_query_set().lineage_of(taxon, include_self=include_self)
+	
+	def subtree_of(self, taxon, include_self=True):
+		'''Returns the descendants of a taxon (or slug).'''
+		return self.get_query_set().subtree_of(taxon, include_self=include_self)
+	
+	def search(self, query, limit=None):
+		'''Returns the taxa matching a full-text query.'''
+		return self.get_query_set().search(query, limit=limit)
+	
+	def replace_path_prefix(self, old_prefix, new_prefix, tree_id, lft, rght):
+		'''
+		Replaces the prefix of the lineage paths of a subtree (given by its
+		root's MPTT fields) with one UPDATE after a move.  Returns False,
+		changing nothing, if the old prefix or a path in the subtree was cut or
+		a new path would be; the paths of the subtree's tree must then be
+		rebuilt.
+		'''
+		qn = connection.ops.quote_name
+		names = {
+			'table': qn(self.model._meta.db_table),
+			'column': qn(self.model._meta.get_field('path').column),
+			'tree_id': qn(self.model._meta.get_field(self.tree_id_attr).column),
+			'lft': qn(self.model._meta.get_field(self.left_attr).column),
+		}
+		subtree = 'WHERE %(tree_id)s = %%s AND %(lft)s BETWEEN %%s AND %%s' % names
+		cursor = connection.cursor()
+		cursor.execute(('SELECT MAX(LENGTH(%(column)s)) FROM %(table)s ' % names) + subtree, [tree_id, lft, rght])
+		length = cursor.fetchone()[0] or 0
+		if max(len(old_prefix), length, length - len(old_prefix) + len(new_prefix)) >= PATH_LENGTH:
+			return False
+		if connection.vendor == 'mysql':
+			expression = 'CONCAT(%%s, SUBSTRING(%(column)s, %%s))' % names
+		else:
+			expression = '%%s || SUBSTR(%(column)s, %%s)' % names
+		cursor.execute(('UPDATE %(table)s SET %(column)s = ' % names) + expression + ' ' + subtree, [new_prefix, len(old_prefix) + 1, tree_id, lft, rght])
+		transaction.commit_unless_managed()
+		return True
+	
+	def rebuild_paths(self, tree_id=None, batch_size=500):
+		'''
+		Recomputes the lineage paths of all taxa (or those of one tree) from
+		one pass over the taxa in tree order, with batched UPDATE statements.
+		'''
+		queryset = self.get_query_set()
+		if tree_id is not None:
+			queryset = queryset.filter(**{self.tree_id_attr: tree_id})
+		paths = {}
+		rows = []
+		for pk, parent_id in queryset.values_list('pk', self.parent_attr).iterator():
+			paths[pk] = path = make_path(paths.get(parent_id), pk)
+			rows.append((path, pk,))
+		
+		qn = connection.ops.quote_name
+		opts = self.model._meta
+		sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (qn(opts.db_table), qn(opts.get_field('path').column), qn(opts.pk.column))
+		cursor = connection.cursor()
+		for start in xrange(0, len(rows), batch_size):
+			cursor.executemany(sql, rows[start:start + batch_size])
+		transaction.commit_unless_managed()
+	
+	def find_tree_error(self):
+		'''
+		Returns the primary key of the first taxon (in tree order) whose MPTT
+		fields disagree with its parent link, or None if the MPTT fields of
+		all taxa are consistent, from one pass over the taxa in tree order:
+		the `lft` and `rght` values of each tree must number its taxa
+		depth-first from 1, each taxon must lie within its parent's range and
+		trees must have one root.
+		'''
+		# [pk, rght] of open taxa
+		stack = []
+		position = 0
+		last_tree_id = None
+		for pk, parent_id, tree_id, lft, rght, level in self.get_query_set().values_list('pk', self.parent_attr, self.tree_id_attr, self.left_attr, self.right_attr, self.level_attr).iterator():
+			while stack and (tree_id != last_tree_id or stack[-1][1] < lft):
+				position += 1
+				if stack[-1][1] != position:
+					return stack[-1][0]
+				stack.pop()
+			if tree_id != last_tree_id:
+				position = 0
+			elif not stack:
+				# a second root
+				return pk
+			position += 1
+			if lft != position or rght <= lft or level != len(stack) or parent_id != (stack[-1][0] if stack else None):
+				return pk
+			stack.append([pk, rght])
+			last_tree_id = tree_id
+		while stack:
+			position += 1
+			if stack[-1][1] != position:
+				return stack[-1][0]
+			stack.pop()
+		return None
+	
+	def rebuild_tree(self, batch_size=500):
+		'''
+		Recomputes the MPTT fields of all taxa from their parent links in one
+		pass with batched UPDATE statements (rather than MPTT's query per
+		taxon).  Trees and siblings keep their order; trees are renumbered
+		from 1.
+		'''
+		children = {}
+		for pk, parent_id in self.get_query_set().values_list('pk', self.parent_attr).iterator():
+			children.setdefault(parent_id, []).append(pk)
+		
+		rows = []
+		for tree_id, root_id in enumerate(children.get(None, ()), 1):
+			position = 1
+			# [pk, lft, level, child iterator] of open taxa
+			stack = [[root_id, position, 0, iter(children.get(root_id, ()))]]
+			while stack:
+				node = stack[-1]
+				child_id = next(node[3], None)
+				position += 1
+				if child_id is None:
+					stack.pop()
+					rows.append((tree_id, node[1], position, node[2], node[0],))
+				else:
+					stack.append([child_id, position, node[2] + 1, iter(children.get(child_id, ()))])
+		
+		qn = connection.ops.quote_name
+		opts = self.model._meta
+		columns = [qn(opts.get_field(attr).column) for attr in (self.tree_id_attr, self.left_attr, self.right_attr, self.level_attr,)]
+		sql = 'UPDATE %s SET %s = %%s, %s = %%s, %s = %%s, %s = %%s WHERE %s = %%s' % tuple([qn(opts.db_table)] + columns + [qn(opts.pk.column)])
+		cursor = connection.cursor()
+		for start in xrange(0, len(rows), batch_size):
+			cursor.executemany(sql, rows[start:start + batch_size])
+		transaction.commit_unless_managed()
+	
+	def recount(self, chunk_size=500):
+		'''
+		Recomputes the denormalized descendant and leaf counts of all taxa in
+		bulk: descendant counts with one update from the MPTT fields, leaf
+		counts from one pass over the taxa in tree order and one update per
+		chunk of taxa sharing a leaf count.
+		'''
+		queryset = self.get_query_set()
+		queryset.update(descendant_count=(F(self.right_attr) - F(self.left_attr) - 1) / 2)
+		
+		leaf_counts = {}
+		stack = []
+		
+		def pop():
+			pk, tree_id, rght, leaves = stack.pop()
+			leaves = leaves or 1
+			leaf_counts.setdefault(leaves, []).append(pk)
+			if stack:
+				stack[-1][3] += leaves
+		
+		for pk, tree_id, lft, rght in queryset.values_list('pk', self.tree_id_attr, self.left_attr, self.right_attr).iterator():
+			while stack and (stack[-1][1] != tree_id or stack[-1][2] < lft):
+				pop()
+			stack.append([pk, tree_id, rght, 0])
+		while stack:
+			pop()
+		
+		for leaves, pks in leaf_counts.items():
+			for start in xrange(0, len(pks), chunk_size):
+				self.filter(pk__in=pks[start:start + chunk_size]).update(leaf_count=leaves)
 
 
 class TaxonomyDatabaseManager(Manager):
 	'''Manager for TaxonomyDatabase model.'''
 	def get_by_natural_key(self, slug):
 		'''Returns taxonomy database instance with matching slug.'''
+		resolver = NaturalKeyResolver.get_active(self.db)
+		if resolver is not None:
+			return resolver.get(self.model, slug)
 		return self.get(slug=slug)
 
 
@@ -25,24 +494,34 @@ class TaxonomyRecordManager(Manager):
 	def get_by_natural_key(self, record_id, database_slug, taxon_slug):
 		'''
 		Returns taxnomy record instance with matching record_id, databse,
-		and taxon.
+		and taxon, in one query.
 		'''
-		from phylogeny.models import Taxon, TaxonomyDatabase
-		return self.get(record_id=record_id, database=TaxonomyDatabase.objects.get_by_natural_key(database_slug), taxon=Taxon.objects.get_by_natural_key(taxon_slug))
+		resolver = NaturalKeyResolver.get_active(self.db)
+		if resolver is not None:
+			from phylogeny.models import Taxon, TaxonomyDatabase
+			return self.get(record_id=record_id, database=resolver.get_pk(TaxonomyDatabase, database_slug), taxon=resolver.get_pk(Taxon, taxon_slug))
+		return self.get(record_id=record_id, database__slug=database_slug, taxon__slug=taxon_slug)
 
 
 class DistributionPointManager(Manager):
 	'''Manager for DistributionPoint model.'''
 	def get_by_natural_key(self, latitude, longitude, taxon_slug):
 		'''
-		Returns distribution point instancewith matching lat/long and taxon.
+		Returns distribution point instancewith matching lat/long and taxon,
+		in one query.
 		'''
-		from phylogeny.models import Taxon
-		return self.get(latitude=latitude, longitude=longitude, taxon=Taxon.objects.get_by_natural_key(taxon_slug))
+		resolver = NaturalKeyResolver.get_active(self.db)
+		if resolver is not None:
+			from phylogeny.models import Taxon
+			return self.get(latitude=latitude, longitude=longitude, taxon=resolver.get_pk(Taxon, taxon_slug))
+		return self.get(latitude=latitude, longitude=longitude, taxon__slug=taxon_slug)
 
 
 class TaxaCategoryManager(Manager):
 	'''Manager for TaxaCategory model.'''
 	def get_by_natural_key(self, slug):
 		'''Returns taxa category with matching slug.'''
+		resolver = NaturalKeyResolver.get_active(self.db)
+		if resolver is not None:
+			return resolver.get(self.model, slug)
 		return self.get(slug=slug)
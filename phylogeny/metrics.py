@@ -0,0 +1,192 @@
+'''
+Tree metrics computed from branch lengths with NumPy:  root-to-tip distances,
+tree height and patristic (pairwise) distances between taxa.
+
+Metrics load a phylogeny with one query (or from a tree snapshot) in MPTT
+order and compute over whole arrays rather than taxon by taxon:
+
+	metrics = TreeMetrics.for_taxon(taxon)
+	metrics.get_height()
+	metrics.get_distance(vespa_crabro, polistes_dominula)
+
+As in exports, taxa without a branch length have a branch length of 1.0.  The
+branch length of the root taxon is not part of any distance.
+
+NumPy is optional for Django Phylogeny but required by this module.
+'''
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from phylogeny.exceptions import PhyloMetricsNumPyNotAvailable
+
+
+class TreeMetrics(object):
+	'''
+	Branch length metrics of a phylogeny.  Taxa are held in arrays in
+	depth-first order; the root is at position 0.
+	'''
+	def __init__(self, pks, parent_pks, lfts, rghts, levels, branch_lengths):
+		'''
+		Initializes metrics from sequences of the fields of the taxa in a
+		phylogeny, in depth-first order.  Missing branch lengths are None.
+		'''
+		if numpy is None:
+			raise PhyloMetricsNumPyNotAvailable('NumPy is required to compute tree metrics.')
+		self.pks = numpy.array(pks, dtype=numpy.int64)
+		self.lfts = numpy.array(lfts, dtype=numpy.int64)
+		self.rghts = numpy.array(rghts, dtype=numpy.int64)
+		self.levels = numpy.array(levels, dtype=numpy.int64)
+		self.levels -= self.levels[0]
+		branch_lengths = numpy.array(branch_lengths, dtype=numpy.float64)
+		branch_lengths[numpy.isnan(branch_lengths)] = 1.0
+		branch_lengths[0] = 0.0
+		self.branch_lengths = branch_lengths
+		
+		# positions by primary key, for lookups
+		self._pk_order = numpy.argsort(self.pks)
+		self._sorted_pks = self.pks[self._pk_order]
+		# the root's parent is outside the phylogeny; it is its own parent
+		self.parents = numpy.zeros(len(self.pks), dtype=numpy.int64)
+		if len(self.pks) > 1:
+			self.parents[1:] = self.get_indexes(parent_pks[1:])
+		self._ancestor_table = None
+		self._root_to_tip = None
+	
+	@classmethod
+	def for_taxon(cls, taxon):
+		'''Returns the metrics of the phylogeny rooted on a taxon, in one query.'''
+		rows = taxon.get_descendants(include_self=True).values_list('pk', 'parent', 'lft', 'rght', 'level', 'branch_length')
+		return cls(*cls.get_columns(rows))
+	
+	@classmethod
+	def for_snapshot(cls, snapshot, pk=None, slug=None):
+		'''Returns the metrics of the phylogeny rooted on a taxon of a tree snapshot.'''
+		start, end = snapshot.get_subtree_range(snapshot.get_index(pk=pk, slug=slug))
+		
+		def get_column(values):
+			# shares memory with the snapshot's array (copied by the constructor)
+			return numpy.frombuffer(values, dtype=values.typecode)[start:end]
+		
+		# the parent of the root is ignored
+		parents = numpy.maximum(get_column(snapshot.parents), 0)
+		parent_pks = numpy.frombuffer(snapshot.pks, dtype=snapshot.pks.typecode)[parents]
+		return cls(get_column(snapshot.pks), parent_pks, get_column(snapshot.lfts), get_column(snapshot.rghts), get_column(snapshot.levels), get_column(snapshot.branch_lengths))
+	
+	@staticmethod
+	def get_columns(rows):
+		'''Returns a list of columns from a sequence of rows.'''
+		rows = list(rows)
+		if not rows:
+			raise ValueError('A phylogeny has at least one taxon.')
+		return [list(column) for column in zip(*rows)]
+	
+	def __len__(self):
+		return len(self.pks)
+	
+	def get_indexes(self, taxa):
+		'''
+		Returns an array of the positions of taxa (or primary keys).  Raises
+		KeyError if a taxon is not in the phylogeny.
+		'''
+		if not isinstance(taxa, numpy.ndarray):
+			taxa = [getattr(taxon, 'pk', taxon) for taxon in taxa]
+		pks = numpy.asarray(taxa, dtype=numpy.int64)
+		positions = numpy.searchsorted(self._sorted_pks, pks)
+		positions[positions >= len(self._sorted_pks)] = 0
+		if not numpy.array_equal(self._sorted_pks[positions], pks):
+			raise KeyError('Taxon not in phylogeny.')
+		return self._pk_order[positions]
+	
+	def get_index(self, taxon):
+		'''Returns the position of a taxon (or primary key).'''
+		return self.get_indexes([taxon])[0]
+	
+	@property
+	def leaves(self):
+		'''Boolean array marking leaf taxa.'''
+		return self.rghts == self.lfts + 1
+	
+	@property
+	def root_to_tip(self):
+		'''
+		Array of the distances of all taxa from the root, computed in one
+		pass:  each branch length is added at its taxon's `lft` and
+		subtracted at its `rght`, so the cumulative sum at a taxon's `lft` is
+		the sum of the branch lengths of the taxon and its ancestors.
+		'''
+		if self._root_to_tip is None:
+			lfts = self.lfts - self.lfts[0]
+			rghts = self.rghts - self.lfts[0]
+			events = numpy.zeros(2 * len(self.pks), dtype=numpy.float64)
+			events[lfts] = self.branch_lengths
+			events[rghts] = -self.branch_lengths
+			self._root_to_tip = numpy.cumsum(events)[lfts]
+		return self._root_to_tip
+	
+	def get_root_to_tip_distances(self, leaves_only=True):
+		'''Returns a dictionary of root-to-tip distances by primary key.'''
+		mask = self.leaves if leaves_only else slice(None)
+		return dict(zip(self.pks[mask].tolist(), self.root_to_tip[mask].tolist()))
+	
+	def get_height(self):
+		'''Returns the greatest root-to-tip distance.'''
+		return float(self.root_to_tip[self.leaves].max())
+	
+	def get_ancestor_table(self):
+		'''
+		Returns the binary lifting table of the phylogeny:  row `k` holds the
+		position of the 2 ** `k`-th ancestor of each taxon (the root beyond
+		the root).
+		'''
+		if self._ancestor_table is None:
+			table = [self.parents]
+			for k in xrange(1, max(int(self.levels.max()), 1).bit_length()):
+				table.append(table[-1][table[-1]])
+			self._ancestor_table = table
+		return self._ancestor_table
+	
+	def get_lca_indexes(self, a, b):
+		'''
+		Returns the positions of the lowest common ancestors of pairs of taxa
+		given by two arrays of positions, for all pairs at once.
+		'''
+		table = self.get_ancestor_table()
+		a = numpy.array(a, dtype=numpy.int64)
+		b = numpy.array(b, dtype=numpy.int64)
+		# make `a` the deeper taxon of each pair, then lift it to the level of `b`
+		swap = self.levels[a] < self.levels[b]
+		a[swap], b[swap] = b[swap], a[swap]
+		difference = self.levels[a] - self.levels[b]
+		for k, ancestors in enumerate(table):
+			lift = (difference >> k) & 1 == 1
+			a[lift] = ancestors[a[lift]]
+		# lift both below their lowest common ancestor
+		for ancestors in reversed(table):
+			lift = ancestors[a] != ancestors[b]
+			a[lift] = ancestors[a[lift]]
+			b[lift] = ancestors[b[lift]]
+		return numpy.where(a == b, a, self.parents[a])
+	
+	def get_distances(self, taxa_a, taxa_b):
+		'''
+		Returns an array of the patristic distances between pairs of taxa
+		(or primary keys) from two sequences:  the root-to-tip distances of
+		both less twice that of their lowest common ancestor.
+		'''
+		a = self.get_indexes(taxa_a)
+		b = self.get_indexes(taxa_b)
+		lca = self.get_lca_indexes(a, b)
+		return self.root_to_tip[a] + self.root_to_tip[b] - 2 * self.root_to_tip[lca]
+	
+	def get_distance(self, taxon_a, taxon_b):
+		'''Returns the patristic distance between two taxa (or primary keys).'''
+		return float(self.get_distances([taxon_a], [taxon_b])[0])
+	
+	def get_distance_matrix(self, taxa):
+		'''Returns the matrix of patristic distances between taxa (or primary keys).'''
+		indexes = self.get_indexes(taxa)
+		a, b = numpy.meshgrid(indexes, indexes, indexing='ij')
+		lca = self.get_lca_indexes(a.ravel(), b.ravel()).reshape(a.shape)
+		return self.root_to_tip[a] + self.root_to_tip[b] - 2 * self.root_to_tip[lca]
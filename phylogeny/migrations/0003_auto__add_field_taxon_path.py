@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Taxon.path'
+        db.add_column('phylogeny_taxon', 'path',
+                      self.gf('django.db.models.fields.CharField')(default='', db_index=True, max_length=255, blank=True),
+                      keep_default=False)
+
+        # Filling in lineage paths, parents before their children, cut to the
+        # length of the column
+        if not db.dry_run:
+            paths = {}
+            for pk, parent_id in orm['phylogeny.Taxon'].objects.order_by('tree_id', 'lft').values_list('pk', 'parent'):
+                paths[pk] = ('%s%d/' % (paths.get(parent_id, ''), pk))[:255]
+                orm['phylogeny.Taxon'].objects.filter(pk=pk).update(path=paths[pk])
+
+    def backwards(self, orm):
+        # Deleting field 'Taxon.path'
+        db.delete_column('phylogeny_taxon', 'path')
+
+    models = {
+        'phylogeny.citation': {
+            'Meta': {'object_name': 'Citation'},
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'doi': ('django.db.models.fields.CharField', [], {'max_length': '256', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'taxon': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.Taxon']"}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '512', 'blank': 'True'})
+        },
+        'phylogeny.distributionpoint': {
+            'Meta': {'unique_together': "(('latitude', 'longitude', 'taxon'),)", 'object_name': 'DistributionPoint'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'latitude': ('django.db.models.fields.FloatField', [], {}),
+            'longitude': ('django.db.models.fields.FloatField', [], {}),
+            'place_name': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'}),
+            'taxon': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.Taxon']"})
+        },
+        'phylogeny.taxacategory': {
+            'Meta': {'object_name': 'TaxaCategory'},
+            'color': ('django.db.models.fields.CharField', [], {'max_length': '7'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'phylogeny.taxon': {
+            'Meta': {'object_name': 'Taxon'},
+            'appearance_date_annotation': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'appearance_date_max_value': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'appearance_date_min_value': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'appearance_date_unit': ('django.db.models.fields.CharField', [], {'default': "'mya'", 'max_length': '3', 'blank': 'True'}),
+            'author': ('django.db.models.fields.CharField', [], {'max_length': '256', 'blank': 'True'}),
+            'body_length_unit': ('django.db.models.fields.CharField', [], {'default': "'mm'", 'max_length': '2', 'blank': 'True'}),
+            'body_length_value': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'branch_length': ('django.db.models.fields.FloatField', [], {'default': '1.0', 'null': 'True', 'blank': 'True'}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.TaxaCategory']", 'null': 'True', 'blank': 'True'}),
+            'color': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'}),
+            'common_name': ('django.db.models.fields.CharField', [], {'max_length': '256', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'date_modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'descendant_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'distribution': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'ecology': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'level': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'leaf_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            'lft': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'children'", 'null': 'True', 'to': "orm['phylogeny.Taxon']"}),
+            'rank': ('django.db.models.fields.CharField', [], {'max_length': '32', 'blank': 'True'}),
+            'rght': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'}),
+            'social_unit_annotation': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'social_unit_size_max': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'social_unit_size_min': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'social_unit_type': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'blank': 'True'}),
+            'tagline': ('django.db.models.fields.CharField', [], {'max_length': '256', 'blank': 'True'}),
+            'tree_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'year_of_description': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'phylogeny.taxonimage': {
+            'Meta': {'object_name': 'TaxonImage'},
+            'caption': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.TaxonImageCategory']", 'null': 'True', 'blank': 'True'}),
+            'credit': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'height': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.files.ImageField', [], {'max_length': '100'}),
+            'primary': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'taxon': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.Taxon']"}),
+            'width': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'phylogeny.taxonimagecategory': {
+            'Meta': {'object_name': 'TaxonImageCategory'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'phylogeny.taxonomydatabase': {
+            'Meta': {'object_name': 'TaxonomyDatabase'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '512'})
+        },
+        'phylogeny.taxonomyrecord': {
+            'Meta': {'unique_together': "(('taxon', 'database', 'record_id'),)", 'object_name': 'TaxonomyRecord'},
+            'database': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.TaxonomyDatabase']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'record_id': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'taxon': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['phylogeny.Taxon']"}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '512', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['phylogeny']
\ No newline at end of file
@@ -2,6 +2,8 @@
 Core Django Phylogeny data models.
 '''
 from django.db import models
+from django.db.models import signals, F
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
@@ -58,12 +60,21 @@ class Taxon(mptt_models.MPTTModel):
 	# tree information
 	branch_length = models.FloatField(_('branch length'), default=app_settings.TAXON_BRANCH_LENGTH_DEFAULT, null=True, blank=True)
 	parent = mptt_models.TreeForeignKey('self', verbose_name=_('parent taxon'), null=True, blank=True, related_name='children')
+	# denormalized tree counts (see PHYLOGENY_TAXON_COUNTS)
+	descendant_count = models.PositiveIntegerField(_('number of descendants'), default=0, editable=False)
+	leaf_count = models.PositiveIntegerField(_('number of leaf nodes'), default=1, editable=False, help_text=_('number of leaf nodes among this taxon and its descendants'))
+	# materialized lineage ("1/5/9/": primary keys of the root, ancestors and
+	# self), cut in deep trees (see managers.make_path)
+	path = models.CharField(_('lineage path'), max_length=managers.PATH_LENGTH, db_index=True, blank=True, editable=False)
 	# dates
 	date_created = models.DateTimeField(_('date created'), auto_now_add=True)
 	date_modified = models.DateTimeField( _('date modified'), auto_now=True)
 	
 	# manager
 	objects = managers.TaxonManager()
+	# fields which are only updated in the database, for whole ranges of the
+	# tree, and never from instances
+	denormalized_fields = ('descendant_count', 'leaf_count', 'path',)
 	
 	class Meta:
 		verbose_name = _('taxon')
@@ -75,6 +86,104 @@ class Taxon(mptt_models.MPTTModel):
 	def natural_key(self):
 		return (self.slug,)
 	
+	def save(self, *args, **kwargs):
+		'''
+		Saves the taxon.  New taxa are given a lineage path and added to their
+		ancestors' counts.  The tree counts, lineage paths and MPTT fields of
+		existing taxa are read from the database first, since they are only
+		updated there (see `refresh_denormalized_fields`).
+		'''
+		is_new = self.pk is None
+		if not is_new:
+			self.refresh_denormalized_fields()
+		super(Taxon, self).save(*args, **kwargs)
+		if is_new:
+			self.update_path()
+			if app_settings.PHYLOGENY_TAXON_COUNTS:
+				self.update_ancestor_counts(1)
+	
+	def refresh_denormalized_fields(self):
+		'''
+		Reads the denormalized fields and the MPTT fields (which are also
+		updated in ranges) from the database, so that saving an instance
+		loaded before they were last updated does not write them back.
+		'''
+		opts = self._mptt_meta
+		fields = self.denormalized_fields + (opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr,)
+		values = Taxon.objects.filter(pk=self.pk).values(*fields)[:1]
+		if values:
+			self.__dict__.update(values[0])
+	
+	def move_to(self, target, position='first-child'):
+		'''
+		Moves the taxon (and its descendants) in the tree, moving its counts
+		from its old ancestors to its new ancestors and rewriting the lineage
+		paths of the subtree.
+		'''
+		if app_settings.PHYLOGENY_TAXON_COUNTS:
+			self.update_ancestor_counts(-1)
+		super(Taxon, self).move_to(target, position)
+		if app_settings.PHYLOGENY_TAXON_COUNTS:
+			self.update_ancestor_counts(1)
+		self.update_path()
+		# the taxon is not saved, but its parent has changed
+		Taxon.objects.filter(pk=self.pk).update(date_modified=timezone.now())
+		invalidate_export_cache(Taxon)
+		invalidate_snapshots(Taxon)
+	
+	def update_path(self):
+		'''
+		Sets the lineage path of the taxon from its parent's, replacing the
+		old path prefix of its descendants with one UPDATE (or rebuilding the
+		paths of its tree if paths in the subtree are cut).
+		'''
+		old_path, parent_path, tree_id, lft, rght = Taxon.objects.filter(pk=self.pk).values_list('path', 'parent__path', 'tree_id', 'lft', 'rght')[0]
+		self.path = managers.make_path(parent_path, self.pk)
+		if old_path == self.path:
+			return
+		if not old_path:
+			Taxon.objects.filter(pk=self.pk).update(path=self.path)
+		elif not Taxon.objects.replace_path_prefix(old_path, self.path, tree_id, lft, rght):
+			Taxon.objects.rebuild_paths(tree_id=tree_id)
+	
+	def get_lineage_pks(self):
+		'''
+		Returns the primary keys of the root, ancestors and self, from the
+		lineage path (or from the MPTT fields if it was cut).
+		'''
+		if not managers.is_complete_path(self.path):
+			return list(self.get_ancestors(include_self=True).values_list('pk', flat=True))
+		return [int(pk) for pk in self.path.split('/') if pk]
+	
+	def delete(self, *args, **kwargs):
+		'''Deletes the taxon, removing it from its ancestors' counts.'''
+		if app_settings.PHYLOGENY_TAXON_COUNTS:
+			self.update_ancestor_counts(-1)
+		super(Taxon, self).delete(*args, **kwargs)
+	
+	def update_ancestor_counts(self, sign):
+		'''
+		Adds (`sign` 1) or subtracts (`sign` -1) the taxon and its descendants
+		to or from the descendant and leaf counts of its ancestors with one
+		ancestor range update.  Call after the taxon is attached to a parent
+		(inserted or moved) or before it is detached (moved or deleted).
+		
+		A parent of which the taxon is the only child is, or was, a leaf node
+		itself, so its leaf is replaced rather than added to.
+		'''
+		node = Taxon.objects.filter(pk=self.pk).values('tree_id', 'lft', 'rght', 'leaf_count', 'parent')[0]
+		if node['parent'] is None:
+			return
+		parent = Taxon.objects.filter(pk=node['parent']).values('lft', 'rght')[0]
+		size = (node['rght'] - node['lft'] + 1) / 2
+		leaves = node['leaf_count']
+		if parent['rght'] - parent['lft'] == 2 * size + 1:
+			leaves -= 1
+		Taxon.objects.filter(tree_id=node['tree_id'], lft__lt=node['lft'], rght__gt=node['rght']).update(
+			descendant_count=F('descendant_count') + sign * size,
+			leaf_count=F('leaf_count') + sign * leaves
+		)
+	
 	def is_leaf_node(self):
 		return super(Taxon, self).is_leaf_node()
 	is_leaf_node.boolean = True
@@ -108,6 +217,8 @@ class Citation(models.Model):
 	url = models.URLField(_('URL'), verify_exists=False, max_length=512, blank=True)
 	doi = models.CharField(_(u'DOI\u00AE: digital object identifier'), max_length=256, blank=True)
 	taxon = models.ForeignKey(Taxon, verbose_name=_('taxon'))
+	# dates
+	date_modified = models.DateTimeField(_('date modified'), auto_now=True, null=True)
 	
 	class Meta:
 		verbose_name = _('citation')
@@ -126,6 +237,8 @@ class TaxonomyDatabase(models.Model):
 	name = models.CharField(_('taxonomy database name'), max_length=256, help_text=_('name of an external taxonomic database such as NCBI, ITIS, etc'))
 	slug = models.SlugField(_('slug'), unique=True, help_text=_('short label containing only letters, numbers, underscores, and/or hyphens; generally used in URLs'))
 	url = models.URLField(_('URL'), max_length=512)
+	# dates
+	date_modified = models.DateTimeField(_('date modified'), auto_now=True, null=True)
 	
 	# manager
 	objects = managers.TaxonomyDatabaseManager()
@@ -150,6 +263,8 @@ class TaxonomyRecord(models.Model):
 	database = models.ForeignKey(TaxonomyDatabase, verbose_name=_('taxonomy database'))
 	record_id = models.CharField(_('taxon record ID'), max_length=256, help_text=_('ID of this record in the specified taxonomic database'))
 	url = models.URLField(_('URL'), max_length=512, blank=True, help_text=_('URL of this record in the specified taxonomic database'))
+	# dates
+	date_modified = models.DateTimeField(_('date modified'), auto_now=True, null=True)
 	
 	# manager
 	objects = managers.TaxonomyRecordManager()
@@ -174,6 +289,8 @@ class DistributionPoint(models.Model):
 	latitude = models.FloatField(_('latitude'))
 	longitude = models.FloatField(_('longitude'))
 	taxon = models.ForeignKey(Taxon, verbose_name=_('taxon'))
+	# dates
+	date_modified = models.DateTimeField(_('date modified'), auto_now=True, null=True)
 	
 	# manager
 	objects = managers.DistributionPointManager()
@@ -241,6 +358,8 @@ class TaxaCategory(models.Model):
 	slug = models.SlugField(_('slug'), unique=True, help_text=_('short label containing only letters, numbers, underscores, and/or hyphens; generally used in URLs'))
 	description = models.TextField(_('description'), blank=True)
 	color = ColorField(_('color'), max_length=7)
+	# dates
+	date_modified = models.DateTimeField(_('date modified'), auto_now=True, null=True)
 	
 	# manager
 	objects = managers.TaxaCategoryManager()
@@ -255,3 +374,69 @@ class TaxaCategory(models.Model):
 	def natural_key(self):
 		return (self.slug,)
 
+
+class ImportJob(models.Model):
+	'''
+	Holds an uploaded phylogeny file queued for import in the background (see
+	jobs.py) and the outcome of the import.
+	'''
+	file = models.FileField(_('phylogeny file'), upload_to=app_settings.PHYLOGENY_IMPORT_JOB_UPLOAD_TO, max_length=512, blank=True)
+	file_format = models.CharField(_('format'), max_length=64, choices=app_settings.PHYLOGENY_IMPORT_FILE_FORMAT_CHOICES)
+	status = models.CharField(_('status'), max_length=16, choices=app_settings.IMPORT_JOB_STATUS_CHOICES, default='queued', db_index=True)
+	clade_count = models.PositiveIntegerField(_('clades processed'), default=0)
+	message = models.TextField(_('message'), blank=True)
+	taxon = models.ForeignKey(Taxon, verbose_name=_('root taxon'), null=True, blank=True, on_delete=models.SET_NULL)
+	# dates
+	date_created = models.DateTimeField(_('date created'), auto_now_add=True)
+	date_started = models.DateTimeField(_('date started'), null=True, blank=True)
+	date_finished = models.DateTimeField(_('date finished'), null=True, blank=True)
+	
+	class Meta:
+		verbose_name = _('import job')
+		verbose_name_plural = _('import jobs')
+	
+	def __unicode__(self):
+		return u'%s (%s)' % (self.file.name or self.pk, self.get_status_display(),)
+	
+	def is_finished(self):
+		return self.status in ('succeeded', 'failed',)
+	
+	def get_elapsed_time(self):
+		'''Returns the number of seconds the job has been running, or ran.'''
+		if self.date_started is None:
+			return 0.0
+		elapsed = (self.date_finished or timezone.now()) - self.date_started
+		return elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1000000.0
+
+
+def invalidate_export_cache(sender, **kwargs):
+	'''Invalidates cached exports when data written to exports changes.'''
+	from phylogeny.exporters import export_cache
+	export_cache.invalidate()
+
+for model in (Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint, TaxaCategory,):
+	signals.post_save.connect(invalidate_export_cache, sender=model, dispatch_uid='phylogeny_export_cache_%s_save' % model._meta.module_name)
+	signals.post_delete.connect(invalidate_export_cache, sender=model, dispatch_uid='phylogeny_export_cache_%s_delete' % model._meta.module_name)
+
+
+def invalidate_snapshots(sender, **kwargs):
+	'''Invalidates tree snapshots when taxa are written.'''
+	from phylogeny.snapshots import snapshot_cache
+	snapshot_cache.invalidate()
+
+signals.post_save.connect(invalidate_snapshots, sender=Taxon, dispatch_uid='phylogeny_snapshots_taxon_save')
+signals.post_delete.connect(invalidate_snapshots, sender=Taxon, dispatch_uid='phylogeny_snapshots_taxon_delete')
+
+
+def update_search_index(sender, instance, **kwargs):
+	'''Indexes saved taxa in the search index.'''
+	from phylogeny.search import search_index_cache
+	search_index_cache.update(taxon=instance)
+
+def remove_from_search_index(sender, instance, **kwargs):
+	'''Removes deleted taxa from the search index.'''
+	from phylogeny.search import search_index_cache
+	search_index_cache.update(pk=instance.pk)
+
+signals.post_save.connect(update_search_index, sender=Taxon, dispatch_uid='phylogeny_search_taxon_save')
+signals.post_delete.connect(remove_from_search_index, sender=Taxon, dispatch_uid='phylogeny_search_taxon_delete')
@@ -0,0 +1,262 @@
+'''
+Streaming phylogeny parsers read PhyloXML and Newick files clade by clade,
+without building the whole Biopython tree.
+
+Parsers yield clade events:  ('start', None) when a clade opens and ('end',
+clade) once the clade and its subtree have been read.  Clades carry their own
+data (name, branch length, taxonomies, ...) but no children, so memory is
+bounded by the depth of the tree rather than its size.  Only the first tree
+of a file is read.
+'''
+import re
+
+from Bio.Phylo import Newick, NewickIO, PhyloXMLIO
+from Bio.Phylo import PhyloXML as PX
+
+
+# helpers for clade data, parsed as by Biopython's private helpers (which
+# are not part of its API)
+
+def split_namespace(tag):
+	'''Returns the namespace and local name of an ElementTree tag.'''
+	if tag.startswith('{'):
+		return tuple(tag[1:].split('}', 1))
+	return '', tag
+
+
+def parse_float(text):
+	'''Returns text as a float, or None if it is missing or not a number.'''
+	try:
+		return float(text)
+	except (TypeError, ValueError):
+		return None
+
+
+def collapse_whitespace(text):
+	'''Collapses runs of whitespace into single spaces and strips text (None stays None).'''
+	if text is not None:
+		return u' '.join(text.split())
+
+
+def parse_confidence(text):
+	'''Returns a Newick label as a confidence value, or None if it is not a number.'''
+	if text.isdigit():
+		return int(text)
+	return parse_float(text)
+
+
+class StreamingPhyloXMLParser(PhyloXMLIO.Parser):
+	'''
+	Reads the clades of the first phylogeny of a PhyloXML file with
+	ElementTree's `iterparse`.  Clade data is parsed as by Biopython, with the
+	public element parsers of its PhyloXML parser and the parsing of
+	clades, taxonomies and sequences reimplemented here rather than taken
+	from its private methods.
+	'''
+	# clade elements read into lists of clade data, clade elements read with
+	# the parser method of the same name, and all the elements read as clade
+	# data
+	clade_list_types = {
+		'confidence': 'confidences',
+		'distribution': 'distributions',
+		'reference': 'references',
+		'property': 'properties',
+	}
+	clade_complex_types = ('color', 'events', 'binary_characters', 'date',)
+	clade_tracked_tags = frozenset(clade_list_types.keys() + list(clade_complex_types) + ['branch_length', 'name', 'node_id', 'width'])
+	
+	def new_clade(self, elem):
+		'''Returns a clade without children from the attributes of a clade element.'''
+		clade = PX.Clade(**elem.attrib)
+		if clade.branch_length is not None:
+			clade.branch_length = float(clade.branch_length)
+		return clade
+	
+	def parse_taxonomy(self, parent):
+		'''Returns the taxonomy of an opened taxonomy element, reading to its end.'''
+		taxonomy = PX.Taxonomy(**parent.attrib)
+		for event, elem in self.context:
+			namespace, tag = split_namespace(elem.tag)
+			if event != 'end':
+				continue
+			if tag == 'taxonomy':
+				parent.clear()
+				break
+			if tag in ('id', 'uri',):
+				setattr(taxonomy, tag, getattr(self, tag)(elem))
+			elif tag == 'common_name':
+				taxonomy.common_names.append(collapse_whitespace(elem.text))
+			elif tag == 'synonym':
+				taxonomy.synonyms.append(elem.text)
+			elif tag in ('code', 'scientific_name', 'authority', 'rank',):
+				setattr(taxonomy, tag, elem.text)
+			elif namespace != PhyloXMLIO.NAMESPACES['phy']:
+				taxonomy.other.append(self.other(elem, namespace, tag))
+				parent.clear()
+		return taxonomy
+	
+	def parse_sequence(self, parent):
+		'''Returns the sequence of an opened sequence element, reading to its end.'''
+		sequence = PX.Sequence(**parent.attrib)
+		for event, elem in self.context:
+			namespace, tag = split_namespace(elem.tag)
+			if event != 'end':
+				continue
+			if tag == 'sequence':
+				parent.clear()
+				break
+			if tag in ('accession', 'mol_seq', 'uri', 'domain_architecture',):
+				setattr(sequence, tag, getattr(self, tag)(elem))
+			elif tag == 'annotation':
+				sequence.annotations.append(self.annotation(elem))
+			elif tag == 'name':
+				sequence.name = collapse_whitespace(elem.text)
+			elif tag in ('symbol', 'location',):
+				setattr(sequence, tag, elem.text)
+			elif namespace != PhyloXMLIO.NAMESPACES['phy']:
+				sequence.other.append(self.other(elem, namespace, tag))
+				parent.clear()
+		return sequence
+	
+	def set_clade_data(self, clade, elem, namespace, tag):
+		'''Sets clade data from a closed child element of a clade element.'''
+		if tag in self.clade_list_types:
+			getattr(clade, self.clade_list_types[tag]).append(getattr(self, tag)(elem))
+		elif tag in self.clade_complex_types:
+			setattr(clade, tag, getattr(self, tag)(elem))
+		elif tag == 'branch_length':
+			if clade.branch_length is not None:
+				raise PhyloXMLIO.PhyloXMLError('Attribute branch_length was already set for this Clade.')
+			clade.branch_length = parse_float(elem.text)
+		elif tag == 'width':
+			clade.width = parse_float(elem.text)
+		elif tag == 'name':
+			clade.name = collapse_whitespace(elem.text)
+		elif tag == 'node_id':
+			clade.node_id = PX.Id(elem.text.strip(), elem.attrib.get('provider'))
+		elif namespace != PhyloXMLIO.NAMESPACES['phy']:
+			clade.other.append(self.other(elem, namespace, tag))
+			elem.clear()
+		else:
+			raise PhyloXMLIO.PhyloXMLError('Misidentified tag: ' + tag)
+	
+	def get_clade_events(self):
+		'''
+		Yields clade events for the first phylogeny.  Elements are cleared
+		once read, and the children of a clade element are dropped as each
+		child clade closes.
+		'''
+		for event, elem in self.context:
+			if event == 'start' and split_namespace(elem.tag)[1] == 'clade':
+				break
+		else:
+			raise PhyloXMLIO.PhyloXMLError('No clade found.')
+		yield 'start', None
+		# (clade, element, open tracked tags) of every open clade
+		stack = [(self.new_clade(elem), elem, [],)]
+		for event, elem in self.context:
+			namespace, tag = split_namespace(elem.tag)
+			clade, clade_elem, tag_stack = stack[-1]
+			if event == 'start':
+				if tag == 'clade':
+					stack.append((self.new_clade(elem), elem, [],))
+					yield 'start', None
+				elif tag == 'taxonomy':
+					clade.taxonomies.append(self.parse_taxonomy(elem))
+				elif tag == 'sequence':
+					clade.sequences.append(self.parse_sequence(elem))
+				elif tag in self.clade_tracked_tags:
+					tag_stack.append(tag)
+			elif tag == 'clade':
+				stack.pop()
+				elem.clear()
+				if stack:
+					# the parent's data elements were read when they closed
+					stack[-1][1].clear()
+				yield 'end', clade
+				if not stack:
+					return
+			elif tag_stack and tag == tag_stack[-1]:
+				tag_stack.pop()
+				self.set_clade_data(clade, elem, namespace, tag)
+		raise PhyloXMLIO.PhyloXMLError('Unexpected end of file.')
+
+
+# Newick tokens as read by Biopython, and whitespace
+newick_token = re.compile(r"\s+|[(),;]|\[(?:\\.|[^\]])*\]|'(?:\\.|[^'])*'|:\ ?[+-]?[0-9]*\.?[0-9]+(?:[eE][+-]?[0-9]+)?|[^\s()\[\]':;,]+")
+
+
+def tokenize_newick(handle, chunk_size=65536):
+	'''
+	Yields the tokens of a Newick file read `chunk_size` characters at a
+	time.  Whitespace is skipped.  A token is only taken once a few
+	characters follow it (or the file has ended), so tokens split between
+	chunks are read whole.
+	'''
+	buffer = ''
+	position = 0
+	end_of_file = False
+	while True:
+		match = newick_token.match(buffer, position)
+		if match is None or (not end_of_file and len(buffer) - match.end() < 3):
+			if end_of_file:
+				if position < len(buffer):
+					raise NewickIO.NewickError('Unexpected Newick text:  %s' % buffer[position:position + 20])
+				return
+			chunk = handle.read(chunk_size)
+			end_of_file = not chunk
+			buffer = buffer[position:] + chunk
+			position = 0
+			continue
+		position = match.end()
+		token = match.group()
+		if not token.isspace():
+			yield token
+
+
+def get_newick_clade_events(tokens):
+	'''
+	Yields clade events for the first tree of a sequence of Newick tokens.
+	Labels and branch lengths are read as by Biopython:  numeric labels of
+	internal clades are confidence values and comments are ignored.  The
+	tree must be enclosed in parentheses (or be a single clade).
+	'''
+	# [clade, has children] of every open clade
+	stack = [[Newick.Clade(), False]]
+	yield 'start', None
+	for token in tokens:
+		clade = stack[-1][0]
+		if token == '(':
+			stack[-1][1] = True
+			stack.append([Newick.Clade(), False])
+			yield 'start', None
+		elif token in (',', ')'):
+			if len(stack) == 1:
+				raise NewickIO.NewickError('Parenthesis mismatch.' if token == ')' else 'Streamed Newick trees must be enclosed in parentheses.')
+			yield 'end', close_newick_clade(*stack.pop())
+			if token == ',':
+				stack.append([Newick.Clade(), False])
+				yield 'start', None
+		elif token == ';':
+			break
+		elif token.startswith('['):
+			continue
+		elif token.startswith(':'):
+			clade.branch_length = float(token[1:])
+		elif token.startswith("'"):
+			clade.name = token[1:-1]
+		else:
+			clade.name = token
+	if len(stack) != 1:
+		raise NewickIO.NewickError('Number of open/close parentheses do not match.')
+	yield 'end', close_newick_clade(*stack.pop())
+
+
+def close_newick_clade(clade, has_children):
+	'''Returns a closed Newick clade, reading numeric internal labels as confidence values.'''
+	if clade.name and has_children:
+		confidence = parse_confidence(clade.name)
+		if confidence is not None:
+			clade.confidence = confidence
+			clade.name = None
+	return clade
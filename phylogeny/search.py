@@ -0,0 +1,487 @@
+'''
+Search indexes are in-process indexes of the names and descriptions of taxa
+for autocomplete, fuzzy matching of scientific names and full-text search,
+so that searches probe sorted arrays rather than scan the taxa table with
+`icontains` or `istartswith` lookups.
+
+Taxa are indexed by their names (`name` and `common_name`) and their text
+(`rank`, `description`, `ecology` and `distribution`), with the translation
+fields modeltranslation adds for them (see translation.py).  Text is
+normalized to lowercase without accents or punctuation.  Searches return the
+primary keys of taxa:
+
+	index = search_index_cache.get()
+	index.autocomplete(u'vesp')         # names starting with "vesp"
+	index.fuzzy(u'Vespa crabo')         # names within a few typos
+	index.search(u'european hornet')    # names and text
+	Taxon.objects.search(u'hornet')     # a queryset of the same taxa
+
+Get the current index from the process-wide `search_index_cache`.  The index
+is built from one query.  Saving or deleting a taxon updates the index of
+the process it is saved in, and increments a version counter (shared between
+processes through the cache set with `PHYLOGENY_SEARCH_CACHE`) so that other
+processes rebuild theirs on their next `get`.  Bulk writers, which write taxa
+without signals, invalidate the index.
+'''
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import chain, islice
+from threading import Lock
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from django.utils.encoding import force_unicode
+
+from phylogeny import app_settings
+from phylogeny.models import Taxon
+from phylogeny.snapshots import StringColumn
+from phylogeny.utils import SharedVersion
+
+
+# fields indexed as names and as text (with their translation fields)
+NAME_FIELDS = ('name', 'common_name',)
+TEXT_FIELDS = ('rank', 'description', 'ecology', 'distribution',)
+
+non_word_re = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize(text):
+	'''
+	Returns text in lowercase without accents, with runs of punctuation and
+	whitespace replaced by single spaces.
+	'''
+	text = unicodedata.normalize('NFKD', force_unicode(text or u''))
+	text = u''.join(character for character in text if not unicodedata.combining(character))
+	return non_word_re.sub(u' ', text.lower()).strip()
+
+
+def get_trigrams(key):
+	'''
+	Returns the trigrams of a normalized name, padded so that each letter
+	starts a trigram.
+	'''
+	key = u'$%s$' % key
+	return [key[start:start + 3] for start in xrange(len(key) - 2)]
+
+
+def get_edit_distance(a, b, max_distance):
+	'''
+	Returns the Levenshtein distance between two strings, or None if it is
+	greater than `max_distance`.  Only the cells of the distance matrix
+	within `max_distance` of its diagonal are computed.
+	'''
+	if abs(len(a) - len(b)) > max_distance:
+		return None
+	beyond = max_distance + 1
+	previous = range(len(b) + 1)
+	for i in xrange(1, len(a) + 1):
+		start = max(1, i - max_distance)
+		end = min(len(b), i + max_distance)
+		current = [beyond] * (len(b) + 1)
+		current[0] = i if i <= max_distance else beyond
+		character = a[i - 1]
+		for j in xrange(start, end + 1):
+			current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (character != b[j - 1]), beyond)
+		if min(current[start - 1:end + 1]) > max_distance:
+			return None
+		previous = current
+	if previous[-1] <= max_distance:
+		return previous[-1]
+
+
+def count_positions(postings, minimum):
+	'''
+	Returns the positions found in at least `minimum` of a list of posting
+	arrays (counted with NumPy if it is installed).
+	'''
+	postings = [positions for positions in postings if positions]
+	if not postings:
+		return []
+	if numpy is not None:
+		values, counts = numpy.unique(numpy.concatenate([numpy.frombuffer(positions, dtype=numpy.int32) for positions in postings]), return_counts=True)
+		return values[counts >= minimum].tolist()
+	counts = {}
+	for positions in postings:
+		for position in positions:
+			counts[position] = counts.get(position, 0) + 1
+	return [position for position, count in counts.iteritems() if count >= minimum]
+
+
+def get_indexed_fields(names):
+	'''
+	Returns the names of the fields of Taxon among `names` and of their
+	translation fields (added by modeltranslation, if installed).
+	'''
+	return [field.name for field in Taxon._meta.fields if getattr(field, 'translated_field', field).name in names]
+
+
+class PostingList(object):
+	'''
+	The sorted positions of the taxa matching a word (or words starting with
+	a prefix):  ranges of the positions array of a WordIndex.
+	'''
+	def __init__(self, positions, ranges):
+		self.positions = positions
+		self.ranges = [(start, end) for start, end in ranges if end > start]
+		self.size = sum(end - start for start, end in self.ranges)
+	
+	def __len__(self):
+		return self.size
+	
+	def __iter__(self):
+		'''Yields the positions in order (repeated if in several ranges).'''
+		if len(self.ranges) == 1:
+			start, end = self.ranges[0]
+			return iter(self.positions[start:end])
+		return merge(*[iter(self.positions[start:end]) for start, end in self.ranges])
+	
+	def __contains__(self, position):
+		for start, end in self.ranges:
+			index = bisect_left(self.positions, position, start, end)
+			if index < end and self.positions[index] == position:
+				return True
+		return False
+
+
+def intersect(posting_lists):
+	'''
+	Yields the positions in every posting list, in order, iterating over the
+	shortest and probing the others.
+	'''
+	posting_lists = sorted(posting_lists, key=len)
+	others = posting_lists[1:]
+	last = None
+	for position in posting_lists[0]:
+		if position != last:
+			for posting_list in others:
+				if position not in posting_list:
+					break
+			else:
+				yield position
+		last = position
+
+
+class WordIndex(object):
+	'''
+	Maps words to the sorted positions of the taxa containing them:  the
+	words are sorted in one string column and their positions concatenated
+	in one array.
+	'''
+	# number of words a prefix expands to at most
+	max_expansions = 100
+	
+	def __init__(self, postings):
+		'''Builds the index from a dictionary mapping words to sorted positions.'''
+		words = sorted(postings)
+		self.words = StringColumn(words)
+		self.offsets = array('i', [0])
+		self.positions = array('i')
+		for word in words:
+			self.positions.extend(postings[word])
+			self.offsets.append(len(self.positions))
+	
+	def get(self, word, prefix=False):
+		'''
+		Returns the posting list of a word, or of the first `max_expansions`
+		words (alphabetically) starting with it if `prefix` is true.
+		'''
+		index = bisect_left(self.words, word)
+		ranges = []
+		while index < len(self.words) and len(ranges) < self.max_expansions:
+			indexed_word = self.words[index]
+			if indexed_word != word and not (prefix and indexed_word.startswith(word)):
+				break
+			ranges.append((self.offsets[index], self.offsets[index + 1],))
+			index += 1
+		return PostingList(self.positions, ranges)
+
+
+class SearchSegment(object):
+	'''
+	Indexes a list of taxa by position:  their normalized scientific names
+	(sorted, for prefix lookups, and by trigram, for fuzzy matching) and the
+	words of their names and of all their indexed fields.
+	'''
+	# number of trigram postings beyond the minimum read for fuzzy matching
+	# (each required of candidates)
+	fuzzy_overlap = 5
+	
+	def __init__(self, documents=()):
+		'''
+		Builds the indexes from (pk, name, names, text) documents, where
+		`names` and `text` are sequences of the values of the name and text
+		fields of a taxon.
+		'''
+		self.pks = array('i')
+		keys = []
+		name_postings = {}
+		text_postings = {}
+		trigrams = {}
+		for position, (pk, name, names, text) in enumerate(documents):
+			self.pks.append(pk)
+			key = normalize(name)
+			keys.append(key)
+			name_words = set(normalize(u' '.join(value or u'' for value in names)).split())
+			for word in name_words:
+				name_postings.setdefault(word, array('i')).append(position)
+			for word in name_words.union(normalize(u' '.join(value or u'' for value in text)).split()):
+				text_postings.setdefault(word, array('i')).append(position)
+			for trigram in set(get_trigrams(key)):
+				trigrams.setdefault(trigram, array('i')).append(position)
+		
+		self.keys = StringColumn(keys)
+		self.lengths = array('i', (len(key) for key in keys))
+		order = sorted(xrange(len(keys)), key=keys.__getitem__)
+		self.sorted_keys = StringColumn(keys[index] for index in order)
+		self.sorted_positions = array('i', order)
+		self.names = WordIndex(name_postings)
+		self.text = WordIndex(text_postings)
+		self.trigrams = trigrams
+	
+	def __len__(self):
+		return len(self.pks)
+	
+	def get_prefix_positions(self, key):
+		'''
+		Yields the positions of the taxa whose normalized scientific names
+		start with a normalized prefix, alphabetically.
+		'''
+		index = bisect_left(self.sorted_keys, key)
+		while index < len(self.sorted_keys) and self.sorted_keys[index].startswith(key):
+			yield self.sorted_positions[index]
+			index += 1
+	
+	def match(self, word_index, words):
+		'''
+		Yields the positions of the taxa with every word in a word index,
+		the last as a prefix, in order.
+		'''
+		return intersect([word_index.get(word) for word in words[:-1]] + [word_index.get(words[-1], prefix=True)])
+	
+	def fuzzy(self, key, max_distance):
+		'''
+		Returns (distance, position) pairs for the taxa whose normalized
+		scientific names are within `max_distance` edits of a normalized name.
+		
+		An edit changes at most three trigrams, so a matching name has all
+		but `3 * max_distance` of the trigrams of the name:  candidates are
+		the positions in enough of the postings of its rarest trigrams
+		(`fuzzy_overlap` more than `3 * max_distance`), checked by length
+		before their edit distance is computed.  Names too short for that
+		many trigrams allow fewer edits.
+		'''
+		trigrams = set(get_trigrams(key))
+		max_distance = min(max_distance, (len(trigrams) - 1) // 3)
+		if max_distance <= 0:
+			return [(0, position) for position in self.get_prefix_positions(key) if self.keys[position] == key]
+		postings = sorted((self.trigrams.get(trigram, ()) for trigram in trigrams), key=len)[:3 * max_distance + self.fuzzy_overlap]
+		matches = []
+		for position in count_positions(postings, len(postings) - 3 * max_distance):
+			if abs(self.lengths[position] - len(key)) > max_distance:
+				continue
+			distance = get_edit_distance(key, self.keys[position], max_distance)
+			if distance is not None:
+				matches.append((distance, position,))
+		return matches
+
+
+class TaxonSearchIndex(object):
+	'''
+	Searches the names and descriptions of taxa.  Taxa are indexed in a main
+	segment, built in tree order, and a delta segment holding the taxa saved
+	since, which is rebuilt when it is next queried.  Taxa saved or deleted
+	since the main segment was built are skipped in it.
+	'''
+	def __init__(self, documents=()):
+		'''Builds the index from documents (see `get_document`) in tree order.'''
+		self.segment = SearchSegment(documents)
+		# primary keys of the taxa changed or deleted since the main segment
+		# was built, and the documents of those saved since
+		self.removed = set()
+		self.pending = {}
+		self._delta = None
+	
+	@classmethod
+	def get_fields(cls):
+		'''Returns the names of the name fields and text fields to index.'''
+		return ['name'] + get_indexed_fields(NAME_FIELDS[1:]), get_indexed_fields(TEXT_FIELDS)
+	
+	@classmethod
+	def get_document(cls, row, name_count):
+		'''
+		Returns the document of a taxon, (pk, name, names, text), from a row
+		of its primary key and the values of its name and text fields.
+		'''
+		return row[0], row[1], row[1:1 + name_count], row[1 + name_count:]
+	
+	@classmethod
+	def build(cls, queryset=None):
+		'''Builds an index of all taxa (or those of `queryset`) with one query.'''
+		if queryset is None:
+			queryset = Taxon.objects.all()
+		name_fields, text_fields = cls.get_fields()
+		rows = queryset.order_by('tree_id', 'lft').values_list('pk', *(name_fields + text_fields)).iterator()
+		return cls(cls.get_document(row, len(name_fields)) for row in rows)
+	
+	@property
+	def delta(self):
+		'''The segment of the taxa saved since the main segment was built.'''
+		if self._delta is None:
+			self._delta = SearchSegment(self.pending[pk] for pk in sorted(self.pending))
+		return self._delta
+	
+	def update(self, taxon):
+		'''Indexes a saved taxon.'''
+		name_fields, text_fields = self.get_fields()
+		self.removed.add(taxon.pk)
+		self.pending[taxon.pk] = self.get_document([taxon.pk] + [getattr(taxon, field) for field in name_fields + text_fields], len(name_fields))
+		self._delta = None
+	
+	def remove(self, pk):
+		'''Removes a deleted taxon.'''
+		self.removed.add(pk)
+		self.pending.pop(pk, None)
+		self._delta = None
+	
+	def get_pks(self, get_positions):
+		'''
+		Yields the primary keys of the taxa at the positions yielded by
+		`get_positions(segment)` in the main segment, then the delta segment.
+		'''
+		for segment, removed in ((self.segment, self.removed,), (self.delta, (),),):
+			for position in get_positions(segment):
+				pk = segment.pks[position]
+				if pk not in removed:
+					yield pk
+	
+	def autocomplete(self, query, limit=10):
+		'''
+		Returns the primary keys of up to `limit` taxa for a partial name:
+		first the taxa whose scientific names start with it, alphabetically,
+		then those whose names or common names have every word of it (the
+		last as a prefix), in tree order.
+		'''
+		key = normalize(query)
+		if not key:
+			return []
+		words = key.split()
+		pks = []
+		for pk in chain(self.get_pks(lambda segment: segment.get_prefix_positions(key)), self.get_pks(lambda segment: segment.match(segment.names, words))):
+			if pk not in pks:
+				pks.append(pk)
+				if len(pks) >= limit:
+					break
+		return pks
+	
+	def fuzzy(self, name, limit=10, max_distance=2):
+		'''
+		Returns the primary keys of up to `limit` taxa whose scientific names
+		are within `max_distance` edits (letters inserted, deleted or
+		replaced) of a name, closest first.
+		'''
+		key = normalize(name)
+		if not key:
+			return []
+		matches = []
+		for segment, removed in ((self.segment, self.removed,), (self.delta, (),),):
+			for distance, position in segment.fuzzy(key, max_distance):
+				if segment.pks[position] not in removed:
+					matches.append((distance, segment.keys[position], segment.pks[position],))
+		matches.sort()
+		return [pk for distance, key, pk in matches[:limit]]
+	
+	def search(self, query, limit=None):
+		'''
+		Returns the primary keys of the taxa (up to `limit`) with every word
+		of a query in their names or text, the last as a prefix, in tree
+		order (taxa saved since the index was built come last).
+		'''
+		words = normalize(query).split()
+		if not words:
+			return []
+		return list(islice(self.get_pks(lambda segment: segment.match(segment.text, words)), limit))
+
+
+class SearchIndexCache(object):
+	'''
+	Holds the search index of the process, rebuilding it when the version of
+	the indexed taxa changes.
+	
+	The version is a `SharedVersion` in the cache set with
+	`PHYLOGENY_SEARCH_CACHE` (None to only see changes made by this
+	process).  Taxa saved or deleted in this process update its index in
+	place and increment the version; if the version was incremented by
+	another process in the meantime, expired (or too many taxa were saved
+	since the index was built), the index is rebuilt.
+	'''
+	version_key = 'phylogeny:search:version'
+	# number of taxa saved since the index was built above which it is
+	# rebuilt rather than updated
+	max_pending = 10000
+	
+	def __init__(self, alias=None):
+		self.alias = alias or app_settings.PHYLOGENY_SEARCH_CACHE
+		self.shared_version = SharedVersion(self.version_key, self.alias)
+		self._index = None
+		self._version = None
+		self._lock = Lock()
+	
+	def get_version(self):
+		'''Returns the current version of the indexed taxa, or None if versions are not shared.'''
+		return self.shared_version.get()
+	
+	def increment_version(self):
+		'''
+		Increments the version and returns it, or None if versions are not
+		shared or the version was missing.
+		'''
+		return self.shared_version.increment()
+	
+	def invalidate(self):
+		'''Discards the indexes of all processes (for taxa written without signals).'''
+		with self._lock:
+			self._index = None
+		self.increment_version()
+	
+	def update(self, taxon=None, pk=None):
+		'''
+		Indexes a saved taxon, or removes the taxon with primary key `pk`, in
+		the index of this process (if it is current) and increments the
+		version.
+		'''
+		with self._lock:
+			version = self.increment_version()
+			if self._index is None:
+				return
+			if (self.shared_version.cache is not None and (version is None or version != self._version + 1)) or len(self._index.pending) >= self.max_pending:
+				self._index = None
+				return
+			if taxon is not None:
+				self._index.update(taxon)
+			else:
+				self._index.remove(pk)
+			if version is not None:
+				self._version = version
+	
+	def get(self):
+		'''
+		Returns the search index of the current version of the taxa,
+		building it if needed.  The version is read before building, so
+		changes made while building trigger another build.
+		'''
+		version = self.get_version()
+		with self._lock:
+			if self._index is None or self._version != version:
+				self._index = TaxonSearchIndex.build()
+				self._version = version
+			return self._index
+
+
+# holds the search index of the process
+search_index_cache = SearchIndexCache()
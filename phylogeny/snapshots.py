@@ -0,0 +1,372 @@
+'''
+Tree snapshots are read-only, in-memory copies of the taxa tree for read-heavy
+views.  A snapshot is built from one query and stores each column in a compact
+array rather than in model instances:  a 500,000 taxa tree takes tens of
+megabytes.
+
+Taxa are stored in depth-first order (by `tree_id` and `lft`), so the
+descendants of a taxon are the positions following it.  Child iteration uses
+first child and next sibling links; ancestor walks follow parent links.
+
+Get the current snapshot from the process-wide `snapshot_cache`:
+
+	snapshot = snapshot_cache.get()
+	vespidae = snapshot.get_node(slug='vespidae')
+	for child in vespidae.get_children():
+		...
+
+Saving, moving or deleting taxa increments a version counter (shared between
+processes through the cache set with `PHYLOGENY_SNAPSHOT_CACHE`) and the next
+`get` rebuilds the snapshot.
+'''
+from array import array
+from bisect import bisect_left
+from itertools import count
+from threading import Lock
+
+from phylogeny import app_settings
+from phylogeny.models import Taxon
+from phylogeny.utils import SharedVersion
+from phylogeny.exceptions import PhyloSnapshotTaxonNotFound
+
+
+class StringColumn(object):
+	'''
+	Stores strings as UTF-8 in one byte string with an array of offsets.
+	'''
+	def __init__(self, strings=()):
+		data = []
+		self.offsets = array('i', [0])
+		offset = 0
+		for string in strings:
+			encoded = (string or u'').encode('utf-8')
+			data.append(encoded)
+			offset += len(encoded)
+			self.offsets.append(offset)
+		self.data = ''.join(data)
+	
+	def __len__(self):
+		return len(self.offsets) - 1
+	
+	def __getitem__(self, index):
+		return self.data[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+
+class SnapshotNode(object):
+	'''
+	A taxon in a snapshot.  Provides the read-only MPTT methods of Taxon.
+	'''
+	__slots__ = ('snapshot', 'index',)
+	
+	def __init__(self, snapshot, index):
+		self.snapshot = snapshot
+		self.index = index
+	
+	def __repr__(self):
+		return '<SnapshotNode: %s>' % self.name.encode('utf-8')
+	
+	def __eq__(self, other):
+		return isinstance(other, SnapshotNode) and self.snapshot is other.snapshot and self.index == other.index
+	
+	def __ne__(self, other):
+		return not self == other
+	
+	def __hash__(self):
+		return hash((id(self.snapshot), self.index,))
+	
+	pk = property(lambda self: self.snapshot.pks[self.index])
+	tree_id = property(lambda self: self.snapshot.tree_ids[self.index])
+	lft = property(lambda self: self.snapshot.lfts[self.index])
+	rght = property(lambda self: self.snapshot.rghts[self.index])
+	level = property(lambda self: self.snapshot.levels[self.index])
+	name = property(lambda self: self.snapshot.names[self.index])
+	slug = property(lambda self: self.snapshot.slugs[self.index])
+	rank = property(lambda self: self.snapshot.ranks[self.index])
+	branch_length = property(lambda self: self.snapshot.get_branch_length(self.index))
+	
+	@property
+	def parent_id(self):
+		parent = self.snapshot.parents[self.index]
+		if parent >= 0:
+			return self.snapshot.pks[parent]
+	
+	def get_parent(self):
+		'''Returns the parent node, or None for a root.'''
+		parent = self.snapshot.parents[self.index]
+		if parent >= 0:
+			return SnapshotNode(self.snapshot, parent)
+	
+	def get_children(self):
+		'''Yields the child nodes.'''
+		for index in self.snapshot.get_child_indexes(self.index):
+			yield SnapshotNode(self.snapshot, index)
+	
+	def get_ancestors(self, include_self=False, ascending=False):
+		'''Returns the ancestor nodes, root first unless `ascending`.'''
+		ancestors = [SnapshotNode(self.snapshot, index) for index in self.snapshot.get_ancestor_indexes(self.index, include_self)]
+		if not ascending:
+			ancestors.reverse()
+		return ancestors
+	
+	def get_descendants(self, include_self=False):
+		'''Yields the descendant nodes in depth-first order.'''
+		start, end = self.snapshot.get_subtree_range(self.index)
+		if not include_self:
+			start += 1
+		for index in xrange(start, end):
+			yield SnapshotNode(self.snapshot, index)
+	
+	def get_descendant_count(self):
+		return (self.rght - self.lft - 1) / 2
+	
+	def get_leafnodes(self):
+		'''Yields the leaf nodes among the descendants.'''
+		for node in self.get_descendants():
+			if node.is_leaf_node():
+				yield node
+	
+	def is_leaf_node(self):
+		return self.snapshot.first_children[self.index] < 0
+	
+	def is_root_node(self):
+		return self.snapshot.parents[self.index] < 0
+	
+	def get_taxon(self):
+		'''Returns an unsaved Taxon instance with the node's fields.'''
+		return self.snapshot.get_taxon(self.index)
+
+
+class TaxonTreeSnapshot(object):
+	'''
+	A read-only copy of the taxa tree in parallel arrays, indexed by
+	depth-first position.
+	'''
+	# fields read from the database, in tree order
+	fields = ('pk', 'tree_id', 'lft', 'rght', 'level', 'name', 'slug', 'rank', 'branch_length',)
+	
+	def __init__(self, rows=()):
+		'''
+		Builds a snapshot from (pk, tree_id, lft, rght, level, name, slug,
+		rank, branch_length) rows ordered by `tree_id` and `lft`.  Parent,
+		child and sibling links are derived from the MPTT fields.
+		'''
+		# primary keys, tree fields and positions fit in 32 bit arrays
+		self.pks = array('i')
+		self.tree_ids = array('i')
+		self.lfts = array('i')
+		self.rghts = array('i')
+		self.levels = array('i')
+		self.branch_lengths = array('d')
+		self.parents = array('i')
+		self.first_children = array('i')
+		self.next_siblings = array('i')
+		names = []
+		slugs = []
+		ranks = []
+		
+		# ancestors of the current row as [index, index of last child]
+		stack = []
+		for index, (pk, tree_id, lft, rght, level, name, slug, rank, branch_length) in enumerate(rows):
+			while stack and (self.tree_ids[stack[-1][0]] != tree_id or self.rghts[stack[-1][0]] < lft):
+				stack.pop()
+			self.pks.append(pk)
+			self.tree_ids.append(tree_id)
+			self.lfts.append(lft)
+			self.rghts.append(rght)
+			self.levels.append(level)
+			# NaN stands for a missing branch length
+			self.branch_lengths.append(float('nan') if branch_length is None else branch_length)
+			self.first_children.append(-1)
+			self.next_siblings.append(-1)
+			names.append(name)
+			slugs.append(slug)
+			ranks.append(rank)
+			if stack:
+				parent = stack[-1]
+				self.parents.append(parent[0])
+				if parent[1] < 0:
+					self.first_children[parent[0]] = index
+				else:
+					self.next_siblings[parent[1]] = index
+				parent[1] = index
+			else:
+				self.parents.append(-1)
+			stack.append([index, -1])
+		
+		self.names = StringColumn(names)
+		self.slugs = StringColumn(slugs)
+		self.ranks = StringColumn(ranks)
+		
+		# sorted keys for lookups by primary key and (hashed) slug
+		order = sorted(xrange(len(self.pks)), key=self.pks.__getitem__)
+		self.pk_keys = array('i', (self.pks[index] for index in order))
+		self.pk_indexes = array('i', order)
+		slug_hashes = [hash(slug) for slug in slugs]
+		order = sorted(xrange(len(slug_hashes)), key=slug_hashes.__getitem__)
+		self.slug_keys = array('l', (slug_hashes[index] for index in order))
+		self.slug_indexes = array('i', order)
+	
+	@classmethod
+	def build(cls, queryset=None):
+		'''Builds a snapshot of all taxa (or those of `queryset`) with one query.'''
+		if queryset is None:
+			queryset = Taxon.objects.all()
+		return cls(queryset.order_by('tree_id', 'lft').values_list(*cls.fields).iterator())
+	
+	def __len__(self):
+		return len(self.pks)
+	
+	def get_branch_length(self, index):
+		branch_length = self.branch_lengths[index]
+		if branch_length == branch_length:
+			return branch_length
+	
+	def get_index(self, pk=None, slug=None):
+		'''
+		Returns the position of the taxon with primary key `pk` or slug `slug`.
+		Raises PhyloSnapshotTaxonNotFound if there is no such taxon.
+		'''
+		if slug is not None:
+			key = hash(slug)
+			position = bisect_left(self.slug_keys, key)
+			while position < len(self.slug_keys) and self.slug_keys[position] == key:
+				index = self.slug_indexes[position]
+				if self.slugs[index] == slug:
+					return index
+				position += 1
+		else:
+			position = bisect_left(self.pk_keys, pk)
+			if position < len(self.pk_keys) and self.pk_keys[position] == pk:
+				return self.pk_indexes[position]
+		raise PhyloSnapshotTaxonNotFound('Taxon %s not found in snapshot.' % (slug or pk))
+	
+	def get_node(self, pk=None, slug=None):
+		'''Returns the node of the taxon with primary key `pk` or slug `slug`.'''
+		return SnapshotNode(self, self.get_index(pk=pk, slug=slug))
+	
+	def get_root_nodes(self):
+		'''Yields the root node of each tree.'''
+		index = 0
+		while index < len(self.pks):
+			yield SnapshotNode(self, index)
+			index = self.get_subtree_range(index)[1]
+	
+	def get_child_indexes(self, index):
+		'''Yields the positions of the children of a taxon.'''
+		child = self.first_children[index]
+		while child >= 0:
+			yield child
+			child = self.next_siblings[child]
+	
+	def get_ancestor_indexes(self, index, include_self=False):
+		'''Yields the positions of the ancestors of a taxon, parent first.'''
+		if not include_self:
+			index = self.parents[index]
+		while index >= 0:
+			yield index
+			index = self.parents[index]
+	
+	def get_subtree_range(self, index):
+		'''
+		Returns the (start, end) positions of the subtree rooted on a taxon,
+		itself included.
+		'''
+		return index, index + (self.rghts[index] - self.lfts[index] + 1) / 2
+	
+	def get_taxon(self, index):
+		'''Returns an unsaved Taxon instance with the fields of a taxon.'''
+		parent = self.parents[index]
+		return Taxon(
+			id=self.pks[index],
+			parent_id=self.pks[parent] if parent >= 0 else None,
+			tree_id=self.tree_ids[index],
+			lft=self.lfts[index],
+			rght=self.rghts[index],
+			level=self.levels[index],
+			name=self.names[index],
+			slug=self.slugs[index],
+			rank=self.ranks[index],
+			branch_length=self.get_branch_length(index)
+		)
+	
+	def get_taxa(self, taxon, pruned=(), chunk_size=1000):
+		'''
+		Yields lists of up to `chunk_size` unsaved Taxon instances for the
+		phylogeny rooted on `taxon`, in depth-first order.  The descendants of
+		taxa whose primary keys are in `pruned` are skipped.
+		'''
+		index, end = self.get_subtree_range(self.get_index(pk=taxon.pk))
+		chunk = []
+		while index < end:
+			chunk.append(self.get_taxon(index))
+			if self.pks[index] in pruned:
+				index = self.get_subtree_range(index)[1]
+			else:
+				index += 1
+			if len(chunk) >= chunk_size:
+				yield chunk
+				chunk = []
+		if chunk:
+			yield chunk
+	
+	def export(self, format_name, pk=None, slug=None, pruning_filter=None):
+		'''
+		Exports the phylogeny rooted on a taxon with the exporter for
+		`format_name`, reading the tree from the snapshot.  Only the
+		snapshot's fields are exported from it; related records (taxonomies,
+		distribution points and citations) are still fetched in bulk.
+		'''
+		from phylogeny.exporters import exporter_registry
+		exporter = exporter_registry.get_by_format_name(format_name)
+		exporter.taxon = self.get_taxon(self.get_index(pk=pk, slug=slug))
+		exporter.pruning_filter = pruning_filter
+		exporter.snapshot = self
+		return exporter()
+
+
+class SnapshotCache(object):
+	'''
+	Holds the snapshot of the taxa tree for the process, rebuilding it when
+	the tree version changes.
+	
+	The version combines a counter in this process with a `SharedVersion` in
+	the cache set with `PHYLOGENY_SNAPSHOT_CACHE` (None to only see changes
+	made by this process).  Both are incremented whenever taxa are saved,
+	moved or deleted.
+	'''
+	version_key = 'phylogeny:snapshot:version'
+	
+	def __init__(self, alias=None):
+		self.alias = alias or app_settings.PHYLOGENY_SNAPSHOT_CACHE
+		self.shared_version = SharedVersion(self.version_key, self.alias)
+		self._local_versions = count()
+		self._local_version = self._local_versions.next()
+		self._snapshot = None
+		self._version = None
+		self._lock = Lock()
+	
+	def get_version(self):
+		'''Returns the current version of the taxa tree.'''
+		return (self._local_version, self.shared_version.get(),)
+	
+	def invalidate(self):
+		'''Starts a new version of the taxa tree.'''
+		self._local_version = self._local_versions.next()
+		self.shared_version.increment()
+	
+	def get(self):
+		'''
+		Returns the snapshot of the current version of the taxa tree,
+		building it if needed.  The version is read before building, so
+		changes made while building trigger another build.
+		'''
+		version = self.get_version()
+		with self._lock:
+			if self._snapshot is None or self._version != version:
+				self._snapshot = TaxonTreeSnapshot.build()
+				self._version = version
+			return self._snapshot
+
+
+# holds the snapshot of the taxa tree for the process
+snapshot_cache = SnapshotCache()
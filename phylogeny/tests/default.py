@@ -1,15 +1,41 @@
 '''
 Suite of tests for the Django Phylogeny app.
 '''
+import bz2
+import gzip
 import os
+import shutil
+import zlib
+from StringIO import StringIO
+from tempfile import mkdtemp
 
+from django.contrib import admin
+from django.core import serializers
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, get_commands
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from Bio import Phylo
 
 import phylogeny
-from phylogeny.models import Taxon, TaxonomyDatabase, TaxonomyRecord, DistributionPoint
-from phylogeny.exporters import exporter_registry, PhyloXMLPhyloExporter, NexusPhyloExporter, NewickPhyloExporter, JSPhyloSVGPhyloXMLPhyloExporter
+from phylogeny.admin import TaxonAdmin, TaxonChangeList
+from phylogeny.models import Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint, TaxaCategory, ImportJob
+from phylogeny.exporters import exporter_registry, export_cache, PhyloXMLPhyloExporter, NexusPhyloExporter, NewickPhyloExporter, JSPhyloSVGPhyloXMLPhyloExporter
+from phylogeny.views import PhylogenyExportView, PhylogenyAdminImportJobStatusView, TaxonAutocompleteView
+from phylogeny.jobs import ImportJobRunner
+from phylogeny.managers import NaturalKeyResolver, PATH_LENGTH
+from phylogeny.artifacts import ArtifactStore
+from phylogeny.snapshots import TaxonTreeSnapshot, snapshot_cache
+from phylogeny.search import TaxonSearchIndex, search_index_cache
+from phylogeny.metrics import TreeMetrics
+from phylogeny.columnar import ColumnarReader
+from phylogeny.utils import SlugAllocator, slugify_unique
 from phylogeny.importers import importer_registry, PhyloXMLPhyloImporter, NexusPhyloImporter, NewickPhyloImporter
-from phylogeny.exceptions import PhyloExporterUnsupportedTaxonAssignment, PhyloExporterRegistryOnlyClassesMayRegister, PhyloExporterRegistryClassAlreadyRegistered, PhyloExporterRegistryExporterNotFound, PhyloImporterRegistryOnlyClassesMayRegister, PhyloImporterRegistryClassAlreadyRegistered, PhyloImporterRegistryImporterNotFound, PhylogenyImportMergeConflict
+from phylogeny.parsers import tokenize_newick, split_namespace, parse_confidence
+from phylogeny.exceptions import PhyloExporterUnsupportedTaxonAssignment, PhyloExporterRegistryOnlyClassesMayRegister, PhyloExporterRegistryClassAlreadyRegistered, PhyloExporterRegistryExporterNotFound, PhyloImporterRegistryOnlyClassesMayRegister, PhyloImporterRegistryClassAlreadyRegistered, PhyloImporterRegistryImporterNotFound, PhylogenyImportMergeConflict, PhylogenyImportNameConflict, PhyloSnapshotTaxonNotFound, PhyloColumnarFileError
 
 
 class GeneralPhylogenyTestCase(TestCase):
@@ -32,6 +58,121 @@ class GeneralPhylogenyTestCase(TestCase):
 		self.assertEqual(self.first_taxon.name, 'Animalia')
 		self.assertEqual(self.last_taxon.name, 'Vespa crabro')
 	
+	def testLeafNodes(self):
+		# Taxon.objects is also the admin's default manager
+		self.assertEqual(Taxon._default_manager.leaf_nodes().get(), self.last_taxon)
+		self.assertEqual(set(self.taxa.non_leaf_nodes()), set(taxon for taxon in self.taxa if not taxon.is_leaf_node()))
+		# adding a child makes a leaf node a non-leaf node
+		Taxon.objects.create(name='Child', slug='child', parent=self.last_taxon)
+		self.assertEqual(Taxon.objects.non_leaf_nodes().count(), Taxon.objects.count() - 1)
+	
+	def testTreeQueries(self):
+		vespidae = Taxon.objects.get(name='Vespidae')
+		polistes = Taxon.objects.create(name='Polistes', slug='polistes', parent=vespidae)
+		Taxon.objects.create(name='Polistes dominula', slug='polistes-dominula', parent=polistes)
+		taxa = Taxon.objects.filter(name__in=('Polistes', 'Vespa crabro',))
+		# compare with the per-instance MPTT equivalents
+		def union(querysets):
+			return set(taxon for queryset in querysets for taxon in queryset)
+		ancestors = union(taxon.get_ancestors() for taxon in taxa)
+		with self.assertNumQueries(1):
+			self.assertEqual(set(Taxon.objects.ancestors_of(taxa)), ancestors)
+		self.assertEqual(set(Taxon.objects.descendants_of(taxa, include_self=True)), union(taxon.get_descendants(include_self=True) for taxon in taxa))
+		self.assertEqual(set(Taxon.objects.leaves_of([vespidae])), set(vespidae.get_leafnodes()))
+		self.assertEqual(Taxon.objects.leaves_of([]).count(), 0)
+		for taxon in Taxon.objects.with_descendant_counts():
+			self.assertEqual(taxon.num_descendants, taxon.get_descendant_count())
+			self.assertEqual(taxon.num_leaves, taxon.get_descendants(include_self=True).leaf_nodes().count())
+		with self.assertNumQueries(2):
+			self.assertEqual(Taxon.objects.lowest_common_ancestor(taxa), vespidae)
+		self.assertEqual(Taxon.objects.lowest_common_ancestor([polistes]), polistes)
+	
+	def testTaxonCounts(self):
+		def assertCounts():
+			for taxon in Taxon.objects.with_descendant_counts():
+				self.assertEqual((taxon.descendant_count, taxon.leaf_count,), (taxon.num_descendants, taxon.num_leaves,))
+		# fixtures are loaded without Taxon.save
+		Taxon.objects.recount()
+		assertCounts()
+		vespidae = Taxon.objects.get(name='Vespidae')
+		polistes = Taxon.objects.create(name='Polistes', slug='polistes', parent=self.last_taxon)
+		dominula = Taxon.objects.create(name='Polistes dominula', slug='polistes-dominula', parent=polistes)
+		assertCounts()
+		polistes.move_to(vespidae, 'last-child')
+		assertCounts()
+		Taxon.objects.get(pk=dominula.pk).delete()
+		assertCounts()
+		Taxon.objects.get(pk=polistes.pk).delete()
+		assertCounts()
+		# saving an instance loaded before its counts changed keeps them
+		vespa = Taxon.objects.get(name='Vespa')
+		Taxon.objects.create(name='Vespa velutina', slug='vespa-velutina', parent=vespa)
+		vespa.common_name = u'hornets'
+		vespa.save()
+		assertCounts()
+	
+	def testLineagePaths(self):
+		def assertPaths():
+			for taxon in Taxon.objects.all():
+				self.assertEqual(taxon.get_lineage_pks(), [ancestor.pk for ancestor in taxon.get_ancestors(include_self=True)])
+		# fixtures are loaded without Taxon.save
+		Taxon.objects.rebuild_paths()
+		assertPaths()
+		vespidae = Taxon.objects.get(name='Vespidae')
+		lineage = list(self.last_taxon.get_ancestors(include_self=True))
+		with self.assertNumQueries(2):
+			self.assertEqual(list(Taxon.objects.lineage_of('vespa-crabro')), lineage)
+		self.assertEqual(list(Taxon.objects.lineage_of(vespidae, include_self=False)), list(vespidae.get_ancestors()))
+		self.assertEqual(list(Taxon.objects.subtree_of(vespidae)), list(vespidae.get_descendants(include_self=True)))
+		self.assertEqual(list(Taxon.objects.subtree_of('vespidae', include_self=False)), list(vespidae.get_descendants()))
+		polistes = Taxon.objects.create(name='Polistes', slug='polistes', parent=self.last_taxon)
+		dominula = Taxon.objects.create(name='Polistes dominula', slug='polistes-dominula', parent=polistes)
+		assertPaths()
+		polistes.move_to(vespidae, 'last-child')
+		assertPaths()
+		# saving an instance loaded before its path changed keeps it
+		dominula.common_name = u'European paper wasp'
+		dominula.save()
+		assertPaths()
+		self.assertEqual(set(Taxon.objects.subtree_of(vespidae)), set(Taxon.objects.get(pk=vespidae.pk).get_descendants(include_self=True)))
+		
+		def assertLookups(*slugs):
+			paths = list(Taxon.objects.values_list('pk', 'path'))
+			Taxon.objects.rebuild_paths()
+			self.assertEqual(list(Taxon.objects.values_list('pk', 'path')), paths)
+			assertPaths()
+			for slug in slugs:
+				taxon = Taxon.objects.get(slug=slug)
+				self.assertEqual(list(Taxon.objects.lineage_of(slug)), list(taxon.get_ancestors(include_self=True)))
+				self.assertEqual(list(Taxon.objects.subtree_of(taxon)), list(taxon.get_descendants(include_self=True)))
+		# the paths of deep taxa are cut, and lookups from them use MPTT fields
+		parent = polistes
+		for level in range(100):
+			parent = Taxon.objects.create(name='Clade %d' % level, slug='clade-%d' % level, parent=parent)
+		self.assertEqual(len(Taxon.objects.get(slug='clade-99').path), PATH_LENGTH)
+		assertLookups('vespidae', 'clade-10', 'clade-90', 'clade-99')
+		# moving taxa with cut paths rebuilds them
+		Taxon.objects.get(slug='clade-50').move_to(vespidae)
+		assertLookups('vespidae', 'clade-49', 'clade-50', 'clade-99')
+	
+	def testTreeMetrics(self):
+		vespidae = Taxon.objects.get(name='Vespidae')
+		polistes = Taxon.objects.create(name='Polistes', slug='polistes', parent=vespidae, branch_length=2.0)
+		def get_distance_to_root(taxon):
+			return sum(ancestor.branch_length or 1.0 for ancestor in taxon.get_ancestors(include_self=True)[1:])
+		first_taxon = Taxon.objects.get(pk=self.first_taxon.pk)
+		with self.assertNumQueries(1):
+			metrics = TreeMetrics.for_taxon(first_taxon)
+		for taxon in Taxon.objects.all():
+			self.assertAlmostEqual(metrics.root_to_tip[metrics.get_index(taxon)], get_distance_to_root(taxon))
+		self.assertAlmostEqual(metrics.get_height(), max(get_distance_to_root(self.last_taxon), get_distance_to_root(polistes)))
+		self.assertAlmostEqual(metrics.get_distance(self.last_taxon, polistes), get_distance_to_root(self.last_taxon) + get_distance_to_root(polistes) - 2 * get_distance_to_root(vespidae))
+		self.assertAlmostEqual(metrics.get_distance(self.last_taxon, vespidae), get_distance_to_root(self.last_taxon) - get_distance_to_root(vespidae))
+		self.assertEqual(metrics.get_distance_matrix([self.last_taxon, polistes]).shape, (2, 2))
+		# metrics from a snapshot agree
+		snapshot_metrics = TreeMetrics.for_snapshot(TaxonTreeSnapshot.build(), pk=first_taxon.pk)
+		self.assertEqual(list(snapshot_metrics.root_to_tip), list(metrics.root_to_tip))
+	
 	def testCitations(self):
 		self.assertEqual(self.first_taxon.citation_set.count(), 1)
 		self.assertEqual(self.last_taxon.citation_set.count(), 1)
@@ -48,6 +189,23 @@ class GeneralPhylogenyTestCase(TestCase):
 		self.assertEqual(self.first_taxon.distributionpoint_set.get().latitude, 1)
 		self.assertEqual(self.first_taxon.distributionpoint_set.get().longitude, -1)
 	
+	def testSlugAllocation(self):
+		self.assertEqual(slugify_unique('Animalia', Taxon), 'animalia-1')
+		allocator = SlugAllocator(Taxon)
+		with self.assertNumQueries(1):
+			self.assertEqual(allocator.allocate('Animalia'), 'animalia-1')
+			self.assertEqual(allocator.allocate('Animalia'), 'animalia-2')
+		allocator.reserve('none-1')
+		self.assertEqual(allocator.allocate('none'), 'none')
+		self.assertEqual(allocator.allocate('none'), 'none-2')
+		# only the base and slugs continuing it with a hyphen are fetched
+		with self.assertNumQueries(1):
+			self.assertEqual(allocator.allocate('Vespa'), 'vespa-1')
+		self.assertFalse('vespa-crabro' in allocator.get_taken('vesp'))
+		self.assertEqual(allocator.get_taken('vespa'), set(['vespa', 'vespa-crabro']))
+		# values without slug characters are given the model name
+		self.assertEqual(allocator.allocate(u'???'), 'taxon')
+	
 	def testNaturalKeys(self):
 		for taxon in self.taxa:
 			self.assertEqual(Taxon.objects.get_by_natural_key(*taxon.natural_key()), taxon)
@@ -58,6 +216,137 @@ class GeneralPhylogenyTestCase(TestCase):
 		for distribution_point in self.distribution_points:
 			self.assertEqual(DistributionPoint.objects.get_by_natural_key(*distribution_point.natural_key()), distribution_point)
 	
+	def testStreamingDumpData(self):
+		stdout = StringIO()
+		call_command('dumpdata-phylogeny', 'phylogeny', use_natural_keys=True, chunk_size=5, stdout=stdout)
+		objects = simplejson.loads(stdout.getvalue())
+		# one object per line
+		self.assertEqual(len(stdout.getvalue().splitlines()), len(objects) + 2)
+		self.assertEqual(len(objects), sum(model.objects.count() for model in (Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint,)))
+		# taxa are dumped depth-first, parents before their children
+		slugs = set()
+		for fields in [obj['fields'] for obj in objects if obj['model'] == 'phylogeny.taxon']:
+			self.assertTrue(fields['parent'] is None or fields['parent'][0] in slugs)
+			slugs.add(fields['slug'])
+		self.assertEqual(len(slugs), self.taxa.count())
+	
+	def testNaturalKeyResolver(self):
+		stdout = StringIO()
+		call_command('dumpdata-phylogeny', 'phylogeny', use_natural_keys=True, stdout=stdout)
+		with NaturalKeyResolver():
+			# one query for the slugs of taxa and one for those of taxonomy databases
+			with self.assertNumQueries(2):
+				objects = list(serializers.deserialize('json', stdout.getvalue()))
+			self.assertEqual(TaxonomyRecord.objects.get_by_natural_key(*self.taxonomy_records[0].natural_key()), self.taxonomy_records[0])
+		for obj in objects:
+			original = obj.object.__class__.objects.get(pk=obj.object.pk)
+			for field in obj.object._meta.fields:
+				if field.rel:
+					self.assertEqual(getattr(obj.object, field.attname), getattr(original, field.attname))
+		self.assertEqual(NaturalKeyResolver.get_active('default'), None)
+		# loaddata is overridden to resolve natural keys with a resolver
+		self.assertEqual(get_commands()['loaddata'], 'phylogeny')
+		parents = list(self.taxa.values_list('slug', 'parent__slug'))
+		directory = mkdtemp()
+		try:
+			path = os.path.join(directory, 'phylogeny.json')
+			with open(path, 'w') as fixture:
+				fixture.write(stdout.getvalue())
+			Taxon.objects.all().delete()
+			call_command('loaddata', path, verbosity=0)
+		finally:
+			shutil.rmtree(directory)
+		self.assertEqual(list(self.taxa.values_list('slug', 'parent__slug')), parents)
+	
+	def testLoadData(self):
+		stdout = StringIO()
+		call_command('dumpdata-phylogeny', 'phylogeny', use_natural_keys=True, stdout=stdout)
+		objects = simplejson.loads(stdout.getvalue())
+		# fixtures are loaded without Taxon.save
+		Taxon.objects.recount()
+		Taxon.objects.rebuild_paths()
+		tree = list(Taxon.objects.values_list('slug', 'parent__slug', 'tree_id', 'lft', 'rght', 'level', 'path', 'descendant_count', 'leaf_count', 'date_created', 'date_modified'))
+		counts = [model.objects.count() for model in (Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint,)]
+		directory = mkdtemp()
+		try:
+			path = os.path.join(directory, 'phylogeny.json.gz')
+			fixture = gzip.open(path, 'wb')
+			fixture.write(stdout.getvalue())
+			fixture.close()
+			Taxon.objects.all().delete()
+			TaxonomyDatabase.objects.all().delete()
+			call_command('loaddata-phylogeny', path, batch_size=5, stdout=StringIO())
+			self.assertEqual([model.objects.count() for model in (Taxon, Citation, TaxonomyDatabase, TaxonomyRecord, DistributionPoint,)], counts)
+			self.assertEqual(list(Taxon.objects.values_list('slug', 'parent__slug', 'tree_id', 'lft', 'rght', 'level', 'path', 'descendant_count', 'leaf_count', 'date_created', 'date_modified')), tree)
+			
+			# inconsistent tree fields are rebuilt from parents, and existing objects overwritten
+			for obj in objects:
+				if obj['model'] == 'phylogeny.taxon':
+					obj['fields']['lft'] = obj['fields']['rght'] = obj['fields']['level'] = 0
+			path = os.path.join(directory, 'phylogeny.json')
+			with open(path, 'wb') as fixture:
+				simplejson.dump(objects, fixture)
+			stderr = StringIO()
+			call_command('loaddata-phylogeny', path, stdout=StringIO(), stderr=stderr)
+			self.assertTrue(stderr.getvalue())
+			self.assertEqual(Taxon.objects.find_tree_error(), None)
+			self.assertEqual(list(Taxon.objects.values_list('slug', 'parent__slug', 'tree_id', 'lft', 'rght', 'level', 'path', 'descendant_count', 'leaf_count', 'date_created', 'date_modified')), tree)
+		finally:
+			shutil.rmtree(directory)
+	
+	def testSearchIndex(self):
+		def get_slugs(pks):
+			slugs = dict(Taxon.objects.filter(pk__in=pks).values_list('pk', 'slug'))
+			return [slugs[pk] for pk in pks]
+		
+		index = TaxonSearchIndex.build()
+		# scientific names starting with the query first, then words of names and common names
+		self.assertEqual(get_slugs(index.autocomplete(u'Ves')), ['vespa', 'vespa-crabro', 'vespidae', 'vespoidea'])
+		self.assertEqual(get_slugs(index.autocomplete(u'paper WASP')), ['vespidae'])
+		self.assertEqual(get_slugs(index.autocomplete(u'crab', limit=1)), ['vespa-crabro'])
+		self.assertEqual(get_slugs(index.fuzzy(u'Vespa crabo')), ['vespa-crabro'])
+		self.assertEqual(get_slugs(index.fuzzy(u'Vespdae', limit=1)), ['vespidae'])
+		self.assertEqual(index.fuzzy(u'Vespa', max_distance=0), index.autocomplete(u'Vespa', limit=1))
+		self.assertEqual(get_slugs(index.search(u'european hornet')), ['vespa-crabro'])
+		self.assertEqual(get_slugs(index.search(u'wasp')), ['hymenoptera', 'vespoidea', 'vespidae', 'vespa-crabro'])
+		self.assertEqual(get_slugs(index.search(u'genus')), ['vespa'])
+		self.assertEqual(index.search(u'!'), [])
+		
+		# saved and deleted taxa update the index of the process in place
+		search_index_cache.invalidate()
+		index = search_index_cache.get()
+		taxon = Taxon.objects.get(slug='vespa')
+		taxon.common_name = u'Hornissen'
+		taxon.save()
+		self.assertTrue(search_index_cache.get() is index)
+		self.assertEqual(list(Taxon.objects.search(u'hornissen').values_list('slug', flat=True)), ['vespa'])
+		Taxon.objects.get(slug='vespa-crabro').delete()
+		self.assertTrue(search_index_cache.get() is index)
+		self.assertEqual(index.search(u'horn'), [Taxon.objects.get(slug='vespidae').pk, taxon.pk])
+		# changes made by other processes rebuild it
+		search_index_cache.increment_version()
+		self.assertFalse(search_index_cache.get() is index)
+		# as does a version which expired
+		index = search_index_cache.get()
+		search_index_cache.shared_version.cache.delete(search_index_cache.version_key)
+		Taxon.objects.get(slug='vespa').save()
+		self.assertFalse(search_index_cache.get() is index)
+		
+		# the admin change list applies list filters before the search limit
+		model_admin = TaxonAdmin(Taxon, admin.site)
+		model_admin.search_limit = 1
+		request = RequestFactory().get('/', {'q': u'wasp', 'leaf_node': 'no'})
+		changelist = TaxonChangeList(request, Taxon, model_admin.list_display, model_admin.list_display_links, model_admin.list_filter, model_admin.date_hierarchy, model_admin.search_fields, model_admin.list_select_related, model_admin.list_per_page, model_admin.list_max_show_all, model_admin.list_editable, model_admin)
+		self.assertEqual([taxon.slug for taxon in changelist.result_list], ['hymenoptera'])
+		request = RequestFactory().get('/', {'q': u'horn', 'leaf_node': 'yes'})
+		changelist = TaxonChangeList(request, Taxon, model_admin.list_display, model_admin.list_display_links, model_admin.list_filter, model_admin.date_hierarchy, model_admin.search_fields, model_admin.list_select_related, model_admin.list_per_page, model_admin.list_max_show_all, model_admin.list_editable, model_admin)
+		self.assertEqual([taxon.slug for taxon in changelist.result_list], ['vespa'])
+		
+		response = TaxonAutocompleteView.as_view()(RequestFactory().get('/', {'q': u'Vespa crabo'}))
+		self.assertEqual(simplejson.loads(response.content), [])
+		response = TaxonAutocompleteView.as_view()(RequestFactory().get('/', {'q': u'vespid'}))
+		self.assertEqual(simplejson.loads(response.content), [{'name': 'Vespidae', 'slug': 'vespidae', 'common_name': 'hornets, paper wasps, potter wasps, yellowjackets'}])
+	
 
 class PhyloExporterTestCase(TestCase):
 	'''Tests phylogeny exporters.'''
@@ -133,6 +422,214 @@ class PhyloExporterTestCase(TestCase):
 		self.assertEqual(self.newick_exporter.export_to, '/export/')
 		self.assertEqual(self.js_phylo_exporter.export_to, '/export/')
 	
+	def testExporterQueryCount(self):
+		# taxa, taxonomy records, taxonomy databases, distribution points and
+		# citations are each fetched once regardless of the size of the tree
+		with self.assertNumQueries(5):
+			self.phyloxml_exporter.get_object()
+	
+	def testPruningFilter(self):
+		self.phyloxml_exporter.pruning_filter = {'name': 'Vespidae'}
+		# one more query finds the pruned taxa; nothing is deleted
+		with self.assertNumQueries(6):
+			phylogeny = self.phyloxml_exporter.get_object()
+		self.assertEqual(len(list(phylogeny.find_clades())), 11)
+		self.assertEqual(phylogeny.get_terminals()[0].name, 'Vespidae')
+		self.assertEqual(Taxon.objects.count(), 13)
+	
+	def testStreamingExporters(self):
+		for exporter in (self.phyloxml_exporter, self.newick_exporter,):
+			exporter.pruning_filter = {'name': 'Vespa'}
+			expected_names = [clade.name for clade in exporter.get_object().find_clades()]
+			# page through the taxa a few at a time
+			exporter.chunk_size = 4
+			output = StringIO()
+			exporter.write(output)
+			output.seek(0)
+			phylogeny = Phylo.read(output, exporter.format_name)
+			self.assertEqual([clade.name for clade in phylogeny.find_clades()], expected_names)
+			self.assertEqual(phylogeny.get_terminals()[0].name, 'Vespa')
+	
+	def testJSPhyloSVGRenderers(self):
+		# the compiled renderer writes all clades from a single query
+		with self.assertNumQueries(2):
+			compiled_output = self.js_phylo_exporter()
+		self.assertEqual(compiled_output, self.expected_js_phylo_string.decode('utf-8'))
+		self.js_phylo_exporter.use_templates = True
+		self.assertEqual(self.js_phylo_exporter(), compiled_output)
+	
+	def testExportCache(self):
+		output = export_cache.export(self.newick_exporter)
+		# cached exports cost one aggregate query
+		with self.assertNumQueries(1):
+			self.assertEqual(export_cache.export(self.newick_exporter), output)
+		# pruning filters are part of the cache key
+		self.newick_exporter.pruning_filter = {'name': 'Vespidae'}
+		self.assertNotEqual(export_cache.export(self.newick_exporter), output)
+		self.newick_exporter.pruning_filter = None
+		# saving related data invalidates cached exports
+		Citation.objects.create(taxon=self.first_taxon, description='Description')
+		with self.assertNumQueries(6):
+			export_cache.export(self.newick_exporter)
+		generation = export_cache.get_generation()
+		TaxaCategory.objects.create(name='Wasps', slug='wasps', color='#ffcc00')
+		self.assertNotEqual(export_cache.get_generation(), generation)
+		# a generation which expired starts again from a new value
+		generation = export_cache.get_generation()
+		export_cache.cache.delete(export_cache.generation_key)
+		self.assertFalse(export_cache.get_generation() in (0, 1, generation,))
+	
+	def testTreeSnapshot(self):
+		with self.assertNumQueries(1):
+			snapshot = TaxonTreeSnapshot.build()
+		self.assertEqual(len(snapshot), self.taxa.count())
+		vespidae = Taxon.objects.get(name='Vespidae')
+		node = snapshot.get_node(slug='vespidae')
+		self.assertEqual((node.pk, node.name, node.lft, node.rght,), (vespidae.pk, vespidae.name, vespidae.lft, vespidae.rght,))
+		self.assertEqual([child.pk for child in node.get_children()], [child.pk for child in vespidae.get_children()])
+		self.assertEqual([ancestor.pk for ancestor in node.get_ancestors()], [ancestor.pk for ancestor in vespidae.get_ancestors()])
+		self.assertEqual([taxon.pk for taxon in snapshot.get_node(pk=self.first_taxon.pk).get_descendants()], [taxon.pk for taxon in self.first_taxon.get_descendants()])
+		self.assertRaises(PhyloSnapshotTaxonNotFound, snapshot.get_node, slug='missing')
+		self.assertEqual(snapshot.export('newick', slug=self.first_taxon.slug), self.newick_exporter())
+		# the process-wide snapshot is rebuilt once taxa are written
+		snapshot = snapshot_cache.get()
+		self.assertTrue(snapshot_cache.get() is snapshot)
+		Taxon.objects.create(name='Polistes', slug='polistes', parent=vespidae)
+		self.assertEqual(len(snapshot_cache.get()), len(snapshot) + 1)
+		# a shared version which expired never returns to an earlier value
+		snapshot = snapshot_cache.get()
+		version = snapshot_cache.get_version()
+		snapshot_cache.shared_version.cache.delete(snapshot_cache.version_key)
+		self.assertNotEqual(snapshot_cache.get_version(), version)
+		self.assertFalse(snapshot_cache.get() is snapshot)
+	
+	def setLastModifiedInPast(self):
+		'''Dates the last change to exported data a minute ago.'''
+		export_cache.cache.set(export_cache.modified_key, export_cache.modified.get() - 60 * 1000000)
+	
+	def testConditionalExport(self):
+		view = PhylogenyExportView.as_view()
+		request_factory = RequestFactory()
+		self.setLastModifiedInPast()
+		response = view(request_factory.get('/'), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 200)
+		# unchanged phylogenies cost the taxon lookup and one aggregate query
+		with self.assertNumQueries(2):
+			response = view(request_factory.get('/', HTTP_IF_NONE_MATCH=response['ETag']), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 304)
+		last_modified = response['Last-Modified']
+		response = view(request_factory.get('/', HTTP_IF_MODIFIED_SINCE=last_modified), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 304)
+		etag = response['ETag']
+		# pruned exports and changed phylogenies have other ETags
+		response = view(request_factory.get('/', {'rank_filter': 'family'}, HTTP_IF_NONE_MATCH=etag), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 200)
+		DistributionPoint.objects.create(taxon=self.first_taxon, latitude=2.0, longitude=2.0)
+		response = view(request_factory.get('/', HTTP_IF_NONE_MATCH=etag), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 200)
+		response = view(request_factory.get('/', HTTP_IF_MODIFIED_SINCE=last_modified), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 200)
+		# modifications are dated once their second is over
+		self.assertFalse(response.has_header('Last-Modified'))
+		# as are taxonomy databases and taxa categories, without writing taxa
+		taxa = list(Taxon.objects.values_list('pk', 'date_modified'))
+		for model in (TaxonomyDatabase, TaxaCategory,):
+			self.setLastModifiedInPast()
+			etag = view(request_factory.get('/'), slug=self.first_taxon.slug, ext='tree')['ETag']
+			if model is TaxaCategory:
+				Taxon.objects.filter(pk=self.first_taxon.pk).update(category=TaxaCategory.objects.create(name='Wasps', slug='wasps', color='#ffcc00'))
+				self.setLastModifiedInPast()
+				etag = view(request_factory.get('/'), slug=self.first_taxon.slug, ext='tree')['ETag']
+			model.objects.all()[0].save()
+			response = view(request_factory.get('/', HTTP_IF_NONE_MATCH=etag), slug=self.first_taxon.slug, ext='tree')
+			self.assertEqual(response.status_code, 200)
+		self.assertEqual(list(Taxon.objects.values_list('pk', 'date_modified')), taxa)
+	
+	def testConditionalExportAfterDeletion(self):
+		view = PhylogenyExportView.as_view()
+		request_factory = RequestFactory()
+		self.setLastModifiedInPast()
+		response = view(request_factory.get('/'), slug=self.first_taxon.slug, ext='tree')
+		etag, last_modified = response['ETag'], response['Last-Modified']
+		# deletions change the ETag and date the phylogeny from the last
+		# change to exported data
+		Citation.objects.filter(taxon=self.first_taxon).delete()
+		response = view(request_factory.get('/', HTTP_IF_NONE_MATCH=etag), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 200)
+		self.first_taxon.get_leafnodes()[0].delete()
+		response = view(request_factory.get('/', HTTP_IF_MODIFIED_SINCE=last_modified), slug=self.first_taxon.slug, ext='tree')
+		self.assertEqual(response.status_code, 200)
+	
+	def testArtifacts(self):
+		root = mkdtemp()
+		try:
+			artifact_store = ArtifactStore(artifacts={self.first_taxon.slug: ('newick',)}, root=os.path.join(root, 'exports'))
+			self.assertFalse(artifact_store.is_fresh(self.newick_exporter))
+			artifact_store.materialize(self.newick_exporter)
+			self.assertTrue(artifact_store.is_fresh(self.newick_exporter))
+			# freshness does not depend on the export cache generation of a process
+			export_cache.invalidate()
+			self.assertTrue(artifact_store.is_fresh(self.newick_exporter))
+			with open(artifact_store.get_path(self.newick_exporter), 'r') as f:
+				self.assertEqual(f.read(), self.newick_exporter())
+			# only the artifact and its digest are left behind
+			self.assertEqual(len(os.listdir(artifact_store.root)), 2)
+			# pruned phylogenies and other formats are exported live
+			self.assertFalse(artifact_store.is_listed(self.phyloxml_exporter))
+			self.newick_exporter.pruning_filter = {'name': 'Vespidae'}
+			self.assertFalse(artifact_store.is_listed(self.newick_exporter))
+			self.newick_exporter.pruning_filter = None
+			# changes make artifacts stale
+			DistributionPoint.objects.create(taxon=self.first_taxon, latitude=2.0, longitude=2.0)
+			self.assertFalse(artifact_store.is_fresh(self.newick_exporter))
+		finally:
+			shutil.rmtree(root)
+	
+	def testColumnarSnapshot(self):
+		def get_tree():
+			fields = [field.name for field in Taxon._meta.local_fields if field.name not in ('id', 'parent', 'category', 'tree_id', 'path',)]
+			return list(Taxon.objects.order_by('lft').values_list('parent__slug', 'category__slug', *fields))
+		def get_related():
+			return (
+				list(Citation.objects.order_by('taxon__lft', 'pk').values_list('taxon__slug', 'description', 'url', 'doi')),
+				list(TaxonomyRecord.objects.order_by('taxon__lft', 'pk').values_list('taxon__slug', 'database__slug', 'record_id', 'url')),
+				list(DistributionPoint.objects.order_by('taxon__lft', 'pk').values_list('taxon__slug', 'place_name', 'latitude', 'longitude')),
+			)
+		
+		# fixtures are loaded without Taxon.save
+		Taxon.objects.recount()
+		exporter = exporter_registry.get_by_format_name('columnar')
+		exporter.taxon = self.first_taxon
+		exporter.chunk_size = 5
+		content = exporter()
+		tree = get_tree()
+		related = get_related()
+		self.assertEqual(importer_registry.sniff_format_name(StringIO(content)), 'columnar')
+		Taxon.objects.all().delete()
+		TaxonomyDatabase.objects.all().delete()
+		importer = importer_registry.get_by_format_name('columnar')
+		importer.bulk_batch_size = 5
+		root = importer.save(import_from=StringIO(content))
+		self.assertEqual(get_tree(), tree)
+		self.assertEqual(get_related(), related)
+		self.assertEqual(root.get_lineage_pks(), [root.pk])
+		self.assertEqual(Taxon.objects.find_tree_error(), None)
+		# files on disk are mapped into memory
+		directory = mkdtemp()
+		try:
+			exporter.save(os.path.join(directory, 'phylogeny.phylocol'))
+			self.assertRaises(PhylogenyImportMergeConflict, importer.save, os.path.join(directory, 'phylogeny.phylocol'))
+			self.assertEqual(Taxon.objects.count(), len(tree))
+		finally:
+			shutil.rmtree(directory)
+		
+		# pruned subtrees are left out
+		exporter.taxon = root
+		exporter.pruning_filter = {'slug': 'vespidae'}
+		reader = ColumnarReader(StringIO(exporter()))
+		self.assertEqual(reader.get_count('taxa'), len(tree) - 2)
+		self.assertRaises(PhyloColumnarFileError, ColumnarReader, StringIO('(A,B)C;'))
+	
 	def testXMLExporterOutput(self):
 		self.assertEqual('%s' % self.phyloxml_exporter(), '%s' % self.expected_phyloxml_string)
 		self.assertEqual('%s' % self.nexus_exporter(), '%s' % self.expected_nexus_string)
@@ -203,6 +700,141 @@ class PhyloImporterTestCase(TestCase):
 		self.newick_importer.save()
 		self.assertEqual(Taxon.objects.count(), 13)
 	
+	def testBulkPhyloXMLImport(self):
+		self.phyloxml_importer.bulk = True
+		self.phyloxml_importer.import_from = self.phyloxml_path
+		self.phyloxml_importer.save()
+		root = Taxon.objects.get(slug='animalia')
+		leaf = Taxon.objects.get(slug='vespa-crabro')
+		self.assertEqual(Taxon.objects.count(), 13)
+		self.assertTrue(root.is_root_node())
+		self.assertEqual(root.get_descendant_count(), 12)
+		self.assertTrue(leaf.is_leaf_node())
+		self.assertEqual(leaf.level, 12)
+		self.assertEqual(leaf.parent.slug, 'vespa')
+		self.assertEqual([taxon.name for taxon in leaf.get_ancestors()][:2], ['Animalia', 'Arthropoda'])
+		self.assertEqual(TaxonomyRecord.objects.count(), 13)
+		self.assertEqual(DistributionPoint.objects.get().taxon, root)
+		self.assertEqual(leaf.citation_set.count(), 1)
+	
+	def testNameConflictScan(self):
+		def import_duplicate_names():
+			self.newick_importer.save(import_from=StringIO('((Vespa,Polistes)Vespidae,Vespa)Vespoidea;'))
+		
+		self.assertRaises(PhylogenyImportNameConflict, import_duplicate_names)
+		self.assertEqual(Taxon.objects.count(), 0)
+	
+	def testBulkNewickImport(self):
+		self.newick_importer.bulk = True
+		self.newick_importer.bulk_batch_size = 5
+		self.newick_importer.import_from = self.newick_path
+		self.newick_importer.save()
+		root = Taxon.objects.get(parent=None)
+		self.assertEqual(Taxon.objects.count(), 13)
+		self.assertEqual(root.get_descendant_count(), 12)
+		self.assertTrue(Taxon.objects.get(level=12).is_leaf_node())
+	
+	def testStreamingImport(self):
+		def get_tree():
+			return list(Taxon.objects.order_by('lft').values_list('name', 'lft', 'rght', 'level', 'branch_length', 'descendant_count', 'leaf_count', 'path'))
+		
+		for importer_class, path in ((PhyloXMLPhyloImporter, self.phyloxml_path,), (NewickPhyloImporter, self.newick_path,),):
+			importer_class(bulk=True).save(import_from=path)
+			expected = [row[:-1] for row in get_tree()]
+			records = (TaxonomyRecord.objects.count(), DistributionPoint.objects.count(), Citation.objects.count(),)
+			Taxon.objects.all().delete()
+			importer = importer_class(stream=True, import_from=path)
+			self.assertEqual(importer.phylogeny, None)
+			root = importer.save()
+			self.assertEqual([row[:-1] for row in get_tree()], expected)
+			self.assertEqual((TaxonomyRecord.objects.count(), DistributionPoint.objects.count(), Citation.objects.count(),), records)
+			self.assertEqual(root.get_lineage_pks(), [root.pk])
+			Taxon.objects.all().delete()
+		
+		# tokens split between chunks are read whole
+		newick = "((Vespa:0.25,'Polistes dominula':1.5e-3)[comment]Vespidae:12.5)Vespoidea;"
+		self.assertEqual(list(tokenize_newick(StringIO(newick), chunk_size=2)), list(tokenize_newick(StringIO(newick))))
+		# clade data is parsed without Biopython's private helpers
+		self.assertEqual(split_namespace('{http://www.phyloxml.org}clade'), ('http://www.phyloxml.org', 'clade',))
+		self.assertEqual(split_namespace('clade'), ('', 'clade',))
+		self.assertEqual([parse_confidence(label) for label in ('95', '0.9', 'Vespidae',)], [95, 0.9, None])
+		self.assertRaises(PhylogenyImportMergeConflict, NewickPhyloImporter(stream=True).save, StringIO('((Vespa,Polistes)Vespidae,Vespa)Vespoidea;'))
+		self.assertEqual(Taxon.objects.count(), 0)
+	
+	def testImportCommand(self):
+		directory = mkdtemp()
+		try:
+			for name, newick in (('a.tree', '((Vespa,Polistes)Vespidae)Vespoidea;'), ('b.tree', '(Apis,Bombus)Apidae;'), ('c.tree', '(Apis;'),):
+				with open(os.path.join(directory, name), 'w') as open_file:
+					open_file.write(newick)
+			# bad files are reported (and the command exits with an error) without
+			# aborting the batch
+			stdout = StringIO()
+			self.assertRaises(SystemExit, call_command, 'import-phylogeny', os.path.join(directory, '*.tree'), format='newick', stdout=stdout, stderr=StringIO())
+			self.assertEqual(Taxon.objects.filter(parent=None).count(), 2)
+			self.assertTrue('Imported 2 of 3 files' in stdout.getvalue())
+			# files parsed in worker processes are written in bulk
+			Taxon.objects.all().delete()
+			self.assertRaises(SystemExit, call_command, 'import-phylogeny', directory, format='newick', processes=2, stdout=StringIO(), stderr=StringIO())
+			self.assertEqual(sorted(Taxon.objects.filter(parent=None).values_list('slug', flat=True)), ['apidae', 'vespoidea'])
+			self.assertEqual(Taxon.objects.count(), 7)
+		finally:
+			shutil.rmtree(directory)
+	
+	def testImportJobs(self):
+		directory = mkdtemp()
+		file_field = ImportJob._meta.get_field('file')
+		storage, file_field.storage = file_field.storage, FileSystemStorage(location=directory)
+		try:
+			runner = ImportJobRunner()
+			job = runner.create(SimpleUploadedFile('a.tree', '((Vespa,Polistes)Vespidae)Vespoidea;'), 'newick')
+			conflicting_job = runner.create(SimpleUploadedFile('b.tree', '(Vespa,Apis)Apidae;'), 'newick')
+			self.assertEqual(runner.get_status(job)['status'], 'queued')
+			self.assertEqual([queued_job.status for queued_job in runner.run_queued()], ['succeeded', 'failed'])
+			# jobs run once
+			self.assertEqual(runner.run(job.pk), None)
+			
+			response = PhylogenyAdminImportJobStatusView.as_view()(RequestFactory().get('/'), pk=job.pk)
+			status = simplejson.loads(response.content)
+			self.assertEqual((status['status'], status['finished'], status['clade_count'], status['taxon'],), ('succeeded', True, 4, 'vespoidea',))
+			status = runner.get_status(ImportJob.objects.get(pk=conflicting_job.pk))
+			self.assertEqual(status['status'], 'failed')
+			self.assertTrue('"Vespa" already exists' in status['message'])
+			self.assertEqual(Taxon.objects.count(), 4)
+			# uploads are deleted once imported
+			self.assertEqual([names for path, directories, names in os.walk(directory) if names], [])
+		finally:
+			file_field.storage = storage
+			shutil.rmtree(directory)
+	
+	def testCompressedUploads(self):
+		def compress(path, compressor):
+			with open(path, 'rb') as open_file:
+				return compressor.compress(open_file.read()) + compressor.flush()
+		
+		for header, format_name in (('<?xml version="1.0"?>', 'phyloxml',), ('  #nexus', 'nexus',), ('[&R] ((A,B),C);', 'newick',), ('A B C', None,),):
+			self.assertEqual(importer_registry.sniff_format_name(StringIO(header)), format_name)
+		
+		directory = mkdtemp()
+		file_field = ImportJob._meta.get_field('file')
+		storage, file_field.storage = file_field.storage, FileSystemStorage(location=directory)
+		try:
+			runner = ImportJobRunner()
+			# formats are detected after decompression, whatever the form says
+			for name, content, format_name in (
+				('tree.xml.gz', compress(self.phyloxml_path, zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)), 'phyloxml',),
+				('tree.nex.bz2', compress(self.nexus_path, bz2.BZ2Compressor()), 'nexus',),
+			):
+				job = runner.create(SimpleUploadedFile(name, content), 'newick')
+				self.assertEqual(job.file_format, format_name)
+				job = runner.run(job.pk)
+				self.assertEqual((job.status, job.clade_count,), ('succeeded', 13,))
+				self.assertEqual(Taxon.objects.count(), 13)
+				Taxon.objects.all().delete()
+		finally:
+			file_field.storage = storage
+			shutil.rmtree(directory)
+	
 
 class PhyloImporterRegistryTestCase(TestCase):
 	'''Tests phylogeny importer registry.'''
@@ -227,9 +859,14 @@ class PhyloImporterRegistryTestCase(TestCase):
 		def import_conflict():
 			importer = PhyloXMLPhyloImporter(import_from=self.phyloxml_path)
 			importer.save()
+		def bulk_import_conflict():
+			importer = PhyloXMLPhyloImporter(import_from=self.phyloxml_path, bulk=True)
+			importer.save()
 		
 		self.assertRaises(PhyloImporterRegistryOnlyClassesMayRegister, register_non_class)
 		self.assertRaises(PhyloImporterRegistryClassAlreadyRegistered, register_class_twice)
 		self.assertRaises(PhyloImporterRegistryImporterNotFound, get_bad_format_name)
 		self.assertRaises(PhylogenyImportMergeConflict, import_conflict)
+		self.assertRaises(PhylogenyImportMergeConflict, bulk_import_conflict)
+		self.assertEqual(Taxon.objects.count(), 13)
 	
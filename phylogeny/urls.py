@@ -4,7 +4,7 @@ Phylogeny URLs.
 from django.conf.urls.defaults import patterns, url, include
 from django.utils.translation import ugettext_lazy as _
 
-from phylogeny.views import PhylogenyExportView
+from phylogeny.views import PhylogenyExportView, TaxonAutocompleteView
 from phylogeny.exporters import exporter_registry
 
 
@@ -12,6 +12,7 @@ extensions = '|'.join((exporter.extension for exporter in exporter_registry.get_
 
 base_urlpatterns = patterns('',
 	url(_(r'^export/(?P<slug>[-\w]+)\.(?P<ext>(%s))$') % extensions, PhylogenyExportView.as_view(), name='export'),
+	url(_(r'^autocomplete/$'), TaxonAutocompleteView.as_view(), name='autocomplete'),
 )
 
 # include base url patterns into the `phylogeny` namespace
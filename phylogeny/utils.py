@@ -1,16 +1,26 @@
 '''
 General purpose functions.
 '''
+import bz2
+import codecs
+import zlib
 from os import path
+from calendar import timegm
 from datetime import datetime
+from time import mktime, time
 
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache
+from django.db import connection, router, transaction
+from django.db.models import Q
+from django.utils import simplejson, timezone
 from django.template.defaultfilters import slugify
 
 
 def get_taxon_image_upload_to(instance, filename):
 	'''
 	Generates an ``upload_to`` path based on the model name and the current date.
-
+	
 	Upload paths are in the format:
 		phylogeny/{{ model_name }}/{{ year }}/{{ month }}/
 	'''
@@ -28,16 +38,293 @@ def get_taxon_image_upload_to(instance, filename):
 	)
 
 
+def get_timestamp(date):
+	'''
+	Returns the timestamp (in seconds) of a datetime, which is in local time
+	if it is naive.
+	'''
+	if timezone.is_aware(date):
+		return timegm(date.utctimetuple())
+	return int(mktime(date.timetuple()))
+
+
+class SlugAllocator(object):
+	'''
+	Allocates slugs which are unique within a model's table.
+	
+	Existing slugs equal to a base slug or starting with the base and a
+	hyphen are fetched with a single query the first time the base is seen.
+	Unique suffixes are then handed out from an in-memory counter.  Slugs
+	handed out are remembered, so one allocator may be reused across a whole
+	import session.  Values without any slug characters (such as u'???') are
+	given the model name as their base, rather than an empty slug.
+	'''
+	def __init__(self, model, slugfield='slug'):
+		self.model = model
+		self.slugfield = slugfield
+		self._taken = {}
+		self._suffixes = {}
+		self._allocated = set()
+	
+	def get_taken(self, base):
+		'''Returns the set of slugs taken in the database for a base slug.'''
+		if base not in self._taken:
+			lookup = Q(**{self.slugfield: base}) | Q(**{'%s__startswith' % self.slugfield: base + '-'})
+			self._taken[base] = set(self.model._default_manager.filter(lookup).values_list(self.slugfield, flat=True))
+			self._suffixes[base] = 0
+		return self._taken[base]
+	
+	def reserve(self, slug):
+		'''Marks a slug as used so that it is never allocated.'''
+		self._allocated.add(slug)
+	
+	def allocate(self, value):
+		'''Returns a unique slug on a name.'''
+		base = slugify(value) or self.model._meta.module_name
+		taken = self.get_taken(base)
+		suffix = self._suffixes[base]
+		while True:
+			potential = base
+			if suffix:
+				potential = '-'.join([base, str(suffix)])
+			suffix += 1
+			if potential not in taken and potential not in self._allocated:
+				break
+		self._suffixes[base] = suffix
+		self.reserve(potential)
+		return potential
+
+
 def slugify_unique(value, model, slugfield='slug'):
 	'''
 	Returns a slug on a name which is unique within a model's table.
 	'''
-	suffix = 0
-	potential = base = slugify(value)
+	return SlugAllocator(model, slugfield).allocate(value)
+
+
+def bulk_create(model, objects, batch_size=500, raw=False):
+	'''
+	Inserts model instances with batched INSERT statements.  Batches are kept
+	below SQLite's limit on query parameters.  Raw inserts write field values
+	as they are, as loaddata does, rather than through the fields'
+	`pre_save` (which sets `auto_now` dates); instances must have their
+	primary keys.
+	'''
+	if connection.vendor == 'sqlite':
+		batch_size = min(batch_size, max(1, 999 // len(model._meta.local_fields)))
+	for start in range(0, len(objects), batch_size):
+		if raw:
+			model._base_manager._insert(objects[start:start + batch_size], fields=model._meta.local_fields, raw=True, using=router.db_for_write(model))
+		else:
+			model._default_manager.bulk_create(objects[start:start + batch_size])
+	if raw and objects:
+		transaction.commit_unless_managed()
+
+
+def join_chunks(strings, chunk_size=65536):
+	'''
+	Joins an iterable of short strings into chunks of at least `chunk_size`
+	characters (except for the last chunk), which are yielded as they fill.
+	'''
+	chunk = []
+	length = 0
+	for string in strings:
+		chunk.append(string)
+		length += len(string)
+		if length >= chunk_size:
+			yield u''.join(chunk)
+			chunk = []
+			length = 0
+	if chunk:
+		yield u''.join(chunk)
+
+
+class SharedVersion(object):
+	'''
+	A version number shared by processes through a cache backend (set with
+	its alias; None to share nothing), which processes increment to tell
+	others that their cached data is stale.
+	
+	The version is stored with a long explicit timeout, since Django's
+	default timeout would expire it within minutes.  Whenever it is missing
+	(expired or evicted) it starts again from the current time in
+	microseconds rather than from 0, so it never returns to a value seen
+	before.
+	'''
+	timeout = 60 * 60 * 24 * 365
+	
+	def __init__(self, key, alias=None):
+		self.key = key
+		self.alias = alias
+		self._cache = None
+	
+	@property
+	def cache(self):
+		'''The cache backend, or None if the version is not shared.'''
+		if self._cache is None and self.alias:
+			self._cache = get_cache(self.alias)
+		return self._cache
+	
+	def get_initial(self):
+		'''Returns a new version which is greater than any version before it.'''
+		return int(time() * 1000000)
+	
+	def get(self):
+		'''Returns the current version, or None if it is not shared.'''
+		if self.cache is None:
+			return None
+		version = self.cache.get(self.key)
+		if version is None:
+			self.cache.add(self.key, self.get_initial(), self.timeout)
+			version = self.cache.get(self.key)
+		return version
+	
+	def reset(self):
+		'''Starts the version again from a new value (the current time).'''
+		if self.cache is not None:
+			self.cache.set(self.key, self.get_initial(), self.timeout)
+	
+	def increment(self):
+		'''
+		Increments the version and returns it, or returns None if it is not
+		shared or was missing (and has been started again).
+		'''
+		if self.cache is None:
+			return None
+		try:
+			if type(self.cache).incr.im_func is BaseCache.incr.im_func:
+				# the generic incr sets the value again with the default timeout
+				version = self.cache.get(self.key)
+				if version is None:
+					raise ValueError
+				version += 1
+				self.cache.set(self.key, version, self.timeout)
+				return version
+			return self.cache.incr(self.key)
+		except ValueError:
+			self.reset()
+			return None
+
+
+class DecompressedFile(object):
+	'''
+	Reads a compressed file as a stream, decompressing `chunk_size` bytes at a
+	time with a decompressor object (such as zlib's or bz2's).  Supports
+	`read`, `readline` and iteration over lines.
+	'''
+	def __init__(self, fileobj, decompressor, chunk_size=65536):
+		self.fileobj = fileobj
+		self.decompressor = decompressor
+		self.chunk_size = chunk_size
+		self._buffer = ''
+		self._position = 0
+		self._end_of_file = False
+	
+	def fill(self):
+		'''Decompresses data into the buffer until some is decompressed or the file ends.'''
+		while not self._end_of_file:
+			data = self.fileobj.read(self.chunk_size)
+			if not data:
+				self._end_of_file = True
+				return
+			data = self.decompressor.decompress(data)
+			if data:
+				self._buffer = self._buffer[self._position:] + data
+				self._position = 0
+				return
+	
+	def read(self, size=-1):
+		'''Returns up to `size` decompressed bytes (all remaining bytes if `size` is negative).'''
+		while (size < 0 or len(self._buffer) - self._position < size) and not self._end_of_file:
+			self.fill()
+		end = len(self._buffer) if size < 0 else self._position + size
+		data = self._buffer[self._position:end]
+		self._position += len(data)
+		return data
+	
+	def readline(self):
+		'''Returns the next decompressed line, including its line break.'''
+		end = self._buffer.find('\n', self._position)
+		while end < 0 and not self._end_of_file:
+			searched = len(self._buffer) - self._position
+			self.fill()
+			end = self._buffer.find('\n', self._position + searched)
+		end = len(self._buffer) if end < 0 else end + 1
+		line = self._buffer[self._position:end]
+		self._position = end
+		return line
+	
+	def __iter__(self):
+		return iter(self.readline, '')
+	
+	def close(self):
+		self.fileobj.close()
+
+
+def open_decompressed(fileobj):
+	'''
+	Returns a stream of the decompressed contents of a gzip or bzip2
+	compressed file (detected by its first bytes), or the file itself if it
+	is not compressed.  The file must be seekable.
+	'''
+	magic = fileobj.read(3)
+	fileobj.seek(0)
+	if magic.startswith('\x1f\x8b'):
+		# gzip header and trailer
+		return DecompressedFile(fileobj, zlib.decompressobj(16 + zlib.MAX_WBITS))
+	if magic == 'BZh':
+		return DecompressedFile(fileobj, bz2.BZ2Decompressor())
+	return fileobj
+
+
+def iter_json_array(fileobj, chunk_size=65536, encoding='utf-8'):
+	'''
+	Yields the values of a JSON array (such as a fixture) as they are read
+	from a file, `chunk_size` bytes at a time, without reading the whole file.
+	Raises ValueError if the file is not a JSON array.
+	'''
+	decoder = simplejson.JSONDecoder()
+	text_decoder = codecs.getincrementaldecoder(encoding)()
+	buffer = u''
+	position = 0
+	end_of_file = False
+	opened = False
+	# whether a value may follow (after the opening bracket or a comma)
+	separated = True
 	while True:
-		if suffix:
-			potential = "-".join([base, str(suffix)])
-		if not model.objects.filter(**{slugfield: potential}).count():
-			return potential
-		# we hit a conflicting slug, so bump the suffix & try again
-		suffix += 1
+		while position < len(buffer) and buffer[position].isspace():
+			position += 1
+		if position < len(buffer):
+			character = buffer[position]
+			if not opened:
+				if character != u'[':
+					raise ValueError('Expected a JSON array.')
+				opened = True
+				position += 1
+				continue
+			if character == u']':
+				return
+			if not separated:
+				if character != u',':
+					raise ValueError('Expected "," or "]" in JSON array.')
+				separated = True
+				position += 1
+				continue
+			try:
+				value, end = decoder.raw_decode(buffer, position)
+			except ValueError:
+				if end_of_file:
+					raise
+				end = None
+			# a value ending the buffer (a number, say) may continue in the next chunk
+			if end is not None and (end < len(buffer) or end_of_file):
+				position = end
+				separated = False
+				yield value
+				continue
+		elif end_of_file:
+			raise ValueError('Unexpected end of JSON array.')
+		data = fileobj.read(chunk_size)
+		end_of_file = not data
+		buffer = buffer[position:] + text_decoder.decode(data, final=end_of_file)
+		position = 0
@@ -1,17 +1,43 @@
 '''
 Django view classes for the Phylogeny app.
 '''
-from django.http import HttpResponse
+from time import time
+
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.utils import simplejson
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.generic.base import View
 from django.views.generic.detail import BaseDetailView, DetailView
 from django.views.generic.edit import FormView
-from django.contrib import messages
-from django.utils.translation import ugettext_lazy as _
 
-from phylogeny.models import Taxon
+from phylogeny import app_settings
+from phylogeny.models import Taxon, ImportJob
 from phylogeny.forms import PhylogenyImportForm
-from phylogeny.exporters import exporter_registry
-from phylogeny.exceptions import PhylogenyImportMergeConflict
-from phylogeny.importers import importer_registry
+from phylogeny.artifacts import artifact_store
+from phylogeny.exporters import exporter_registry, export_cache
+from phylogeny.jobs import import_job_runner
+from phylogeny.search import search_index_cache
+from phylogeny.utils import get_timestamp
+
+
+def close_connection_after(chunks):
+	'''
+	Yields the chunks of a streamed response, then closes the database
+	connection.  Chunks are produced after the view has returned, outside
+	TransactionMiddleware (as in autocommit), so the connection their queries
+	use is closed once they are exhausted or the response is closed.
+	'''
+	try:
+		for chunk in chunks:
+			yield chunk
+	finally:
+		connection.close()
 
 
 class PhylogenyExportView(BaseDetailView):
@@ -34,23 +60,90 @@ class PhylogenyExportView(BaseDetailView):
 		format_name = self.request.GET.get('format', '')
 		rank_filter = self.request.GET.get('rank_filter', '')
 		
-		content_type = 'text/plain'
-		if ext == 'xml':
-			content_type = 'application/xml'
-		
 		if format_name:
 			exporter = exporter_registry.get_by_format_and_extension(format_name, ext)
 		else:
 			exporter = exporter_registry.get_by_extension(ext)
 		
+		content_type = exporter.content_type or 'text/plain'
+		if ext == 'xml':
+			content_type = 'application/xml'
+		
 		exporter.taxon = self.object
 		if rank_filter:
 			exporter.pruning_filter = {'rank': rank_filter}
-		content = exporter()
-		response = HttpResponse(content, content_type=content_type, **kwargs)
-		response['Content-Disposition'] = 'attachment; filename=%s.%s' % (slug, ext)
 		
+		# answer conditional requests from one aggregate query, before
+		# anything is exported
+		state = exporter.get_state()
+		version = exporter.get_version(state)
+		digest = export_cache.get_digest(exporter, version=version)
+		# the last modification is the later of the phylogeny's dates and the
+		# last change to exported data (which dates deletions); without the
+		# export cache deletions cannot be dated, so only the ETag is given.
+		# It is only given once its second is over, so that later changes
+		# always have a later date
+		last_modified = export_cache.get_last_modified()
+		if last_modified is not None and state['last_modified']:
+			last_modified = max(last_modified, get_timestamp(state['last_modified']))
+		if last_modified is not None and last_modified >= int(time()):
+			last_modified = None
+		if self.is_not_modified(digest, last_modified):
+			response = HttpResponseNotModified()
+		else:
+			# serve materialized artifacts while they are fresh
+			artifact_path = artifact_store.get_fresh_path(exporter, digest)
+			if artifact_path:
+				content = FileWrapper(open(artifact_path, 'rb'))
+			elif app_settings.PHYLOGENY_EXPORT_STREAMING and exporter.streaming:
+				# the response iterates over the exporter's chunks as it is sent
+				content = close_connection_after(exporter.stream())
+			else:
+				content = export_cache.export(exporter, version=version)
+			response = HttpResponse(content, content_type=content_type, **kwargs)
+			response['Content-Disposition'] = 'attachment; filename=%s.%s' % (slug, ext)
+		
+		response['ETag'] = quote_etag(digest)
+		if last_modified:
+			response['Last-Modified'] = http_date(last_modified)
 		return response
+	
+	def is_not_modified(self, etag, last_modified):
+		'''
+		Returns True if the request's `If-None-Match` header matches the ETag
+		(unquoted) or, without it, if the `If-Modified-Since` header is no earlier than
+		the last modification (a timestamp, or None).
+		'''
+		if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+		if if_none_match:
+			etags = parse_etags(if_none_match)
+			return '*' in etags or etag in etags
+		if_modified_since = parse_http_date_safe(self.request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+		return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+
+class TaxonAutocompleteView(View):
+	'''
+	Returns the taxa matching a partial name (URL parameter `q`) as JSON, from
+	the search index:  names starting with it, then names and common names
+	with words starting with its words, or names within a few typos of it if
+	none do.  URL parameter `limit` sets the number of taxa (at most 50).
+	'''
+	default_limit = 10
+	max_limit = 50
+	
+	def get(self, request, *args, **kwargs):
+		'''Returns a HTTP response of the matching taxa's names, slugs and common names.'''
+		query = request.GET.get('q', '')
+		try:
+			limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+		except ValueError:
+			limit = self.default_limit
+		index = search_index_cache.get()
+		pks = index.autocomplete(query, limit=limit) or index.fuzzy(query, limit=limit)
+		taxa = dict((taxon['pk'], taxon,) for taxon in Taxon.objects.filter(pk__in=pks).values('pk', 'name', 'slug', 'common_name'))
+		results = [{'name': taxa[pk]['name'], 'slug': taxa[pk]['slug'], 'common_name': taxa[pk]['common_name']} for pk in pks if pk in taxa]
+		return HttpResponse(simplejson.dumps(results), content_type='application/json')
 
 
 class PhylogenyAdminVisualizeView(DetailView):
@@ -59,7 +152,7 @@ class PhylogenyAdminVisualizeView(DetailView):
 	'''
 	template_name = 'admin/phylogeny/visualize.html'
 	queryset = Taxon.objects.all()
-
+	
 	def render_to_response(self, context, *args, **kwargs):
 		'''
 		Renders a phylogeny visualization.
@@ -84,32 +177,62 @@ class PhylogenyAdminImportView(FormView):
 		context.update({'is_popup': True})
 		return super(PhylogenyAdminImportView, self).render_to_response(context, *args, **kwargs)
 	
+	@method_decorator(csrf_exempt)
+	def dispatch(self, request, *args, **kwargs):
+		'''
+		Streams uploads to a temporary file in chunks, whatever their size,
+		rather than holding them in memory.  Upload handlers are set before
+		the CSRF check reads the form.
+		'''
+		request.upload_handlers = [TemporaryFileUploadHandler()]
+		return csrf_protect(super(PhylogenyAdminImportView, self).dispatch)(request, *args, **kwargs)
+	
 	def post(self, request, *args, **kwargs):
 		'''
-		Processes file upload as a phylogeny import if form is valid.
+		Saves the file upload as an import job if the form is valid and
+		redirects to the job's progress page.  The phylogeny is imported in
+		the background.
 		'''
 		form_class = self.get_form_class()
 		form = self.get_form(form_class)
+		if not form.is_valid():
+			return self.form_invalid(form)
 		
-		if form.is_valid():
-			file_format = form.cleaned_data.get('file_format')
-			try:
-				importer = importer_registry.get_by_format_name(file_format)
-				for file_field in request.FILES:
-					importer.save(import_from=request.FILES[file_field])
-			except PhylogenyImportMergeConflict as exception:
-				form._errors['file_field'] = form.error_class(['%s' % exception])
-				return self.render_to_response({'form': form})
-			except:
-				form._errors['file_field'] = form.error_class([_('An error occurred during import.  Please verify the file format and file contents.  If the error persists, try importing a different file or format.')])
-				return self.render_to_response({'form': form})
-		
-		messages.success(request, _('Successfully imported phylogeny.'))
-		
-		return HttpResponse('''
-			<script type="text/javascript">
-				opener.location=opener.location;
-				window.close();
-			</script>
-		''')
+		# the job is committed before the background thread looks it up
+		with transaction.commit_on_success():
+			job = import_job_runner.create(form.cleaned_data['file_field'], form.cleaned_data['file_format'])
+		import_job_runner.submit(job)
+		return HttpResponseRedirect(reverse('admin:phylogeny:import_job', kwargs={'pk': job.pk}))
+
+
+class PhylogenyAdminImportJobView(DetailView):
+	'''
+	Renders the progress of an import job, polling its status until the
+	job has finished.
+	'''
+	template_name = 'admin/phylogeny/import_job.html'
+	queryset = ImportJob.objects.all()
+	context_object_name = 'job'
+	
+	def render_to_response(self, context, *args, **kwargs):
+		'''
+		Renders an import job's progress.
+		'''
+		context.update({'is_popup': True, 'status': import_job_runner.get_status(self.object)})
+		return super(PhylogenyAdminImportJobView, self).render_to_response(context, *args, **kwargs)
 
+
+class PhylogenyAdminImportJobStatusView(BaseDetailView):
+	'''
+	Returns the status of an import job as JSON:  clades processed, elapsed
+	time and outcome (see `ImportJobRunner.get_status`).
+	'''
+	queryset = ImportJob.objects.all()
+	
+	def render_to_response(self, context, **kwargs):
+		'''
+		Returns a HTTP response of the job status, which is never cached.
+		'''
+		response = HttpResponse(simplejson.dumps(import_job_runner.get_status(self.object)), content_type='application/json')
+		response['Cache-Control'] = 'no-cache'
+		return response